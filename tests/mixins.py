@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 import os
 
 s = os.getenv("DBREDIS_1_PORT_6379_TCP_ADDR")
@@ -27,6 +27,15 @@ else:
 REDIS_PORT = 6379
 
 
+def delay(secs):
+    """
+    Returns a Deferred which fires after `secs` seconds
+    """
+    d = defer.Deferred()
+    reactor.callLater(secs, d.callback, None)
+    return d
+
+
 class RedisVersionCheckMixin(object):
     @defer.inlineCallbacks
     def checkVersion(self, major, minor, patch=0):
@@ -0,0 +1,121 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT
+
+
+class TestBatching(unittest.TestCase):
+    KEY = "txredisapi:test_batching"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.db = redis.BatchingHandler(db)
+        yield db.mset(dict(("%s:%d" % (self.KEY, i), i) for i in range(5)))
+        yield db.hmset(self.KEY + ":h", {"a": "x", "b": "y"})
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(["%s:%d" % (self.KEY, i) for i in range(5)] +
+                             [self.KEY + ":h"])
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_gets_batched(self):
+        keys = ["%s:%d" % (self.KEY, i) for i in (3, 1, 4, 1, 0)]
+        keys.append(self.KEY + ":missing")
+        values = yield defer.gatherResults([self.db.get(k) for k in keys])
+        self.assertEqual(values, [3, 1, 4, 1, 0, None])
+        self.assertEqual(self.db.stats(), {"requests": 6, "batches": 1})
+
+    @defer.inlineCallbacks
+    def test_hgets_batched(self):
+        values = yield defer.gatherResults([
+            self.db.hget(self.KEY + ":h", "b"),
+            self.db.hget(self.KEY + ":h", "a"),
+            self.db.hget(self.KEY + ":h", "c"),
+            self.db.get(self.KEY + ":2"),
+        ])
+        self.assertEqual(values, ["y", "x", None, 2])
+        self.assertEqual(self.db.stats()["batches"], 2)
+
+    @defer.inlineCallbacks
+    def test_max_batch(self):
+        self.db.maxBatch = 2
+        keys = ["%s:%d" % (self.KEY, i) for i in range(5)]
+        values = yield defer.gatherResults([self.db.get(k) for k in keys])
+        self.assertEqual(values, list(range(5)))
+        self.assertEqual(self.db.stats()["batches"], 3)
+
+    @defer.inlineCallbacks
+    def test_single_get_keeps_errors(self):
+        d = self.db.get(self.KEY + ":h")
+        yield self.assertFailure(d, redis.ResponseError)
+
+
+class TestShardedBatching(unittest.TestCase):
+    KEYS = ["txredisapi:test_sharded_batching:%d" % i for i in range(20)]
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hosts = ["%s:%d" % (REDIS_HOST, REDIS_PORT),
+                 "127.0.0.1:%d" % REDIS_PORT]
+        self.sharded = yield redis.ShardedConnection(hosts, reconnect=False)
+        for i, key in enumerate(self.KEYS):
+            yield self.sharded.set(key, i)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for key in self.KEYS:
+            yield self.sharded.delete(key)
+        yield self.sharded.disconnect()
+
+    @defer.inlineCallbacks
+    def test_sharded_mget_order(self):
+        keys = list(reversed(self.KEYS))
+        values = yield self.sharded.mget(keys)
+        self.assertEqual(values, list(reversed(range(20))))
+
+    @defer.inlineCallbacks
+    def test_batched_gets(self):
+        db = redis.BatchingHandler(self.sharded)
+        values = yield defer.gatherResults([db.get(k) for k in self.KEYS])
+        self.assertEqual(values, list(range(20)))
+        self.assertEqual(db.stats()["batches"], 1)
+
+    @defer.inlineCallbacks
+    def test_bad_key_fails_alone(self):
+        db = redis.BatchingHandler(self.sharded)
+        # The sharded handler raises right away for bytes keys
+        d1 = db.get(b"txredisapi:bytes")
+        d2 = db.get(self.KEYS[1])
+        d3 = db.get(self.KEYS[2])
+        yield self.assertFailure(d1, ValueError)
+        values = yield defer.gatherResults([d2, d3])
+        self.assertEqual(values, [1, 2])
+
+    @defer.inlineCallbacks
+    def test_later_batches_sent(self):
+        db = redis.BatchingHandler(self.sharded, maxBatch=1)
+        d1 = db.get(b"txredisapi:bytes")
+        d2 = db.get(self.KEYS[3])
+        d3 = db.hget(self.KEYS[4], "f")
+        yield self.assertFailure(d1, ValueError)
+        value = yield d2
+        self.assertEqual(value, 3)
+        yield self.assertFailure(d3, redis.ResponseError)
@@ -18,7 +18,7 @@ from twisted.trial import unittest
 
 import txredisapi as redis
 
-from tests.mixins import REDIS_HOST, REDIS_PORT
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
 
 
 class TestBlockingCommands(unittest.TestCase):
@@ -45,3 +45,145 @@ class TestBlockingCommands(unittest.TestCase):
 
         yield db.delete(self.QUEUE_KEY, self.TEST_KEY)
         yield db.disconnect()
+
+
+class TestBlockingPool(unittest.TestCase):
+    QUEUE_KEY = 'txredisapi:test_blocking_pool'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=1, reconnect=False,
+                                             blockingPoolsize=2)
+        yield self.db.delete(self.QUEUE_KEY)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.QUEUE_KEY)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_main_pool_stays_available(self):
+        self.assertEqual(self.db._factory.blockingFactory, None)
+        pops = [self.db.brpop(self.QUEUE_KEY, timeout=5) for _ in range(3)]
+        blocking = self.db._factory.blockingFactory
+        self.assertEqual(blocking.connecting, 2)
+
+        # The only connection of the main pool is not taken by BRPOP
+        yield self.db.set(self.QUEUE_KEY + ':other', 'x')
+        yield self.db.delete(self.QUEUE_KEY + ':other')
+        self.assertEqual(len(self.db._factory.connectionQueue.pending), 1)
+
+        yield self.db.lpush(self.QUEUE_KEY, ['a', 'b', 'c'])
+        results = yield defer.gatherResults(pops)
+        self.assertEqual(sorted(r[1] for r in results), ['a', 'b', 'c'])
+        self.assertEqual(blocking.size, 2)
+
+    @defer.inlineCallbacks
+    def test_idle_connections_closed(self):
+        blocking = self.db._factory.getBlockingFactory()
+        blocking.connectionQueue.idleTimeout = 0.1
+        yield self.db.lpush(self.QUEUE_KEY, 'a')
+        yield self.db.brpop(self.QUEUE_KEY, timeout=1)
+        self.assertEqual(blocking.size, 1)
+        yield delay(0.3)
+        self.assertEqual(blocking.size, 0)
+
+        # Opened again when needed
+        yield self.db.lpush(self.QUEUE_KEY, 'b')
+        result = yield self.db.brpop(self.QUEUE_KEY, timeout=1)
+        self.assertEqual(result, [self.QUEUE_KEY, 'b'])
+
+    @defer.inlineCallbacks
+    def test_killed_connection_replaced(self):
+        blocking = self.db._factory.getBlockingFactory()
+        blocking.maxsize = 1
+        first = self.db.brpop(self.QUEUE_KEY, timeout=5)
+        # Waits for the only connection of the pool
+        second = self.db.brpop(self.QUEUE_KEY, timeout=1)
+        while not blocking.size:
+            yield delay(0.01)
+        clients = yield self.db.execute_command("CLIENT", "LIST")
+        for line in clients.splitlines():
+            fields = dict(f.split("=", 1) for f in line.split())
+            if fields["cmd"] == "brpop":
+                yield self.db.execute_command("CLIENT", "KILL", "ID",
+                                              fields["id"])
+
+        yield self.assertFailure(first, redis.ConnectionError)
+        result = yield second
+        self.assertEqual(result, None)
+        result = yield self.db.brpop(self.QUEUE_KEY, timeout=1)
+        self.assertEqual(result, None)
+        self.assertEqual(blocking.size, 1)
+
+    @defer.inlineCallbacks
+    def test_not_configured(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.addCleanup(db.disconnect)
+        self.assertIdentical(db._factory.getBlockingFactory(), db._factory)
+
+
+class TestBlockingMultiplexer(unittest.TestCase):
+    KEY = 'txredisapi:test_multiplexer'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=1,
+                                        reconnect=False, blockingPoolsize=1)
+        self.db = redis.BlockingMultiplexer(db)
+        self.keys = ['%s:%d' % (self.KEY, i) for i in range(50)]
+        yield db.delete(self.keys)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.keys)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_many_waiters_one_connection(self):
+        pops = [self.db.blpop(key) for key in self.keys]
+        yield delay(0.05)
+        for key in reversed(self.keys):
+            yield self.db.rpush(key, key + ':value')
+        results = yield defer.gatherResults(pops)
+        self.assertEqual(results, [[key, key + ':value']
+                                   for key in self.keys])
+        self.assertEqual(self.db.handler._factory.blockingFactory.size, 1)
+        self.assertEqual(self.db.stats()["waiting"], 0)
+
+    @defer.inlineCallbacks
+    def test_same_key_fifo(self):
+        first = self.db.blpop(self.keys[0])
+        second = self.db.blpop([self.keys[1], self.keys[0]])
+        yield delay(0.05)
+        yield self.db.rpush(self.keys[0], ['a', 'b'])
+        r1 = yield first
+        r2 = yield second
+        self.assertEqual((r1[1], r2[1]), ('a', 'b'))
+
+    @defer.inlineCallbacks
+    def test_timeout_and_push_back(self):
+        d = self.db.blpop(self.keys[0], timeout=0.1)
+        result = yield d
+        self.assertEqual(result, None)
+        self.assertEqual(self.db.stats()["keys"], 0)
+
+        other = self.db.blpop(self.keys[1], timeout=1)
+        yield self.db.rpush(self.keys[1], 'x')
+        result = yield other
+        self.assertEqual(result, [self.keys[1], 'x'])
+
+        # The value for a key nobody waits for anymore is not lost
+        self.db._popped([self.keys[2], 'y'])
+        yield delay(0.05)
+        values = yield self.db.lrange(self.keys[2], 0, -1)
+        self.assertEqual(values, ['y'])
+
+    @defer.inlineCallbacks
+    def test_errors_fan_out(self):
+        yield self.db.set(self.keys[0], 'string')
+        d1 = self.db.blpop(self.keys[0])
+        d2 = self.db.blpop(self.keys[1])
+        for d in (d1, d2):
+            yield self.assertFailure(d, redis.ResponseError)
@@ -0,0 +1,154 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import RedisVersionCheckMixin, REDIS_HOST, REDIS_PORT, delay
+
+
+class TestClientCache(unittest.TestCase, RedisVersionCheckMixin):
+    KEY = "txredisapi:test_client_cache"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.other = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                            reconnect=False)
+        self.db = self.other
+        if not (yield self.checkVersion(6, 0)):
+            yield self.other.disconnect()
+            raise unittest.SkipTest("CLIENT TRACKING requires Redis >= 6.0")
+        yield self.other.delete([self.KEY, self.KEY + ":h"])
+
+        self.cache = redis.ClientCache(maxEntries=100)
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False,
+                                             clientCache=self.cache)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.other.delete([self.KEY, self.KEY + ":h"])
+        yield self.db.disconnect()
+        yield self.other.disconnect()
+
+    @defer.inlineCallbacks
+    def test_hit_and_invalidation(self):
+        yield self.other.set(self.KEY, "a")
+        value = yield self.db.get(self.KEY)
+        self.assertEqual(value, "a")
+        value = yield self.db.get(self.KEY)
+        self.assertEqual(value, "a")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+        # Written by another client: the server sends an invalidation
+        yield self.other.set(self.KEY, "b")
+        yield delay(0.1)
+        value = yield self.db.get(self.KEY)
+        self.assertEqual(value, "b")
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    @defer.inlineCallbacks
+    def test_own_writes(self):
+        yield self.db.set(self.KEY, "a")
+        yield self.db.get(self.KEY)
+        yield self.db.set(self.KEY, "b")
+        value = yield self.db.get(self.KEY)
+        self.assertEqual(value, "b")
+
+    @defer.inlineCallbacks
+    def test_hashes_and_mget(self):
+        yield self.other.hmset(self.KEY + ":h", {"f1": "v1", "f2": "v2"})
+        yield self.other.set(self.KEY, "a")
+
+        value = yield self.db.hget(self.KEY + ":h", "f1")
+        self.assertEqual(value, "v1")
+        value = yield self.db.hgetall(self.KEY + ":h")
+        self.assertEqual(value, {"f1": "v1", "f2": "v2"})
+        value = yield self.db.mget([self.KEY, self.KEY + ":none"])
+        self.assertEqual(value, ["a", None])
+
+        hits = self.cache.stats()["hits"]
+        yield self.db.hget(self.KEY + ":h", "f1")
+        yield self.db.hgetall(self.KEY + ":h")
+        value = yield self.db.get(self.KEY)
+        self.assertEqual(value, "a")
+        self.assertEqual(self.cache.stats()["hits"], hits + 3)
+
+        yield self.other.hset(self.KEY + ":h", "f1", "new")
+        yield delay(0.1)
+        value = yield self.db.hget(self.KEY + ":h", "f1")
+        self.assertEqual(value, "new")
+
+    @defer.inlineCallbacks
+    def test_lru_bounds(self):
+        self.cache.maxEntries = 2
+        yield self.other.mset({"%s:%d" % (self.KEY, i): i for i in range(3)})
+        for i in range(3):
+            yield self.db.get("%s:%d" % (self.KEY, i))
+        stats = self.cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        yield self.other.delete(["%s:%d" % (self.KEY, i) for i in range(3)])
+
+    def test_max_bytes(self):
+        cache = redis.ClientCache(maxBytes=10)
+        cache.store("a", "get", "12345")
+        cache.store("b", "get", "12345")
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache.lookup("b", "get"), (True, "12345"))
+
+    def test_inflight_invalidation(self):
+        cache = redis.ClientCache()
+        d = defer.Deferred()
+        cache._fetch(lambda *args: d, ["k"], ["get"], ("k",), {},
+                     lambda reply: [reply])
+        # Invalidated while the read was in flight: the reply may be stale
+        cache.invalidate("k")
+        d.callback("old")
+        self.assertEqual(cache.lookup("k", "get"), (False, None))
+
+    @defer.inlineCallbacks
+    def test_flushed_when_tracking_lost(self):
+        yield self.other.set(self.KEY, "a")
+        yield self.db.get(self.KEY)
+        self.assertEqual(self.cache.stats()["entries"], 1)
+
+        tracker = self.cache._trackers[self.db._factory]
+        tracker.continueTrying = False
+        tracker.pool[0].transport.loseConnection()
+        yield tracker.waitForEmptyPool()
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+        # Not cached anymore
+        yield self.db.get(self.KEY)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    @defer.inlineCallbacks
+    def test_tracking_rejected(self):
+        def client_id(conn):
+            return defer.fail(redis.ResponseError("NOPERM client id"))
+        self.patch(redis.ClientTrackingProtocol, "client_id", client_id)
+
+        cache = redis.ClientCache()
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False,
+                                    clientCache=cache)
+        self.addCleanup(db.disconnect)
+        # Reads go to the server, uncached
+        yield self.other.set(self.KEY, "a")
+        value = yield db.get(self.KEY)
+        self.assertEqual(value, "a")
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertTrue(cache._trackers[db._factory].failed)
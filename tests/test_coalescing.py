@@ -0,0 +1,80 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT
+
+
+class TestCoalescing(unittest.TestCase):
+    KEY = "txredisapi:test_coalescing"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.db = redis.CoalescingHandler(db)
+        yield self.db.hmset(self.KEY, {"a": "1"})
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_identical_reads_share_reply(self):
+        conn = self.db.handler._factory.pool[0]
+        sent = len(conn.replyQueue.waiting)
+        results = [self.db.hgetall(self.KEY) for _ in range(10)]
+        self.assertEqual(len(conn.replyQueue.waiting), sent + 1)
+
+        results = yield defer.gatherResults(results)
+        self.assertEqual(results, [{"a": 1}] * 10)
+        # replies are not shared objects
+        results[0]["b"] = 2
+        self.assertEqual(results[1], {"a": 1})
+
+        stats = self.db.stats()
+        self.assertEqual(stats["coalesced"], 9)
+        self.assertEqual(stats["commands"]["hgetall"],
+                         {"requests": 10, "coalesced": 9})
+
+    @defer.inlineCallbacks
+    def test_different_args_not_coalesced(self):
+        yield defer.gatherResults([self.db.hget(self.KEY, "a"),
+                                   self.db.hget(self.KEY, "b")])
+        self.assertEqual(self.db.stats()["coalesced"], 0)
+
+    @defer.inlineCallbacks
+    def test_writes_not_coalesced(self):
+        yield defer.gatherResults([self.db.hset(self.KEY, "c", "1"),
+                                   self.db.hset(self.KEY, "c", "1")])
+        self.assertEqual(self.db.stats()["requests"], 0)
+
+    @defer.inlineCallbacks
+    def test_per_command(self):
+        self.db.commands.discard("hget")
+        yield defer.gatherResults([self.db.hget(self.KEY, "a"),
+                                   self.db.hget(self.KEY, "a")])
+        self.assertEqual(self.db.stats()["coalesced"], 0)
+
+    @defer.inlineCallbacks
+    def test_errors_fan_out(self):
+        yield self.db.set(self.KEY + ":str", "x")
+        self.addCleanup(self.db.delete, self.KEY + ":str")
+        d1 = self.db.hgetall(self.KEY + ":str")
+        d2 = self.db.hgetall(self.KEY + ":str")
+        for d in (d1, d2):
+            yield self.assertFailure(d, redis.ResponseError)
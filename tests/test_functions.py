@@ -0,0 +1,98 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import RedisVersionCheckMixin, REDIS_HOST, REDIS_PORT
+
+
+LIBRARY = """#!lua name=txredisapi_test
+redis.register_function('txr_incr', function(keys, args)
+    return redis.call('INCRBY', keys[1], args[1])
+end)
+redis.register_function{
+    function_name='txr_get',
+    callback=function(keys, args) return redis.call('GET', keys[1]) end,
+    flags={'no-writes'}
+}
+"""
+
+
+class TestFunctions(unittest.TestCase, RedisVersionCheckMixin):
+    KEY = "txredisapi:test_functions"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False)
+        if not (yield self.checkVersion(7, 0)):
+            yield self.db.disconnect()
+            raise unittest.SkipTest("Functions require Redis >= 7.0")
+        yield self.db.delete(self.KEY)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        try:
+            yield self.db.function_delete("txredisapi_test")
+        except redis.ResponseError:
+            pass
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_load_and_call(self):
+        name = yield self.db.function_load(LIBRARY)
+        self.assertEqual(name, "txredisapi_test")
+        yield self.assertFailure(self.db.function_load(LIBRARY),
+                                 redis.ResponseError)
+        name = yield self.db.function_load(LIBRARY, replace=True)
+        self.assertEqual(name, "txredisapi_test")
+
+        r = yield self.db.fcall("txr_incr", [self.KEY], [5])
+        self.assertEqual(r, 5)
+        r = yield self.db.fcall_ro("txr_get", [self.KEY])
+        self.assertEqual(r, 5)
+        yield self.assertFailure(self.db.fcall_ro("txr_incr", [self.KEY], [1]),
+                                 redis.ResponseError)
+
+        libs = yield self.db.function_list("txredisapi_test")
+        self.assertEqual(len(libs), 1)
+
+    @defer.inlineCallbacks
+    def test_registry_reloads(self):
+        name = yield self.db.register_library(LIBRARY)
+        self.assertEqual(name, "txredisapi_test")
+        self.assertIn(name, self.db._factory.libraries)
+
+        # The server forgets it, the next call loads it again once
+        yield self.db.function_delete(name)
+        r = yield defer.gatherResults([
+            self.db.fcall("txr_incr", [self.KEY], [1]) for _ in range(4)])
+        self.assertEqual(sorted(r), [1, 2, 3, 4])
+
+
+class TestFunctionRouting(unittest.TestCase):
+    def test_fcall_ro_is_read_only(self):
+        self.assertIn("fcall_ro", redis.ReadOnlyMethods)
+        self.assertNotIn("fcall", redis.ReadOnlyMethods)
+
+    @defer.inlineCallbacks
+    def test_sharded_fcall_needs_a_key(self):
+        hosts = ["%s:%d" % (REDIS_HOST, REDIS_PORT)]
+        db = yield redis.ShardedConnection(hosts, reconnect=False)
+        self.addCleanup(db.disconnect)
+        self.assertRaises(ValueError, db.fcall_ro, "txr_get")
+        self.assertRaises(ValueError, db.fcall, "txr_incr", [], [1])
@@ -0,0 +1,100 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import six
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT
+
+
+class CountingTransport(StringTransport):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+
+class MockFactory(object):
+    continueTrying = True
+    isLazy = False
+    error = None
+
+    def connectionError(self, why):
+        self.error = why
+
+
+class TestPipelinedHandshake(unittest.TestCase):
+    def _connect(self, **kwargs):
+        proto = redis.BaseRedisProtocol(**kwargs)
+        proto.factory = MockFactory()
+        transport = CountingTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_single_write(self):
+        proto, transport = self._connect(password="secret", dbid=2,
+                                         clientName="worker-1")
+        connected = proto.whenConnected()
+
+        self.assertEqual(transport.writes, 1)
+        self.assertEqual(transport.value(), six.b("").join([
+            proto._build_command("AUTH", "secret"),
+            proto._build_command("CLIENT", "SETNAME", "worker-1"),
+            proto._build_command("SELECT", 2),
+        ]))
+        self.assertFalse(connected.called)
+
+        proto.dataReceived(six.b("+OK\r\n+OK\r\n+OK\r\n"))
+        self.assertIs(self.successResultOf(connected), proto)
+
+    def test_no_handshake(self):
+        proto, transport = self._connect()
+        self.assertEqual(transport.writes, 0)
+        self.assertEqual(proto.connected, 1)
+
+    def test_failed_auth(self):
+        proto, transport = self._connect(password="wrong", dbid=2)
+        connected = proto.whenConnected()
+
+        proto.dataReceived(six.b("-ERR invalid password\r\n+OK\r\n"))
+        self.assertFalse(connected.called)
+        self.assertTrue(transport.disconnecting)
+        self.assertFalse(proto.factory.continueTrying)
+        self.assertEqual(proto.factory.error,
+                         "Redis error: could not auth: ERR invalid password")
+
+    def test_failed_select(self):
+        proto, transport = self._connect(dbid=100000)
+        proto.dataReceived(six.b("-ERR DB index is out of range\r\n"))
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(proto.factory.error,
+                         "Redis error: could not set dbid=100000: "
+                         "ERR DB index is out of range")
+
+
+class TestClientName(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_client_name(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=2,
+                                        reconnect=False, dbid=1,
+                                        clientName="txredisapi-test")
+        self.addCleanup(db.disconnect)
+        for conn in db._factory.pool:
+            name = yield conn.client_getname()
+            self.assertEqual(name, "txredisapi-test")
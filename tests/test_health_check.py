@@ -0,0 +1,108 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
+
+
+class SilentProtocol(Protocol):
+    """Accepts the connection but never answers anything"""
+
+
+class TestHealthCheck(unittest.TestCase):
+    silent_port = 36390
+
+    @defer.inlineCallbacks
+    def test_rtt_is_measured(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=2,
+                                        reconnect=False,
+                                        healthCheckInterval=0.05)
+        yield delay(0.2)
+
+        state = db.healthState()
+        self.assertEqual(len(state), 2)
+        for conn in state:
+            self.assertTrue(conn["healthy"])
+            self.assertTrue(conn["connected"])
+            self.assertIsNotNone(conn["rtt"])
+            self.assertIsNotNone(conn["last_check"])
+
+        yield db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_dead_connection_evicted(self):
+        factory = Factory.forProtocol(SilentProtocol)
+        listener = reactor.listenTCP(self.silent_port, factory)
+        self.addCleanup(listener.stopListening)
+
+        db = yield redis.ConnectionPool("127.0.0.1", self.silent_port,
+                                        poolsize=2, reconnect=False,
+                                        healthCheckInterval=0.05)
+        conns = list(db._factory.pool)
+        yield delay(0.3)
+
+        for conn in conns:
+            self.assertFalse(conn.connected)
+            self.assertFalse(conn.healthy)
+        self.assertEqual(db._factory.size, 0)
+        self.assertEqual(db._factory.connectionQueue.pending, [])
+
+        yield db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_disabled_by_default(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        yield db.ping()
+        self.assertIsNone(db._factory._healthCheckCall)
+        self.assertIsNone(db.healthState()[0]["rtt"])
+        yield db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_busy_connection_kept(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=1,
+                                        reconnect=False, maxInFlight=2,
+                                        healthCheckInterval=0.05)
+        self.assertAlmostEqual(db._factory.healthCheckTimeout, 0.15)
+        conn = db._factory.pool[0]
+
+        # The connection stays in the pool while DEBUG SLEEP runs, and a
+        # PING queued behind it must not get the connection evicted
+        yield db.execute_command("DEBUG", "SLEEP", "0.3")
+        self.assertTrue(conn.connected)
+        yield delay(0.1)
+        self.assertTrue(conn.healthy)
+
+        yield db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        factory = Factory.forProtocol(SilentProtocol)
+        listener = reactor.listenTCP(self.silent_port, factory)
+        self.addCleanup(listener.stopListening)
+
+        db = yield redis.ConnectionPool("127.0.0.1", self.silent_port,
+                                        poolsize=1, reconnect=False,
+                                        healthCheckInterval=0.05,
+                                        healthCheckTimeout=0.5)
+        conn = db._factory.pool[0]
+        yield delay(0.3)
+        self.assertTrue(conn.connected)
+        yield delay(0.4)
+        self.assertFalse(conn.connected)
+
+        yield db.disconnect()
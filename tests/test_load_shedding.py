@@ -0,0 +1,77 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT
+
+
+class TestLoadShedding(unittest.TestCase):
+    KEY = "txredisapi:test_load_shedding"
+
+    @defer.inlineCallbacks
+    def test_max_in_flight(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=1,
+                                        reconnect=False, maxInFlight=2,
+                                        maxWaiters=1)
+        self.addCleanup(db.disconnect)
+        yield db.set(self.KEY, "value")
+
+        conn = db._factory.pool[0]
+        d1 = db.get(self.KEY)
+        d2 = db.get(self.KEY)
+        self.assertEqual(len(conn.replyQueue.waiting), 2)
+
+        # over the in-flight limit: waits for a free slot
+        d3 = db.get(self.KEY)
+        self.assertEqual(len(conn.replyQueue.waiting), 2)
+        self.assertFalse(d3.called)
+
+        # over the waiters limit: fails right away
+        d4 = db.get(self.KEY)
+        self.failureResultOf(d4, redis.PoolExhausted)
+
+        result = yield defer.gatherResults([d1, d2, d3])
+        self.assertEqual(result, ["value"] * 3)
+
+        yield db.delete(self.KEY)
+
+    @defer.inlineCallbacks
+    def test_max_waiters_blocking(self):
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=1,
+                                        reconnect=False, maxWaiters=1)
+        self.addCleanup(db.disconnect)
+        yield db.delete(self.KEY)
+
+        d1 = db.blpop(self.KEY, timeout=2)
+        d2 = db.blpop(self.KEY, timeout=2)
+        d3 = db.get(self.KEY)
+        self.failureResultOf(d3, redis.PoolExhausted)
+
+        other = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                       reconnect=False)
+        yield other.rpush(self.KEY, ["a", "b"])
+        yield other.disconnect()
+
+        result = yield defer.gatherResults([d1, d2])
+        self.assertEqual(result, [[self.KEY, "a"], [self.KEY, "b"]])
+
+    @defer.inlineCallbacks
+    def test_unlimited_by_default(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.addCleanup(db.disconnect)
+        result = yield defer.gatherResults([db.ping() for _ in range(100)])
+        self.assertEqual(len(result), 100)
@@ -0,0 +1,102 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_buckets(self):
+        h = redis.LatencyHistogram(precision=3)
+        for us in (0, 7, 8, 9, 16, 17, 31, 1000, 123456):
+            b = h.bucket(us)
+            upper = h.upper(b)
+            self.assertTrue(us < upper * 1e6 + 1e-6, (us, upper))
+            self.assertTrue(upper * 1e6 - us <= max(1, us / 8.0) + 1e-6,
+                            (us, upper))
+        self.assertEqual(h.bucket(16), h.bucket(17))
+        self.assertNotEqual(h.bucket(16), h.bucket(18))
+
+    def test_percentiles(self):
+        h = redis.LatencyHistogram()
+        for i in range(99):
+            h.record(0.001)
+        h.record(0.5)
+        self.assertEqual(h.count, 100)
+        self.assertTrue(0.001 <= h.percentile(50) < 0.00113)
+        self.assertTrue(0.001 <= h.percentile(99) < 0.00113)
+        self.assertEqual(h.percentile(100), 0.5)
+        self.assertEqual(h.cumulative([0.0001, 0.01, 1.0]),
+                         [(0.0001, 0), (0.01, 99), (1.0, 100)])
+
+
+class TestCommandMetrics(unittest.TestCase):
+    KEY = "txredisapi:test_metrics"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False,
+                                             metrics=True)
+        self.metrics = self.db.metrics()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_commands(self):
+        yield self.db.set(self.KEY, "x" * 100)
+        for i in range(3):
+            yield self.db.get(self.KEY)
+        yield self.assertFailure(self.db.hget(self.KEY, "f"),
+                                 redis.ResponseError)
+
+        stats = self.metrics.stats()
+        self.assertEqual(stats["commands"]["GET"]["count"], 3)
+        self.assertEqual(stats["commands"]["SET"]["count"], 1)
+        self.assertTrue(stats["commands"]["GET"]["p99"] > 0)
+        self.assertEqual(stats["errors"], {"HGET": {"ResponseError": 1}})
+        self.assertTrue(stats["bytes_out"] > 100)
+        self.assertTrue(stats["bytes_in"] > 300)
+
+    @defer.inlineCallbacks
+    def test_prometheus(self):
+        yield self.db.get(self.KEY)
+        yield self.assertFailure(self.db.execute_command("NOSUCHCOMMAND"),
+                                 redis.ResponseError)
+        text = self.metrics.prometheus(labels={"node": "a"})
+        lines = text.splitlines()
+        self.assertIn("# TYPE redis_client_command_duration_seconds "
+                      "histogram", lines)
+        self.assertIn('redis_client_command_duration_seconds_bucket'
+                      '{node="a",command="GET",le="+Inf"} 1', lines)
+        self.assertIn('redis_client_command_duration_seconds_count'
+                      '{node="a",command="GET"} 1', lines)
+        self.assertIn('redis_client_command_errors_total'
+                      '{node="a",command="NOSUCHCOMMAND",'
+                      'error="ResponseError"} 1', lines)
+        self.assertTrue(any(line.startswith(
+            'redis_client_bytes_sent_total{node="a"} ') for line in lines))
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.assertEqual(db.metrics(), None)
+        yield db.get(self.KEY)
+        yield db.disconnect()
@@ -0,0 +1,120 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
+
+
+def _event(command, *args):
+    return redis.MonitorEvent(0.0, 0, "lua", command, list(args))
+
+
+class TestMonitorEvent(unittest.TestCase):
+    def test_parse(self):
+        event = redis.MonitorEvent.parse(
+            '1339518083.107412 [3 127.0.0.1:60866] "set" "key" "a b"')
+        self.assertEqual(event.timestamp, 1339518083.107412)
+        self.assertEqual(event.db, 3)
+        self.assertEqual(event.client, "127.0.0.1:60866")
+        self.assertEqual(event.command, "SET")
+        self.assertEqual(event.args, ["key", "a b"])
+
+    def test_escapes(self):
+        event = redis.MonitorEvent.parse(
+            r'1.5 [0 lua] "set" "k\"1" "a\nb" "\xc3\xa9" "\\"')
+        self.assertEqual(event.client, "lua")
+        self.assertEqual(event.args, ['k"1', "a\nb", u"\xe9", "\\"])
+
+    def test_not_monitor_lines(self):
+        self.assertEqual(redis.MonitorEvent.parse("OK"), None)
+        self.assertEqual(redis.MonitorEvent.parse(1), None)
+
+
+class TestHotKeyAggregator(unittest.TestCase):
+    def test_top(self):
+        agg = redis.HotKeyAggregator(k=2)
+        for i in range(10):
+            agg.add(_event("GET", "hot"))
+        for i in range(5):
+            agg.add(_event("HGET", "warm", "f"))
+        for i in range(50):
+            agg.add(_event("GET", "cold:%d" % i))
+        agg.add(_event("MGET", "hot", "warm"))
+        agg.add(_event("PING"))
+
+        self.assertEqual(agg.top_keys(), [("hot", 11), ("warm", 6)])
+        self.assertEqual(agg.top_commands(),
+                         [("GET", 60), ("HGET", 5)])
+        self.assertEqual(agg.estimate("hot"), 11)
+        self.assertEqual(agg.events, 67)
+
+    def test_keys(self):
+        agg = redis.HotKeyAggregator()
+        self.assertEqual(agg.keys(_event("MSET", "a", "1", "b", "2")),
+                         ["a", "b"])
+        self.assertEqual(agg.keys(_event("EVALSHA", "sha", "2", "a", "b",
+                                         "arg")), ["a", "b"])
+        self.assertEqual(agg.keys(_event("PUBLISH", "channel", "m")), [])
+
+    def test_decay(self):
+        agg = redis.HotKeyAggregator(k=1)
+        for i in range(4):
+            agg.add(_event("GET", "old"))
+        agg.decay(0.25)
+        self.assertEqual(agg.top_keys(), [("old", 1)])
+        agg.add(_event("GET", "new"))
+        agg.add(_event("GET", "new"))
+        self.assertEqual(agg.top_keys(), [("new", 2)])
+
+
+class TestMonitor(unittest.TestCase):
+    KEY = "txredisapi:test_monitor"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.aggregator = redis.HotKeyAggregator()
+        self.factory = redis.MonitorFactory(aggregator=self.aggregator)
+        self.factory.continueTrying = False
+        reactor.connectTCP(REDIS_HOST, REDIS_PORT, self.factory)
+        self.monitor = yield self.factory.deferred
+        self.db = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                         reconnect=False)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+        yield self.monitor.disconnect()
+
+    @defer.inlineCallbacks
+    def test_aggregated(self):
+        reply = yield self.monitor.monitor()
+        self.assertEqual(reply, "OK")
+        for i in range(5):
+            yield self.db.set(self.KEY, i)
+        while self.aggregator.top_commands(1) != [("SET", 5)]:
+            yield delay(0.01)
+        self.assertEqual(self.aggregator.top_keys(1), [(self.KEY, 5)])
+
+    @defer.inlineCallbacks
+    def test_sampled(self):
+        self.factory.pool[0].sampleRate = 0.0
+        yield self.monitor.monitor()
+        yield self.db.set(self.KEY, 1)
+        yield self.db.ping()
+        yield delay(0.05)
+        self.assertEqual(self.aggregator.events, 0)
@@ -0,0 +1,233 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
+
+
+class TestGlobToRegex(unittest.TestCase):
+    def assertMatches(self, pattern, key, expected=True):
+        regex = re.compile(redis._glob_to_regex(pattern))
+        self.assertEqual(bool(regex.match(key)), expected,
+                         "%r ~ %r" % (pattern, key))
+
+    def test_patterns(self):
+        self.assertMatches("user:*", "user:1")
+        self.assertMatches("user:*", "users:1", False)
+        self.assertMatches("h?llo", "hallo")
+        self.assertMatches("h?llo", "hllo", False)
+        self.assertMatches("h[ae]llo", "hello")
+        self.assertMatches("h[ae]llo", "hillo", False)
+        self.assertMatches("h[^e]llo", "hallo")
+        self.assertMatches("h[^e]llo", "hello", False)
+        self.assertMatches("h[a-b]llo", "hbllo")
+        self.assertMatches("a.b", "axb", False)
+        self.assertMatches("a\\*", "a*")
+        self.assertMatches("a\\*", "ab", False)
+
+
+class TestReplyCache(unittest.TestCase):
+    def test_lfu_eviction(self):
+        cache = redis.ReplyCache(maxEntries=2, policy="lfu")
+        cache.store("a", "get", 1)
+        cache.store("b", "get", 2)
+        cache.lookup("a", "get")
+        cache.lookup("a", "get")
+        cache.store("c", "get", 3)
+        self.assertEqual(cache.lookup("a", "get"), (True, 1))
+        self.assertEqual(cache.lookup("b", "get"), (False, None))
+        self.assertEqual(cache.lookup("c", "get"), (True, 3))
+
+    def test_lru_eviction(self):
+        cache = redis.ReplyCache(maxEntries=2)
+        cache.store("a", "get", 1)
+        cache.store("b", "get", 2)
+        cache.lookup("a", "get")
+        cache.store("c", "get", 3)
+        self.assertEqual(cache.lookup("a", "get"), (True, 1))
+        self.assertEqual(cache.lookup("b", "get"), (False, None))
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, redis.ReplyCache, policy="fifo")
+
+
+class TestNearCache(unittest.TestCase):
+    KEY = "txredisapi:test_near_cache"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.other = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                            reconnect=False)
+        db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
+        self.db = redis.NearCacheHandler(db, [(self.KEY + ":short*", 0.2),
+                                              (self.KEY + ":*", 60)],
+                                         negativeTtl=0.2)
+        yield self.other.delete([self.KEY + ":a", self.KEY + ":short"])
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.other.delete([self.KEY + ":a", self.KEY + ":short"])
+        yield self.db.disconnect()
+        yield self.other.disconnect()
+
+    @defer.inlineCallbacks
+    def test_ttl(self):
+        key = self.KEY + ":short"
+        yield self.other.set(key, "a")
+        value = yield self.db.get(key)
+        self.assertEqual(value, "a")
+
+        yield self.other.set(key, "b")
+        value = yield self.db.get(key)
+        self.assertEqual(value, "a")
+
+        yield delay(0.3)
+        value = yield self.db.get(key)
+        self.assertEqual(value, "b")
+
+    @defer.inlineCallbacks
+    def test_uncached_keys(self):
+        key = "txredisapi:test_near_cache_uncached"
+        yield self.other.set(key, "a")
+        yield self.db.get(key)
+        yield self.db.get(key)
+        self.assertEqual(self.db.stats()["entries"], 0)
+        self.assertEqual(self.db.stats()["misses"], 0)
+        yield self.other.delete(key)
+
+    @defer.inlineCallbacks
+    def test_own_writes(self):
+        key = self.KEY + ":a"
+        yield self.db.set(key, "a")
+        value = yield self.db.get(key)
+        self.assertEqual(value, "a")
+        yield self.db.set(key, "b")
+        value = yield self.db.get(key)
+        self.assertEqual(value, "b")
+
+        yield self.db.hset(key + "h", "f", "1")
+        yield self.db.hgetall(key + "h")
+        yield self.db.delete([key + "h"])
+        value = yield self.db.hgetall(key + "h")
+        self.assertEqual(value, {})
+
+    @defer.inlineCallbacks
+    def test_own_writes_every_key(self):
+        k1, k2, h = self.KEY + ":k1", self.KEY + ":k2", self.KEY + ":h"
+        self.addCleanup(self.other.delete, [k1, k2, h])
+
+        @defer.inlineCallbacks
+        def check(write, key, expected, read="get", *args):
+            yield getattr(self.db, read)(key, *args)
+            yield write
+            value = yield getattr(self.db, read)(key, *args)
+            self.assertEqual(value, expected)
+
+        yield self.db.set(k1, 1)
+        yield check(self.db.incrby(k1, 5), k1, 6)
+        yield check(self.db.incrbyfloat(k1, 0.5), k1, 6.5)
+        yield check(self.db.append(k1, "x"), k1, "6.5x")
+        yield check(self.db.setrange(k1, 0, "7"), k1, "7.5x")
+        yield check(self.db.psetex(k1, 10000, "p"), k1, "p")
+        yield check(self.db.getdel(k1), k1, None)
+
+        yield self.db.set(k1, "a")
+        yield self.db.set(k2, "b")
+        yield check(self.db.rename(k1, k2), k2, "a")
+        yield self.db.set(k1, "c")
+        yield check(self.db.renamenx(k2, k1), k1, "c")
+        yield check(self.db.delete(k2, k1), k1, None)
+        yield self.db.mset({k1: "d", k2: "e"})
+        yield check(self.db.unlink([k1, k2]), k2, None)
+
+        self.assertEqual(redis._written_keys("smove", (k1, k2, "m"), {}),
+                         [k1, k2])
+        self.assertEqual(redis._written_keys("sort", (k1,), {"store": k2}),
+                         [k2])
+
+        yield check(self.db.hsetnx(h, "f", "v"), h, "v", "hget", "f")
+        yield check(self.db.hincrbyfloat(h, "n", 1.5), h, 1.5, "hget", "n")
+        yield check(self.db.hdel(h, ["f"]), h, {"n": 1.5}, "hgetall")
+
+    @defer.inlineCallbacks
+    def test_transactions_and_pipelines(self):
+        yield self.db.disconnect()
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=2,
+                                        reconnect=False)
+        self.db = redis.NearCacheHandler(db, [(self.KEY + ":*", 60)])
+        key = self.KEY + ":a"
+        yield self.db.set(key, "a")
+        yield self.db.get(key)
+
+        t = yield self.db.multi()
+        yield t.set(key, "b")
+        yield self.db.get(key)
+        yield t.commit()
+        value = yield self.db.get(key)
+        self.assertEqual(value, "b")
+
+        t = yield self.db.watch(key)
+        t = yield t.multi()
+        yield t.incr(key + "n")
+        yield t.append(key, "c")
+        yield t.commit()
+        value = yield self.db.get(key)
+        self.assertEqual(value, "bc")
+        yield self.other.delete(key + "n")
+
+        p = yield self.db.pipeline()
+        p.set(key, "d")
+        yield self.db.get(key)
+        yield p.execute_pipeline()
+        value = yield self.db.get(key)
+        self.assertEqual(value, "d")
+
+    @defer.inlineCallbacks
+    def test_flush_invalidates_all(self):
+        yield self.db.set(self.KEY + ":a", "a")
+        yield self.db.get(self.KEY + ":a")
+        self.assertEqual(self.db.stats()["entries"], 1)
+        self.db.cache.invalidating("flushdb", lambda: defer.succeed(None))()
+        self.assertEqual(self.db.stats()["entries"], 0)
+
+    @defer.inlineCallbacks
+    def test_negative_caching(self):
+        key = self.KEY + ":a"
+        value = yield self.db.get(key)
+        self.assertEqual(value, None)
+
+        yield self.other.set(key, "a")
+        value = yield self.db.get(key)
+        self.assertEqual(value, None)
+        self.assertEqual(self.db.stats()["hits"], 1)
+
+        # negativeTtl is shorter than the TTL of the pattern
+        yield delay(0.3)
+        value = yield self.db.get(key)
+        self.assertEqual(value, "a")
+
+    @defer.inlineCallbacks
+    def test_mget(self):
+        yield self.other.set(self.KEY + ":a", "a")
+        value = yield self.db.mget([self.KEY + ":a", "txredisapi:uncached"])
+        self.assertEqual(value, ["a", None])
+        self.assertEqual(self.db.stats()["entries"], 1)
+        value = yield self.db.get(self.KEY + ":a")
+        self.assertEqual(value, "a")
+        self.assertEqual(self.db.stats()["hits"], 1)
@@ -13,12 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from twisted.trial import unittest
 
 import txredisapi as redis
 
-from tests.mixins import REDIS_HOST, REDIS_PORT
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
 
 
 class TestRedisConnections(unittest.TestCase):
@@ -81,17 +81,13 @@ class TestRedisConnections(unittest.TestCase):
     @defer.inlineCallbacks
     def testRedisOperationsSet1(self):
 
-        def sleep(secs):
-            d = defer.Deferred()
-            reactor.callLater(secs, d.callback, None)
-            return d
         db = yield redis.Connection(REDIS_HOST, REDIS_PORT, reconnect=False)
         key, value = "txredisapi:test1", "foo"
         # test expiration in milliseconds
         yield db.set(key, value, pexpire=10)
         result_1 = yield db.get(key)
         self.assertEqual(result_1, value)
-        yield sleep(0.015)
+        yield delay(0.015)
         result_2 = yield db.get(key)
         self.assertEqual(result_2, None)
 
@@ -99,7 +95,7 @@ class TestRedisConnections(unittest.TestCase):
         yield db.set(key, value, expire=1)
         result_3 = yield db.get(key)
         self.assertEqual(result_3, value)
-        yield sleep(1.001)
+        yield delay(1.001)
         result_4 = yield db.get(key)
         self.assertEqual(result_4, None)
         yield db.disconnect()
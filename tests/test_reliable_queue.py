@@ -0,0 +1,90 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
+
+
+class TestReliableQueue(unittest.TestCase):
+    NAME = "txredisapi:test_reliable_queue"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False)
+        self.queue = redis.ReliableQueue(self.db, self.NAME,
+                                         visibilityTimeout=0.2, batchSize=10)
+        yield self.db.delete(self.queue.keys)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.queue.stop()
+        yield self.db.delete(self.queue.keys)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_claim_and_ack(self):
+        last = yield self.queue.push(["job%d" % i for i in range(25)])
+        self.assertEqual(last, 25)
+
+        jobs = yield self.queue.claim()
+        self.assertEqual(len(jobs), 10)
+        self.assertEqual(jobs[0], (1, "job0"))
+        size = yield self.queue.size()
+        self.assertEqual(size, (15, 10))
+
+        acks = [self.queue.ack(job_id) for job_id, _ in jobs[:5]]
+        acks.append(self.queue.ack([job_id for job_id, _ in jobs[5:]]))
+        yield defer.gatherResults(acks)
+        size = yield self.queue.size()
+        self.assertEqual(size, (15, 0))
+        stored = yield self.db.hlen(self.queue.keys[2])
+        self.assertEqual(stored, 15)
+
+        jobs = yield self.queue.claim(100)
+        self.assertEqual([job for _, job in jobs],
+                         ["job%d" % i for i in range(10, 25)])
+        jobs = yield self.queue.claim()
+        self.assertEqual(jobs, [])
+
+    @defer.inlineCallbacks
+    def test_requeue_expired(self):
+        yield self.queue.push(["a", "b", "c"])
+        jobs = yield self.queue.claim(2)
+        yield self.queue.touch(jobs[1][0], timeout=60)
+        count = yield self.queue.requeue()
+        self.assertEqual(count, 0)
+
+        yield delay(0.3)
+        count = yield self.queue.requeue()
+        self.assertEqual(count, 1)
+        # Expired jobs are retried first
+        jobs = yield self.queue.claim()
+        self.assertEqual([job for _, job in jobs], ["a", "c"])
+
+        # Acks of jobs no longer in progress are ignored
+        acked = yield self.queue.ACK(self.db, self.queue.keys[1:3], [99])
+        self.assertEqual(acked, 0)
+
+    @defer.inlineCallbacks
+    def test_periodic_requeue(self):
+        yield self.queue.push("a")
+        yield self.queue.claim()
+        self.queue.start(0.1)
+        yield delay(0.5)
+        size = yield self.queue.size()
+        self.assertEqual(size, (1, 0))
@@ -16,12 +16,16 @@
 # limitations under the License.
 
 
-from txredisapi import Connection
+from txredisapi import Connection, ConnectionPool, ShardedConnection
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, ensureDeferred, inlineCallbacks
+from twisted.internet.defer import succeed
 from twisted.trial import unittest
 
+import txredisapi
+
 from .mixins import RedisVersionCheckMixin, REDIS_HOST, REDIS_PORT
+from .mixins import delay
 
 
 class TestScan(unittest.TestCase, RedisVersionCheckMixin):
@@ -75,3 +79,177 @@ class TestScan(unittest.TestCase, RedisVersionCheckMixin):
         if not self.redis_2_8_0:
             skipMsg = "Redis version < 2.8.0 (found version: %s)"
             raise unittest.SkipTest(skipMsg % self.redis_version)
+
+
+class TestScanIterators(unittest.TestCase):
+    KEYS = ['_scan_iter_test_' + str(v).zfill(4) for v in range(100)]
+    HKEY = '_scan_iter_test_hash'
+    ZKEY = '_scan_iter_test_zset'
+
+    @inlineCallbacks
+    def setUp(self):
+        self.db = yield ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=2,
+                                       reconnect=False)
+        yield self.db.mset(dict((k, 'value') for k in self.KEYS))
+        yield self.db.hmset(self.HKEY, dict(('f%d' % i, 'v%d' % i)
+                                            for i in range(50)))
+        for i in range(50):
+            yield self.db.zadd(self.ZKEY, i, 'm%d' % i)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEYS + [self.HKEY, self.ZKEY])
+        yield self.db.disconnect()
+
+    @inlineCallbacks
+    def test_scan_iter_pages(self):
+        result = []
+        pages = 0
+        for page in self.db.scan_iter(pattern='_scan_iter_test_0*',
+                                      count=10):
+            keys = yield page
+            if keys is not None:
+                pages += 1
+                result.extend(keys)
+        self.assertEqual(sorted(result), self.KEYS)
+        self.assertTrue(pages > 1)
+
+    @inlineCallbacks
+    def test_scan_iter_type(self):
+        result = []
+        it = self.db.scan_iter(pattern='_scan_iter_test_*', keytype='hash')
+        while True:
+            keys = yield it.next_page()
+            if keys is None:
+                break
+            result.extend(keys)
+        self.assertEqual(result, [self.HKEY])
+
+    @inlineCallbacks
+    def test_hscan_zscan_iter(self):
+        it = self.db.hscan_iter(self.HKEY, count=5)
+        fields = yield ensureDeferred(self._collect(it))
+        self.assertEqual(dict(fields),
+                         dict(('f%d' % i, 'v%d' % i) for i in range(50)))
+
+        it = self.db.zscan_iter(self.ZKEY, pattern='m1*', count=5)
+        members = yield ensureDeferred(self._collect(it))
+        expected = [('m%d' % i, i) for i in [1] + list(range(10, 20))]
+        self.assertEqual(sorted(members), sorted(expected))
+
+    async def _collect(self, it):
+        return [item async for item in it]
+
+    @inlineCallbacks
+    def test_prefetch_and_dedup(self):
+        replies = {0: Deferred(), 1: Deferred(), 2: Deferred()}
+        calls = []
+
+        def scan(cursor):
+            calls.append(cursor)
+            return replies[cursor]
+
+        it = txredisapi.ScanIterator(scan)
+        page = it.next_page()
+        self.assertEqual(calls, [0])
+        replies[0].callback((1, ['a', 'b']))
+        # The next page is requested before the first one is consumed
+        self.assertEqual(calls, [0, 1])
+        keys = yield page
+        self.assertEqual(keys, ['a', 'b'])
+
+        page = it.next_page()
+        # A page of keys seen already is skipped
+        replies[1].callback((2, ['b', 'a']))
+        self.assertEqual(calls, [0, 1, 2])
+        replies[2].callback((0, ['b', 'c']))
+        keys = yield page
+        self.assertEqual(keys, ['c'])
+        self.assertTrue(it.finished)
+        keys = yield it.next_page()
+        self.assertEqual(keys, None)
+
+    def test_no_prefetch(self):
+        calls = []
+
+        def scan(cursor):
+            calls.append(cursor)
+            return succeed((cursor + 1, ['k%d' % cursor]))
+
+        it = txredisapi.ScanIterator(scan, dedup=False, prefetch=False)
+        it.next_page()
+        self.assertEqual(calls, [0])
+
+
+class TestShardedScan(unittest.TestCase):
+    KEYS = ['_sharded_scan_test_' + str(v).zfill(4) for v in range(60)]
+    # Two nodes pointing to the same server: each one sees every key
+    HOSTS = ["%s:%d" % (REDIS_HOST, REDIS_PORT), "127.0.0.1:%d" % REDIS_PORT]
+
+    @inlineCallbacks
+    def setUp(self):
+        self.db = yield ShardedConnection(self.HOSTS, reconnect=False)
+        self.nodes = [node._factory.uuid for node in self.db._ring.nodes]
+        for key in self.KEYS:
+            yield self.db.set(key, 'value')
+
+    @inlineCallbacks
+    def tearDown(self):
+        for key in self.KEYS:
+            yield self.db.delete(key)
+        yield self.db.disconnect()
+
+    @inlineCallbacks
+    def _collect(self, it):
+        result = []
+        for page in it:
+            keys = yield page
+            result.extend(keys or [])
+        return result
+
+    @inlineCallbacks
+    def test_scan_all_nodes(self):
+        it = self.db.scan_iter(pattern='_sharded_scan_test_*', count=10)
+        result = yield self._collect(it)
+        self.assertEqual(sorted(result), sorted(self.KEYS * 2))
+        self.assertEqual(it.checkpoint(),
+                         dict((node, None) for node in self.nodes))
+
+    @inlineCallbacks
+    def test_max_nodes_and_resume(self):
+        it = self.db.scan_iter(pattern='_sharded_scan_test_*', count=10,
+                               max_nodes=1)
+        first = yield it.next_page()
+        checkpoint = it.checkpoint()
+        # Only one node is scanned at a time
+        cursors = [checkpoint[node] for node in self.nodes]
+        self.assertEqual(sorted(c != 0 for c in cursors), [False, True])
+        it = self.db.scan_iter(pattern='_sharded_scan_test_*', count=10,
+                               checkpoint=checkpoint)
+        rest = yield self._collect(it)
+        self.assertEqual(sorted(set(first + rest)), self.KEYS)
+        self.assertEqual(len(first) + len(rest), 2 * len(self.KEYS))
+
+    @inlineCallbacks
+    def test_finished_nodes_skipped(self):
+        checkpoint = {self.nodes[0]: None}
+        it = self.db.scan_iter(pattern='_sharded_scan_test_*',
+                               checkpoint=checkpoint)
+        result = yield self._collect(it)
+        self.assertEqual(sorted(result), self.KEYS)
+
+    @inlineCallbacks
+    def test_close(self):
+        it = self.db.scan_iter(pattern='_sharded_scan_test_*', count=10,
+                               max_nodes=1)
+        yield it.next_page()
+        checkpoint = it.checkpoint()
+        it.close()
+        self.assertTrue(it.finished)
+        page = yield it.next_page()
+        self.assertIsNone(page)
+        # The node scans stopped instead of waiting for their pages to
+        # be taken
+        yield delay(0.05)
+        self.assertEqual(it._taken, {})
+        self.assertEqual(it.checkpoint(), checkpoint)
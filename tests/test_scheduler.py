@@ -0,0 +1,115 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import REDIS_HOST, REDIS_PORT, delay
+
+
+class TestDelayedScheduler(unittest.TestCase):
+    NAME = "txredisapi:test_scheduler"
+    READY = "txredisapi:test_scheduler_ready"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False)
+        self.scheduler = redis.DelayedScheduler(self.db, self.NAME,
+                                                self.READY, shards=4,
+                                                batchSize=10)
+        yield self.db.delete(self.scheduler.shards + [self.READY])
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.scheduler.stop()
+        yield self.db.delete(self.scheduler.shards + [self.READY])
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_move_due_jobs(self):
+        now = time.time()
+        for i in range(25):
+            yield self.scheduler.schedule("job%d" % i, now - 1)
+        yield self.scheduler.schedule("later", now + 60)
+        sizes = yield defer.gatherResults(
+            [self.db.zcard(k) for k in self.scheduler.shards])
+        self.assertEqual(sum(sizes), 26)
+        self.assertTrue(len([x for x in sizes if x]) > 1)
+
+        shard = self.scheduler._shard("later")
+        count, wait = yield self.scheduler.move(shard)
+        self.assertTrue(55 < wait <= 60)
+        for i in range(4):
+            while (yield self.scheduler.move(i))[0]:
+                pass
+        ready = yield self.db.lrange(self.READY, 0, -1)
+        self.assertEqual(sorted(ready),
+                         sorted("job%d" % i for i in range(25)))
+
+        yield self.scheduler.cancel("later")
+        count, wait = yield self.scheduler.move(shard)
+        self.assertEqual((count, wait), (0, None))
+
+    @defer.inlineCallbacks
+    def test_polling(self):
+        self.scheduler.maxInterval = 5
+        self.scheduler.start()
+        yield delay(0.05)
+        # Scheduled sooner than the next poll
+        yield self.scheduler.schedule("soon", time.time() + 0.1)
+        yield delay(0.3)
+        ready = yield self.db.lrange(self.READY, 0, -1)
+        self.assertEqual(ready, ["soon"])
+
+    @defer.inlineCallbacks
+    def test_adaptive_interval(self):
+        yield self.scheduler.schedule("a", time.time() + 0.5)
+        shard = self.scheduler._shard("a")
+        self.scheduler.start([shard])
+        yield delay(0.05)
+        wait = self.scheduler._calls[shard].getTime() - reactor.seconds()
+        self.assertTrue(0.3 < wait < 0.5, wait)
+
+    @defer.inlineCallbacks
+    def test_stream_target(self):
+        self.scheduler.stream = True
+        yield self.scheduler.schedule("a", time.time() - 1)
+        yield self.scheduler.move(self.scheduler._shard("a"))
+        entries = yield self.db.xrange(self.READY)
+        self.assertEqual([fields for _, fields in entries], [{"job": "a"}])
+
+    @defer.inlineCallbacks
+    def test_server_clock(self):
+        yield self.scheduler.scheduleIn("a", 60)
+        seconds, micros = yield self.db.time()
+        score = yield self.db.zscore(
+            self.scheduler.shards[self.scheduler._shard("a")], "a")
+        now = int(seconds) + int(micros) / 1e6
+        self.assertTrue(59 < score - now <= 60, score - now)
+
+    @defer.inlineCallbacks
+    def test_local_clock_ahead(self):
+        class skewed(object):
+            @staticmethod
+            def time():
+                return time.time() + 3600
+
+        self.patch(redis, "time", skewed)
+        yield self.scheduler.schedule("a", skewed.time() - 1)
+        count, wait = yield self.scheduler.move(self.scheduler._shard("a"))
+        self.assertEqual(count, 1)
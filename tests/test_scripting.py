@@ -26,6 +26,7 @@ from twisted.internet import reactor
 from twisted.python import failure
 
 from tests.mixins import Redis26CheckMixin, REDIS_HOST, REDIS_PORT
+from tests.mixins import delay
 
 
 class TestScripting(unittest.TestCase, Redis26CheckMixin):
@@ -200,3 +201,74 @@ class TestScripting(unittest.TestCase, Redis26CheckMixin):
 
     def _hash_script(self, script):
         return hashlib.sha1(script.encode()).hexdigest()
+
+
+class TestScriptObjects(unittest.TestCase):
+    _SCRIPT = "return redis.call('INCRBY', KEYS[1], ARGV[1])"
+    KEY = "txredisapi:test_script_objects"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False)
+        yield self.db.script_flush()
+        yield self.db.delete(self.KEY)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_script(self):
+        script = redis.Script(self._SCRIPT)
+        self.assertEqual(script.sha,
+                         hashlib.sha1(six.b(self._SCRIPT)).hexdigest())
+        r = yield script(self.db, keys=[self.KEY], args=[2])
+        self.assertEqual(r, 2)
+        r = yield script(self.db, keys=[self.KEY], args=[3])
+        self.assertEqual(r, 5)
+
+    @defer.inlineCallbacks
+    def test_register_script(self):
+        script = yield self.db.register_script(self._SCRIPT)
+        for conn in self.db._factory.pool:
+            self.assertIn(script.sha, conn.script_hashes)
+        exists = yield self.db.script_exists(script.sha)
+        self.assertTrue(exists)
+
+        # Connections made later load it in their handshake
+        db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT, poolsize=1)
+        self.addCleanup(db.disconnect)
+        yield db.register_script(script)
+        yield db.script_flush()
+        old_conn = db._factory.pool[0]
+        old_conn.transport.loseConnection()
+        while not db._factory.pool or db._factory.pool[0] is old_conn:
+            yield delay(0.05)
+        self.assertIn(script.sha, db._factory.pool[0].script_hashes)
+        exists = yield db.script_exists(script.sha)
+        self.assertTrue(exists)
+
+    @defer.inlineCallbacks
+    def test_register_invalid_script(self):
+        d = self.db.register_script("return (")
+        yield self.assertFailure(d, redis.ResponseError)
+        self.assertEqual(len(self.db._factory.scripts), 0)
+
+    @defer.inlineCallbacks
+    def test_pipeline_and_transaction(self):
+        script = yield self.db.register_script(self._SCRIPT)
+
+        pipe = yield self.db.pipeline()
+        script(pipe, keys=[self.KEY], args=[1])
+        script(pipe, keys=[self.KEY], args=[1])
+        r = yield pipe.execute_pipeline()
+        self.assertEqual(r, [1, 2])
+
+        # Not loaded: EVAL is used rather than an EVALSHA that could fail
+        yield self.db.script_flush()
+        t = yield self.db.multi()
+        script(t, keys=[self.KEY], args=[1])
+        r = yield t.commit()
+        self.assertEqual(r, [3])
@@ -6,6 +6,8 @@ from twisted.trial.unittest import TestCase
 
 from txredisapi import BaseRedisProtocol, Sentinel, MasterNotFoundError
 
+from tests.mixins import delay
+
 if sys.version_info >= (3, 3):
     from unittest.mock import Mock
 else:
@@ -90,6 +92,7 @@ class FakeSentinelProtocol(FakeRedisProtocol):
                      "ip", host,
                      "port", port,
                      "flags", flags,
+                     "master-link-status", self.factory.slave_link_status,
                      "num-other-sentinels", self.factory.num_other_sentinels]
                     for (host, port), flags in zip(self.factory.slave_addrs, self.factory.slave_flags)
                 ]
@@ -97,9 +100,20 @@ class FakeSentinelProtocol(FakeRedisProtocol):
             else:
                 self.send_error("No such master with that name")
 
+        elif request[0] == "SUBSCRIBE":
+            for i, channel in enumerate(request[1:]):
+                self.send_reply(["subscribe", channel, i + 1])
+            self.factory.subscribers.append((self, request[1:]))
+
         else:
             FakeRedisProtocol.replyReceived(self, request)
 
+    def connectionLost(self, why):
+        self.factory.subscribers = [
+            (proto, channels) for proto, channels in self.factory.subscribers
+            if proto is not self]
+        FakeRedisProtocol.connectionLost(self, why)
+
 
 class FakeRedisFactory(Factory):
     protocol = FakeRedisProtocol
@@ -128,9 +142,18 @@ class FakeSentinelFactory(FakeRedisFactory):
     master_flags = "master"
     slave_addrs = (("127.0.0.1", 63791), ("127.0.0.1", 63792))
     slave_flags = ("slave", "slave")
+    slave_link_status = "ok"
 
     num_other_sentinels = 0
 
+    def __init__(self):
+        self.subscribers = []
+
+    def publish(self, channel, message):
+        for proto, channels in self.subscribers:
+            if channel in channels:
+                proto.send_reply(["message", channel, message])
+
 
 class TestSentinelDiscovery(TestCase):
 
@@ -292,12 +315,6 @@ class TestConnectViaSentinel(TestCase):
         self.assertEqual(reply[0], "master")
         yield conn.disconnect()
 
-    @staticmethod
-    def _delay(secs):
-        d = defer.Deferred()
-        reactor.callLater(secs, d.callback, None)
-        return d
-
     @defer.inlineCallbacks
     def test_drop_all_when_master_changes(self):
         # When master address change detected, factory should drop and reestablish
@@ -318,7 +335,7 @@ class TestConnectViaSentinel(TestCase):
         conn._factory.pool[0].transport.loseConnection()
 
         # After a short time all connections should be to the new master
-        yield self._delay(0.2)
+        yield delay(0.2)
         addrs = [proto.transport.getPeer() for proto in conn._factory.pool]
         self.assertTrue(len(addrs), 3)
         self.assertTrue(all(addr.port == self.slave_port for addr in addrs))
@@ -356,3 +373,201 @@ class TestAuthViaSentinel(TestCase):
         reply = yield conn.role()
         self.assertEqual(reply[0], "master")
         yield conn.disconnect()
+
+
+class FakeDataRedisProtocol(FakeRedisProtocol):
+    """Answers PING and replies to GET and SET with the name of the server"""
+    def replyReceived(self, request):
+        if isinstance(request, list) and request[0] == "PING":
+            self.transport.write(b"+PONG\r\n")
+        elif isinstance(request, list) and request[0] in ("GET", "SET"):
+            self.send_reply(self.factory.name)
+        else:
+            FakeRedisProtocol.replyReceived(self, request)
+
+
+class FakeDataRedisFactory(FakeRedisFactory):
+    protocol = FakeDataRedisProtocol
+
+    def __init__(self, name, role):
+        self.name = name
+        self.role = role
+
+
+class TestReplicaRouting(TestCase):
+
+    master_port = 36379
+    slave_port = 36380
+    sentinel_port = 46379
+
+    def setUp(self):
+        self.fake_master = FakeDataRedisFactory("master", FakeRedisFactory.role)
+        self.master_listener = reactor.listenTCP(self.master_port, self.fake_master)
+        self.fake_slave = FakeDataRedisFactory(
+            "slave", ["slave", "127.0.0.1", self.master_port, "connected", 0])
+        self.slave_listener = reactor.listenTCP(self.slave_port, self.fake_slave)
+
+        self.fake_sentinel = FakeSentinelFactory()
+        self.fake_sentinel.master_addr = ("127.0.0.1", self.master_port)
+        self.fake_sentinel.slave_addrs = [("127.0.0.1", self.slave_port)]
+        self.fake_sentinel.slave_flags = ["slave"]
+        self.sentinel_listener = reactor.listenTCP(self.sentinel_port, self.fake_sentinel)
+
+        self.client = Sentinel([("127.0.0.1", self.sentinel_port)])
+        self.client.discovery_timeout = 0.2
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.disconnect()
+        self.sentinel_listener.stopListening()
+        self.master_listener.stopListening()
+        self.slave_listener.stopListening()
+
+    @defer.inlineCallbacks
+    def test_reads_go_to_replica(self):
+        conn = self.client.replica_routing_for("test", healthCheckInterval=0.05)
+        yield delay(0.3)
+
+        self.assertEqual(len(conn.replicas), 1)
+        reply = yield conn.get("foo")
+        self.assertEqual(reply, "slave")
+        reply = yield conn.set("foo", "bar")
+        self.assertEqual(reply, "master")
+
+        yield conn.disconnect()
+
+    @defer.inlineCallbacks
+    def test_fallback_to_master_without_replicas(self):
+        self.fake_sentinel.slave_addrs = []
+        conn = self.client.replica_routing_for("test", healthCheckInterval=0.05)
+        yield delay(0.3)
+
+        self.assertEqual(conn.replicas, {})
+        reply = yield conn.get("foo")
+        self.assertEqual(reply, "master")
+
+        yield conn.disconnect()
+
+    @defer.inlineCallbacks
+    def test_replica_with_broken_link_is_skipped(self):
+        self.fake_sentinel.slave_link_status = "err"
+        conn = self.client.replica_routing_for("test", healthCheckInterval=0.05)
+        yield delay(0.3)
+
+        self.assertEqual(conn.replicas, {})
+        reply = yield conn.get("foo")
+        self.assertEqual(reply, "master")
+
+        yield conn.disconnect()
+
+
+class TestFailoverEvents(TestCase):
+
+    master_port = 36379
+    slave_port = 36380
+    sentinel_port = 46379
+
+    def setUp(self):
+        self.fake_master = FakeRedisFactory()
+        self.master_listener = reactor.listenTCP(self.master_port, self.fake_master)
+        self.fake_slave = FakeRedisFactory()
+        self.fake_slave.role = ["slave", "127.0.0.1", self.master_port, "connected", 0]
+        self.slave_listener = reactor.listenTCP(self.slave_port, self.fake_slave)
+
+        self.fake_sentinel = FakeSentinelFactory()
+        self.fake_sentinel.master_addr = ("127.0.0.1", self.master_port)
+        self.fake_sentinel.slave_addrs = [("127.0.0.1", self.slave_port)]
+        self.fake_sentinel.slave_flags = ["slave"]
+        self.sentinel_listener = reactor.listenTCP(self.sentinel_port, self.fake_sentinel)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.disconnect()
+        self.sentinel_listener.stopListening()
+        self.master_listener.stopListening()
+        self.slave_listener.stopListening()
+
+    @defer.inlineCallbacks
+    def test_switch_master_moves_pool(self):
+        self.client = Sentinel([("127.0.0.1", self.sentinel_port)],
+                               watch_failover=True)
+        self.client.discovery_timeout = 1
+
+        conn = self.client.master_for("test", poolsize=3)
+        yield conn.role()
+        yield delay(0.1)
+        self.assertEqual(len(self.fake_sentinel.subscribers), 1)
+
+        # Failover: sentinel still reports the old master for a while,
+        # only the event tells about the new one.
+        self.fake_slave.role = ["master", 0, ["127.0.0.1", self.slave_port, 0]]
+        self.fake_master.role = ["slave", "127.0.0.1", self.slave_port, "connected", 0]
+        self.fake_sentinel.publish(
+            "+switch-master", "test 127.0.0.1 {0} 127.0.0.1 {1}".format(
+                self.master_port, self.slave_port))
+
+        yield delay(0.2)
+        addrs = [proto.transport.getPeer() for proto in conn._factory.pool]
+        self.assertEqual(len(addrs), 3)
+        self.assertTrue(all(addr.port == self.slave_port for addr in addrs))
+
+        # The cached address is used, no need to ask the sentinel
+        addr = yield self.client.discover_master("test")
+        self.assertEqual(addr, ("127.0.0.1", self.slave_port))
+
+        yield conn.disconnect()
+
+    @defer.inlineCallbacks
+    def test_master_sdown_forgets_cached_address(self):
+        self.client = Sentinel([("127.0.0.1", self.sentinel_port)],
+                               watch_failover=True)
+        yield self.client.discover_master("test")
+        self.assertIn("test", self.client._masters)
+
+        self.client.handle_event(
+            "+sdown", "master test 127.0.0.1 {0}".format(self.master_port))
+        self.assertNotIn("test", self.client._masters)
+
+    @defer.inlineCallbacks
+    def test_no_subscription_by_default(self):
+        self.client = Sentinel([("127.0.0.1", self.sentinel_port)])
+        conn = self.client.master_for("test")
+        yield conn.role()
+        self.assertEqual(self.fake_sentinel.subscribers, [])
+        yield conn.disconnect()
+
+    @defer.inlineCallbacks
+    def test_standby_connections_promoted(self):
+        self.client = Sentinel([("127.0.0.1", self.sentinel_port)],
+                               watch_failover=True)
+        self.client.discovery_timeout = 1
+
+        conn = self.client.master_for("test", poolsize=3, standby_poolsize=2)
+        self.addCleanup(conn.disconnect)
+        yield conn.role()
+        yield delay(0.2)
+        factory = conn._factory
+        standby = factory.standby[("127.0.0.1", self.slave_port)]
+        self.assertEqual(len(standby), 2)
+        self.assertEqual(len(factory.pool), 3)
+
+        self.fake_slave.role = ["master", 0, ["127.0.0.1", self.slave_port, 0]]
+        self.fake_master.role = ["slave", "127.0.0.1", self.slave_port, "connected", 0]
+        self.client.handle_event(
+            "+switch-master", "test 127.0.0.1 {0} 127.0.0.1 {1}".format(
+                self.master_port, self.slave_port))
+
+        # Standby connections are usable right away
+        self.assertEqual(factory.promoted, standby)
+        self.assertEqual(factory.standby, {})
+        reply = yield conn.role()
+        self.assertEqual(reply[0], "master")
+
+        # and replaced by regular connections later
+        yield delay(0.3)
+        self.assertEqual(factory.promoted, [])
+        addrs = [proto.transport.getPeer() for proto in factory.pool]
+        self.assertEqual(len(addrs), 3)
+        self.assertTrue(all(addr.port == self.slave_port for addr in addrs))
+        self.assertTrue(all(proto.transport.connector in factory.connectors
+                            for proto in factory.pool))
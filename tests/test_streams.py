@@ -0,0 +1,239 @@
+# coding: utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+import txredisapi as redis
+
+from tests.mixins import RedisVersionCheckMixin, REDIS_HOST, REDIS_PORT, delay
+
+
+class TestStreamCommands(unittest.TestCase, RedisVersionCheckMixin):
+    KEY = "txredisapi:test_stream"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False)
+        if not (yield self.checkVersion(6, 2)):
+            yield self.db.disconnect()
+            raise unittest.SkipTest("XAUTOCLAIM requires Redis >= 6.2")
+        yield self.db.delete(self.KEY)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+
+    @defer.inlineCallbacks
+    def test_add_range_read(self):
+        id1 = yield self.db.xadd(self.KEY, {"a": "1"}, id="1-1")
+        self.assertEqual(id1, "1-1")
+        yield self.db.xadd(self.KEY, {"b": "x"}, id="2-1")
+        length = yield self.db.xlen(self.KEY)
+        self.assertEqual(length, 2)
+
+        entries = yield self.db.xrange(self.KEY)
+        self.assertEqual(entries, [("1-1", {"a": 1}), ("2-1", {"b": "x"})])
+        entries = yield self.db.xrevrange(self.KEY, count=1)
+        self.assertEqual(entries, [("2-1", {"b": "x"})])
+
+        streams = yield self.db.xread({self.KEY: "1-1"})
+        self.assertEqual(list(streams.items()),
+                         [(self.KEY, [("2-1", {"b": "x"})])])
+        streams = yield self.db.xread({self.KEY: "$"}, block=50)
+        self.assertEqual(streams, {})
+
+        yield self.db.xadd(self.KEY, {"c": "y"}, maxlen=1,
+                           approximate=False)
+        length = yield self.db.xlen(self.KEY)
+        self.assertEqual(length, 1)
+
+    @defer.inlineCallbacks
+    def test_groups(self):
+        yield self.db.xgroup_create(self.KEY, "g", "0", mkstream=True)
+        yield self.db.xadd(self.KEY, {"a": "1"}, id="1-1")
+        yield self.db.xadd(self.KEY, {"a": "2"}, id="1-2")
+        streams = yield self.db.xreadgroup("g", "c1", {self.KEY: ">"})
+        self.assertEqual([e[0] for e in streams[self.KEY]], ["1-1", "1-2"])
+
+        acked = yield self.db.xack(self.KEY, "g", "1-1")
+        self.assertEqual(acked, 1)
+        pending = yield self.db.xpending(self.KEY, "g")
+        self.assertEqual(pending[0], 1)
+
+        start, entries = yield self.db.xautoclaim(self.KEY, "g", "c2", 0)
+        self.assertEqual(start, "0-0")
+        self.assertEqual(entries, [("1-2", {"a": 2})])
+        yield self.db.xgroup_destroy(self.KEY, "g")
+
+
+class TestStreamConsumer(unittest.TestCase, RedisVersionCheckMixin):
+    KEY = "txredisapi:test_stream_consumer"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = yield redis.ConnectionPool(REDIS_HOST, REDIS_PORT,
+                                             poolsize=2, reconnect=False,
+                                             blockingPoolsize=2)
+        if not (yield self.checkVersion(6, 2)):
+            yield self.db.disconnect()
+            raise unittest.SkipTest("XAUTOCLAIM requires Redis >= 6.2")
+        yield self.db.delete(self.KEY)
+        self.processed = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.delete(self.KEY)
+        yield self.db.disconnect()
+
+    def process(self, entry_id, fields):
+        self.processed.append(fields["n"])
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        return d
+
+    @defer.inlineCallbacks
+    def _waitFor(self, count):
+        for _ in range(200):
+            if len(self.processed) >= count:
+                return
+            yield delay(0.01)
+
+    @defer.inlineCallbacks
+    def test_consume_and_ack(self):
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        self.process, count=10, block=100,
+                                        window=5)
+        yield consumer.start()
+        for i in range(30):
+            yield self.db.xadd(self.KEY, {"n": i})
+        yield self._waitFor(30)
+        self.assertEqual(sorted(self.processed), list(range(30)))
+        yield consumer.stop()
+
+        self.assertEqual(consumer.stats()["processed"], 30)
+        pending = yield self.db.xpending(self.KEY, "workers")
+        self.assertEqual(pending[0], 0)
+
+    @defer.inlineCallbacks
+    def test_stale_entries_claimed(self):
+        yield self.db.xgroup_create(self.KEY, "workers", "0", mkstream=True)
+        yield self.db.xadd(self.KEY, {"n": 1})
+        # Delivered to a consumer that never acks it
+        yield self.db.xreadgroup("workers", "dead", {self.KEY: ">"})
+
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        self.process, block=100,
+                                        claimInterval=0.05, minIdleTime=10)
+        yield consumer.start()
+        yield self._waitFor(1)
+        yield consumer.stop()
+        self.assertEqual(self.processed, [1])
+        pending = yield self.db.xpending(self.KEY, "workers")
+        self.assertEqual(pending[0], 0)
+
+    @defer.inlineCallbacks
+    def test_failures_not_acked(self):
+        def process(entry_id, fields):
+            raise ValueError("boom")
+
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        process, block=100, claimInterval=0)
+        yield consumer.start()
+        yield self.db.xadd(self.KEY, {"n": 1})
+        for _ in range(100):
+            if consumer.failed:
+                break
+            yield delay(0.01)
+        yield consumer.stop()
+        self.assertEqual(consumer.stats()["failed"], 1)
+        pending = yield self.db.xpending(self.KEY, "workers")
+        self.assertEqual(pending[0], 1)
+
+    @defer.inlineCallbacks
+    def test_fatal_error_stops(self):
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        self.process, block=100,
+                                        claimInterval=0)
+        yield consumer.start(createGroup=False)
+        yield self.assertFailure(consumer.join(), redis.ResponseError)
+        self.assertFalse(consumer.running)
+        self.assertTrue(str(consumer.error).startswith("NOGROUP"))
+        yield consumer.stop()
+
+    @defer.inlineCallbacks
+    def test_connection_killed(self):
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        self.process, block=100,
+                                        claimInterval=0)
+        yield consumer.start()
+        yield self.db.execute_command("CLIENT", "KILL", "ID",
+                                      consumer._clientId)
+        # Goes on with another connection
+        for i in range(3):
+            yield self.db.xadd(self.KEY, {"n": i})
+        yield self._waitFor(3)
+        self.assertEqual(sorted(self.processed), [0, 1, 2])
+        self.assertTrue(consumer.running)
+        yield consumer.stop()
+
+    @defer.inlineCallbacks
+    def test_no_connection_left(self):
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        self.process, block=100,
+                                        claimInterval=0)
+        yield consumer.start()
+        yield self.db._factory.getBlockingFactory().disconnect()
+        yield self.assertFailure(consumer.join(), redis.ConnectionError)
+        self.assertFalse(consumer.running)
+        yield consumer.stop()
+
+    @defer.inlineCallbacks
+    def test_claim_respects_window(self):
+        yield self.db.xgroup_create(self.KEY, "workers", "0", mkstream=True)
+        for i in range(5):
+            yield self.db.xadd(self.KEY, {"n": i})
+        yield self.db.xreadgroup("workers", "dead", {self.KEY: ">"})
+
+        waiting = []
+
+        def process(entry_id, fields):
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        consumer = redis.StreamConsumer(self.db, self.KEY, "workers", "c1",
+                                        process, block=100, window=2,
+                                        claimInterval=0, minIdleTime=0)
+        yield consumer.start(createGroup=False)
+        claimed = consumer.claim()
+        for _ in range(5):
+            for _ in range(100):
+                if waiting:
+                    break
+                yield delay(0.01)
+            self.assertLessEqual(consumer.stats()["inflight"], 2)
+            waiting.pop(0).callback(None)
+        yield claimed
+        yield consumer.stop()
+        self.assertEqual(consumer.stats()["processed"], 5)
+
+    @defer.inlineCallbacks
+    def test_xread_blocks_only_with_block(self):
+        yield self.db.xadd(self.KEY, {"n": 1})
+        yield self.db.xread({self.KEY: "0"})
+        self.assertIsNone(self.db._factory.blockingFactory)
+        yield self.db.xread({self.KEY: "$"}, block=10)
+        self.assertIsNotNone(self.db._factory.blockingFactory)
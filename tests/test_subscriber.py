@@ -19,7 +19,7 @@ from twisted.trial import unittest
 
 import txredisapi as redis
 
-from tests.mixins import REDIS_HOST, REDIS_PORT
+from tests.mixins import RedisVersionCheckMixin, REDIS_HOST, REDIS_PORT, delay
 
 
 class TestSubscriberProtocol(unittest.TestCase):
@@ -149,3 +149,416 @@ class TestAuthenticatedSubscriberProtocol(unittest.TestCase):
 
         reply = yield self.db.subscribe("test_subscribe2")
         self.assertEqual(reply, [u"subscribe", u"test_subscribe2", 2])
+
+
+class TestChannelDispatcher(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.received = []
+        self.dispatcher = redis.ChannelDispatcher()
+        factory = redis.SubscriberFactory(dispatcher=self.dispatcher)
+        factory.continueTrying = False
+        reactor.connectTCP(REDIS_HOST, REDIS_PORT, factory)
+        self.db = yield factory.deferred
+        self.publisher = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                                reconnect=False)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.disconnect()
+        yield self.publisher.disconnect()
+
+    def callback(self, name):
+        def received(channel, messages):
+            self.received.append((name, channel, messages))
+        return received
+
+    def test_dispatch_batches(self):
+        d = self.dispatcher
+        d.add("a", self.callback("a"))
+        d.add_pattern("b.*", self.callback("b.*"))
+        d.add_pattern("*", self.callback("*"))
+        unhandled = d.dispatch([(None, "a", 1), ("*", "a", 1),
+                                (None, "b.1", 2), (None, "a", 3),
+                                ("b.*", "b.2", 4), ("*", "b.2", 4),
+                                ("c*", "c", 5)])
+        self.assertEqual(self.received, [
+            ("a", "a", [1, 3]), ("*", "a", [1]),
+            ("b.*", "b.2", [4]), ("*", "b.2", [4])])
+        self.assertEqual(unhandled, [(None, "b.1", 2), ("c*", "c", 5)])
+
+        d.remove_pattern("*")
+        d.remove("a")
+        self.received = []
+        unhandled = d.dispatch([(None, "a", 1), ("b.*", "b.1", 2)])
+        self.assertEqual(self.received, [("b.*", "b.1", [2])])
+        self.assertEqual(unhandled, [(None, "a", 1)])
+
+    @defer.inlineCallbacks
+    def test_messages_dispatched(self):
+        self.dispatcher.add("test_dispatch", self.callback("channel"))
+        self.dispatcher.add_pattern("test_dispatch.*",
+                                    self.callback("pattern"))
+        yield self.db.subscribe("test_dispatch")
+        yield self.db.psubscribe("test_dispatch.*")
+
+        yield self.publisher.publish("test_dispatch", "one")
+        yield self.publisher.publish("test_dispatch.x", "two")
+        yield self.db.ping()
+        self.assertEqual(self.received,
+                         [("channel", "test_dispatch", ["one"]),
+                          ("pattern", "test_dispatch.x", ["two"])])
+
+    @defer.inlineCallbacks
+    def test_messages_of_a_chunk_batched(self):
+        self.dispatcher.add("test_dispatch", self.callback("channel"))
+        yield self.db.subscribe("test_dispatch")
+
+        # Published with a single write
+        pipeline = yield self.publisher.pipeline()
+        for i in range(200):
+            pipeline.publish("test_dispatch", i)
+        yield pipeline.execute_pipeline()
+        yield self.db.ping()
+
+        messages = [m for _, _, batch in self.received for m in batch]
+        self.assertEqual(messages, list(range(200)))
+        # Delivered in the chunks the socket was read in, not one by one
+        self.assertLessEqual(len(self.received), 5)
+
+    @defer.inlineCallbacks
+    def test_matching_channel_and_pattern(self):
+        # Redis sends both a message and a pmessage: each callback gets one
+        self.dispatcher.add("test_dispatch.1", self.callback("channel"))
+        self.dispatcher.add_pattern("test_dispatch.*",
+                                    self.callback("pattern"))
+        yield self.db.subscribe("test_dispatch.1")
+        yield self.db.psubscribe("test_dispatch.*")
+
+        count = yield self.publisher.publish("test_dispatch.1", "hi")
+        self.assertEqual(count, 2)
+        yield self.db.ping()
+        self.assertEqual(sorted(self.received),
+                         [("channel", "test_dispatch.1", ["hi"]),
+                          ("pattern", "test_dispatch.1", ["hi"])])
+
+
+class PartitionedSubscriber(redis.PartitionedSubscriber):
+    def __init__(self, *args, **kwargs):
+        redis.PartitionedSubscriber.__init__(self, *args, **kwargs)
+        self.received = []
+
+    def messageReceived(self, pattern, channel, message):
+        self.received.append((pattern, channel, message))
+
+
+class TestPartitionedSubscriber(unittest.TestCase):
+    CHANNELS = ["test_partitioned:%d" % i for i in range(50)]
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.subscriber = PartitionedSubscriber(REDIS_HOST, REDIS_PORT,
+                                                partitions=3, chunkSize=7)
+        yield self.subscriber.connect()
+        self.publisher = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                                reconnect=False)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.subscriber.disconnect()
+        yield self.publisher.disconnect()
+
+    @defer.inlineCallbacks
+    def test_partitions(self):
+        yield self.subscriber.subscribe(self.CHANNELS)
+        yield self.subscriber.psubscribe("test_partitioned.*")
+        stats = self.subscriber.stats()
+        self.assertEqual(sum(s["channels"] for s in stats), 50)
+        self.assertTrue(all(s["channels"] for s in stats))
+        self.assertEqual(sum(s["patterns"] for s in stats), 1)
+
+        for channel in self.CHANNELS:
+            count = yield self.publisher.publish(channel, "m")
+            self.assertEqual(count, 1)
+        count = yield self.publisher.publish("test_partitioned.x", "p")
+        self.assertEqual(count, 1)
+        while len(self.subscriber.received) < 51:
+            yield delay(0.01)
+        self.assertIn(("test_partitioned.*", "test_partitioned.x", "p"),
+                      self.subscriber.received)
+
+        stats = self.subscriber.stats()
+        self.assertEqual(sum(s["messages"] for s in stats), 51)
+        self.assertTrue(all(s["rate"] > 0 for s in stats))
+        stats = self.subscriber.stats()
+        self.assertTrue(all(s["rate"] == 0 for s in stats))
+
+        yield self.subscriber.unsubscribe(self.CHANNELS[:10])
+        count = yield self.publisher.publish(self.CHANNELS[0], "m")
+        self.assertEqual(count, 0)
+        stats = self.subscriber.stats()
+        self.assertEqual(sum(s["channels"] for s in stats), 40)
+
+    @defer.inlineCallbacks
+    def test_resubscribe_after_reconnect(self):
+        yield self.subscriber.subscribe(self.CHANNELS)
+        channel = self.CHANNELS[0]
+        factory = self.subscriber.factories[
+            self.subscriber.partition(channel)]
+        factory.delay = factory.initialDelay = 0.05
+        factory.connection.transport.loseConnection()
+        yield factory.waitForEmptyPool()
+        self.assertFalse(all(s["connected"] for s in self.subscriber.stats()))
+
+        for _ in range(100):
+            count = yield self.publisher.publish(channel, "again")
+            if count:
+                break
+            yield delay(0.02)
+        self.assertEqual(count, 1)
+        while not self.subscriber.received:
+            yield delay(0.01)
+        self.assertEqual(self.subscriber.received,
+                         [(None, channel, "again")])
+
+    @defer.inlineCallbacks
+    def test_dispatcher(self):
+        yield self.subscriber.disconnect()
+        received = []
+        dispatcher = redis.ChannelDispatcher()
+        dispatcher.add(self.CHANNELS[1],
+                       lambda channel, messages: received.extend(messages))
+        self.subscriber = PartitionedSubscriber(REDIS_HOST, REDIS_PORT,
+                                                dispatcher=dispatcher)
+        yield self.subscriber.connect()
+        yield self.subscriber.subscribe(self.CHANNELS[:2])
+        yield self.publisher.publish(self.CHANNELS[1], "a")
+        yield self.publisher.publish(self.CHANNELS[0], "b")
+        while not received or not self.subscriber.received:
+            yield delay(0.01)
+        self.assertEqual(received, ["a"])
+        self.assertEqual(self.subscriber.received,
+                         [(None, self.CHANNELS[0], "b")])
+
+
+class TestSubscription(unittest.TestCase):
+    CHANNEL = "test_subscription"
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        factory = redis.SubscriberFactory()
+        factory.continueTrying = False
+        reactor.connectTCP(REDIS_HOST, REDIS_PORT, factory)
+        self.db = yield factory.deferred
+        self.publisher = yield redis.Connection(REDIS_HOST, REDIS_PORT,
+                                                reconnect=False)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.db.disconnect()
+        yield self.publisher.disconnect()
+
+    @defer.inlineCallbacks
+    def publish(self, count, channel=CHANNEL):
+        for i in range(count):
+            yield self.publisher.publish(channel, i)
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        sub = redis.Subscription(self.db)
+        yield sub.subscribe(self.CHANNEL)
+        yield sub.psubscribe(self.CHANNEL + ".*")
+        d = sub.get()
+        yield self.publish(1)
+        message = yield d
+        self.assertEqual(message, (None, self.CHANNEL, 0))
+        yield self.publish(1, self.CHANNEL + ".x")
+        message = yield sub.get()
+        self.assertEqual(message,
+                         (self.CHANNEL + ".*", self.CHANNEL + ".x", 0))
+
+        d = sub.get()
+        yield sub.close()
+        message = yield d
+        self.assertEqual(message, None)
+        count = yield self.publisher.publish(self.CHANNEL, "x")
+        self.assertEqual(count, 0)
+
+    @defer.inlineCallbacks
+    def test_drop_oldest(self):
+        sub = redis.Subscription(self.db, maxsize=2)
+        yield sub.subscribe(self.CHANNEL)
+        yield self.publish(5)
+        yield self.db.ping()
+        self.assertEqual(sub.stats()["dropped"], 3)
+        messages = yield defer.gatherResults([sub.get(), sub.get()])
+        self.assertEqual([m[2] for m in messages], [3, 4])
+
+    @defer.inlineCallbacks
+    def test_drop_newest(self):
+        sub = redis.Subscription(self.db, maxsize=2, overflow="drop-newest")
+        yield sub.subscribe(self.CHANNEL)
+        yield self.publish(5)
+        yield self.db.ping()
+        self.assertEqual(sub.stats()["dropped"], 3)
+        messages = yield defer.gatherResults([sub.get(), sub.get()])
+        self.assertEqual([m[2] for m in messages], [0, 1])
+
+    @defer.inlineCallbacks
+    def test_pause(self):
+        sub = redis.Subscription(self.db, maxsize=4, overflow="pause")
+        yield sub.subscribe(self.CHANNEL)
+        yield self.publish(50)
+        while not sub.paused:
+            yield delay(0.01)
+        yield delay(0.05)
+        # Reading stopped: the rest waits in the socket
+        self.assertTrue(sub.stats()["queued"] < 50)
+
+        messages = []
+        for i in range(50):
+            message = yield sub.get()
+            messages.append(message[2])
+        self.assertEqual(messages, list(range(50)))
+        stats = sub.stats()
+        self.assertEqual(stats["dropped"], 0)
+        self.assertTrue(stats["pauses"] >= 1)
+        self.assertFalse(stats["paused"])
+
+    @defer.inlineCallbacks
+    def test_async_iteration(self):
+        sub = redis.Subscription(self.db)
+        yield sub.subscribe(self.CHANNEL)
+        yield self.publish(3)
+
+        closed = []
+
+        async def consume():
+            messages = []
+            async for pattern, channel, message in sub:
+                messages.append(message)
+                if len(messages) == 3:
+                    closed.append(sub.close())
+            return messages
+
+        messages = yield defer.ensureDeferred(consume())
+        self.assertEqual(messages, [0, 1, 2])
+        yield closed[0]
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, redis.Subscription, self.db,
+                          overflow="block")
+
+
+class ShardedSubscriber(redis.ShardedSubscriber):
+    def __init__(self, *args, **kwargs):
+        redis.ShardedSubscriber.__init__(self, *args, **kwargs)
+        self.received = []
+
+    def messageReceived(self, pattern, channel, message):
+        self.received.append((channel, message))
+
+
+class TestShardedSubscriber(unittest.TestCase, RedisVersionCheckMixin):
+    HOSTS = ["%s:%d" % (REDIS_HOST, REDIS_PORT), "127.0.0.1:%d" % REDIS_PORT]
+    CHANNELS = ["test_sharded_subscriber:%d" % i for i in range(20)]
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.subscriber = ShardedSubscriber(self.HOSTS[:1])
+        self.publisher = yield redis.ShardedConnection(self.HOSTS,
+                                                       reconnect=False)
+        self.db = self.publisher._ring.nodes[0]
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.subscriber.disconnect()
+        yield self.publisher.disconnect()
+
+    @defer.inlineCallbacks
+    def wait_for(self, count):
+        while len(self.subscriber.received) < count:
+            yield delay(0.01)
+
+    @defer.inlineCallbacks
+    def test_channels_follow_the_ring(self):
+        yield self.subscriber.add_node(self.HOSTS[1])
+        yield self.subscriber.subscribe(self.CHANNELS)
+        stats = self.subscriber.stats()
+        self.assertEqual(sum(s["channels"] for s in stats), 20)
+        self.assertTrue(all(s["connected"] for s in stats))
+
+        for channel in self.CHANNELS:
+            count = yield self.publisher.publish(channel, "m")
+            self.assertEqual(count, 1)
+            node = self.publisher._node(channel)._factory.uuid
+            factory = self.subscriber.factories[
+                self.subscriber.partition(channel)]
+            self.assertEqual(factory.uuid, node)
+        yield self.wait_for(20)
+
+        # Hash tags put channels on the same node
+        self.assertEqual(self.subscriber.partition("a{tag}"),
+                         self.subscriber.partition("b{tag}"))
+
+    @defer.inlineCallbacks
+    def test_lazy_connections(self):
+        yield self.subscriber.add_node(self.HOSTS[1])
+        stats = self.subscriber.stats()
+        self.assertFalse(any(s["connected"] for s in stats))
+
+        channel = self.CHANNELS[0]
+        yield self.subscriber.subscribe(channel)
+        stats = self.subscriber.stats()
+        index = self.subscriber.partition(channel)
+        self.assertEqual([s["connected"] for s in stats],
+                         [i == index for i in range(2)])
+
+    @defer.inlineCallbacks
+    def test_channels_moved(self):
+        yield self.subscriber.subscribe(self.CHANNELS)
+        self.assertEqual(self.subscriber.stats()[0]["channels"], 20)
+
+        yield self.subscriber.add_node(self.HOSTS[1])
+        stats = self.subscriber.stats()
+        self.assertTrue(0 < stats[1]["channels"] < 20)
+        self.assertEqual(sum(s["channels"] for s in stats), 20)
+        for channel in self.CHANNELS:
+            count = yield self.publisher.publish(channel, "m")
+            self.assertEqual(count, 1)
+        yield self.wait_for(20)
+
+        yield self.subscriber.remove_node(self.HOSTS[0])
+        stats = self.subscriber.stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["channels"], 20)
+        for channel in self.CHANNELS:
+            count = yield self.db.publish(channel, "m")
+            self.assertEqual(count, 1)
+        yield self.wait_for(40)
+
+    @defer.inlineCallbacks
+    def test_unreachable_node(self):
+        yield self.subscriber.disconnect()
+        self.subscriber = ShardedSubscriber(["127.0.0.1:1"], reconnect=False)
+        d = self.subscriber.subscribe(self.CHANNELS[0])
+        yield self.assertFailure(d, redis.ConnectionError)
+        self.assertFalse(self.subscriber.stats()[0]["connected"])
+
+    def test_no_patterns(self):
+        self.assertRaises(NotImplementedError, self.subscriber.psubscribe,
+                          "test_sharded_subscriber:*")
+
+    @defer.inlineCallbacks
+    def test_ssubscribe(self):
+        if not (yield self.checkVersion(7, 0)):
+            raise unittest.SkipTest("SSUBSCRIBE requires Redis >= 7.0")
+        yield self.subscriber.disconnect()
+        self.subscriber = ShardedSubscriber(self.HOSTS, ssubscribe=True)
+        yield self.subscriber.subscribe(self.CHANNELS)
+        for channel in self.CHANNELS:
+            count = yield self.publisher.spublish(channel, "m")
+            self.assertEqual(count, 1)
+        yield self.wait_for(20)
+        self.assertEqual(sorted(self.subscriber.received),
+                         sorted((channel, "m") for channel in self.CHANNELS))
@@ -32,6 +32,7 @@ import re
 import warnings
 import zlib
 import string
+import time
 import hashlib
 import random
 
@@ -39,6 +40,7 @@ from typing import Optional, Union
 from twisted.internet import defer, ssl
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet.tcp import Connector
 from twisted.protocols import basic
 from twisted.protocols import policies
@@ -87,6 +89,314 @@ class TimeoutError(ConnectionError):
     pass
 
 
+class PoolExhausted(ConnectionError):
+    pass
+
+
+class Script(object):
+    """
+    A Lua script with its SHA1 computed once. Calling it with a
+    connection handler, a pipeline or a transaction runs it with EVALSHA
+    when the script is known to be loaded on the connection, with EVAL
+    otherwise:
+
+        incr_max = Script("...")
+        result = yield incr_max(rc, keys=["counter"], args=[10])
+
+    See also ConnectionHandler.register_script().
+    """
+    def __init__(self, script):
+        if isinstance(script, six.text_type):
+            script = script.encode()
+        self.script = script
+        self.sha = hashlib.sha1(script).hexdigest()
+
+    def __call__(self, conn, keys=[], args=[]):
+        return conn.run_script(self, keys, args)
+
+    def __repr__(self):
+        return "<Redis Script: %s>" % self.sha
+
+
+StopAsyncIteration = getattr(six.moves.builtins, "StopAsyncIteration",
+                             StopIteration)
+
+
+class _PageIterator(object):
+    """
+    Iteration protocols on top of next_page(): an iterator of Deferreds
+    for inlineCallbacks and an async iterator of single items.
+    """
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        return self.next_page()
+
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._items:
+            return defer.succeed(self._items.popleft())
+
+        def page(items):
+            if items is None:
+                raise StopAsyncIteration()
+            self._items.extend(items)
+            return self._items.popleft()
+        return self.next_page().addCallback(page)
+
+
+class ScanIterator(_PageIterator):
+    """
+    Iterates all the pages of a SCAN, SSCAN, HSCAN or ZSCAN, requesting
+    the next page as soon as one arrives so it is on its way while the
+    current one is processed. Items already seen in previous pages are
+    skipped (SCAN may return an element more than once), which keeps
+    every key returned so far in memory until the scan is over: on large
+    keyspaces, pass dedup=False and handle duplicates instead.
+
+    With inlineCallbacks, each item of the iterator is a Deferred which
+    fires with the next non-empty page, or None when the last page
+    turned out to be empty:
+
+        for page in rc.scan_iter(pattern="user:*", count=500):
+            keys = yield page
+
+    It is also an async iterator of single items:
+
+        async for key in rc.scan_iter(pattern="user:*"):
+            ...
+
+    `cursor` is where the iteration resumes after the pages handed out so
+    far (0 once finished), and can be given to scan_iter() to continue
+    from there later.
+    """
+    def __init__(self, scan, pairs=False, dedup=True, prefetch=True,
+                 cursor=0):
+        self._scan = scan
+        self._pairs = pairs
+        self._seen = set() if dedup else None
+        self._prefetch = prefetch
+        self._cursor = self.cursor = int(cursor)
+        self._request = None
+        self._lock = defer.DeferredLock()
+        self._items = collections.deque()
+        self.finished = False
+
+    def _fetch(self):
+        return self._scan(self._cursor).addCallback(self._gotPage)
+
+    def _gotPage(self, reply):
+        cursor, items = reply
+        self._cursor = int(cursor)
+        if self._pairs:
+            items = list(zip(items[::2], items[1::2]))
+        if self._seen is not None:
+            page = []
+            for item in items:
+                key = item[0] if self._pairs else item
+                if key not in self._seen:
+                    self._seen.add(key)
+                    page.append(item)
+            items = page
+        return items
+
+    @defer.inlineCallbacks
+    def _nextPage(self):
+        while not self.finished:
+            d, self._request = self._request or self._fetch(), None
+            try:
+                items = yield d
+            except Exception:
+                self.finished = True
+                raise
+            self.cursor = self._cursor
+            if self._cursor == 0:
+                self.finished = True
+            elif self._prefetch:
+                self._request = self._fetch()
+            if items:
+                return items
+        return None
+
+    def next_page(self):
+        """
+        Returns a Deferred which fires with the next non-empty page, or
+        None when there are no more.
+        """
+        return self._lock.run(self._nextPage)
+
+    def close(self):
+        """
+        Stop iterating, discarding the prefetched page if any.
+        """
+        self.finished = True
+        if self._request is not None:
+            self._request.addErrback(lambda _: None)
+            self._request = None
+
+
+class MergedScanIterator(_PageIterator):
+    """
+    Runs several ScanIterators (one per node, by name) concurrently and
+    merges their pages in arrival order. At most `max_nodes` nodes are
+    scanned at the same time. Every node has at most one SCAN in flight,
+    as each cursor comes from the previous reply, and waits for its page
+    to be taken before going on, with only the next one prefetched.
+
+    checkpoint() returns the cursor of every node after the pages handed
+    out so far, None for the nodes already finished; scanning resumes
+    from it when given to ShardedConnectionHandler.scan_iter(). When a
+    node fails, next_page() fails with its error and the rest of the
+    nodes go on; the checkpoint keeps the failed node where it was.
+    """
+    def __init__(self, iterators, max_nodes=None, finished=()):
+        self._iterators = iterators
+        self._cursors = dict((name, None) for name in finished)
+        for name, it in iterators.items():
+            self._cursors[name] = it.cursor
+        self._semaphore = defer.DeferredSemaphore(
+            max_nodes or max(len(iterators), 1))
+        self._queue = defer.DeferredQueue()
+        self._lock = defer.DeferredLock()
+        self._items = collections.deque()
+        self._running = len(iterators)
+        self._started = False
+        self._closed = False
+        self._taken = {}
+
+    @property
+    def finished(self):
+        return self._started and not self._running
+
+    @defer.inlineCallbacks
+    def _scanNode(self, name, it):
+        try:
+            while not self._closed:
+                items = yield it.next_page()
+                if items is None or self._closed:
+                    break
+                taken = self._taken[name] = defer.Deferred()
+                cursor = None if it.finished else it.cursor
+                self._queue.put((name, items, cursor, taken))
+                yield taken
+                self._taken.pop(name, None)
+        except Exception:
+            self._queue.put((name, Failure(), None, None))
+        else:
+            self._queue.put((name, None, None, None))
+
+    @defer.inlineCallbacks
+    def _nextPage(self):
+        if not self._started:
+            self._started = True
+            for name, it in self._iterators.items():
+                self._semaphore.run(self._scanNode, name, it)
+
+        while self._running:
+            name, items, cursor, taken = yield self._queue.get()
+            if self._closed:
+                break
+            if isinstance(items, Failure):
+                self._running -= 1
+                items.raiseException()
+            self._cursors[name] = cursor
+            if items is None:
+                self._running -= 1
+                continue
+            taken.callback(None)
+            return items
+        return None
+
+    def next_page(self):
+        """
+        Returns a Deferred which fires with the next page from any node,
+        or None when all of them are finished.
+        """
+        return self._lock.run(self._nextPage)
+
+    def checkpoint(self):
+        return dict(self._cursors)
+
+    def close(self):
+        """
+        Stop scanning all the nodes, discarding the pages not handed out.
+        The checkpoint stays after the pages handed out so far.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._started = True
+        self._running = 0
+        for it in self._iterators.values():
+            it.close()
+        taken, self._taken = self._taken, {}
+        for d in taken.values():
+            if not d.called:
+                d.callback(None)
+        if self._queue.waiting:
+            # Wake up next_page()
+            self._queue.put((None, None, None, None))
+
+
+class _ScanIterators(object):
+    """
+    scan_iter() and friends, for protocols and connection handlers.
+    """
+    def scan_iter(self, pattern=None, count=None, keytype=None,
+                  dedup=True, prefetch=True, cursor=0):
+        return ScanIterator(
+            lambda cursor: self.scan(cursor, pattern, count, keytype),
+            dedup=dedup, prefetch=prefetch, cursor=cursor)
+
+    def sscan_iter(self, key, pattern=None, count=None,
+                   dedup=True, prefetch=True, cursor=0):
+        return ScanIterator(
+            lambda cursor: self.sscan(key, cursor, pattern, count),
+            dedup=dedup, prefetch=prefetch, cursor=cursor)
+
+    def hscan_iter(self, key, pattern=None, count=None,
+                   dedup=True, prefetch=True, cursor=0):
+        """
+        Iterates (field, value) pairs
+        """
+        return ScanIterator(
+            lambda cursor: self.hscan(key, cursor, pattern, count),
+            pairs=True, dedup=dedup, prefetch=prefetch, cursor=cursor)
+
+    def zscan_iter(self, key, pattern=None, count=None,
+                   dedup=True, prefetch=True, cursor=0):
+        """
+        Iterates (member, score) pairs
+        """
+        return ScanIterator(
+            lambda cursor: self.zscan(key, cursor, pattern, count),
+            pairs=True, dedup=dedup, prefetch=prefetch, cursor=cursor)
+
+
+def _stream_entries(reply):
+    # [[id, [field, value, ...]], ...] -> [(id, {field: value}), ...]
+    entries = []
+    for entry_id, fields in reply or []:
+        if fields is not None:
+            fields = dict(zip(fields[::2], fields[1::2]))
+        entries.append((entry_id, fields))
+    return entries
+
+
+def _stream_reply(reply):
+    streams = collections.OrderedDict()
+    for stream, entries in reply or []:
+        streams[stream] = _stream_entries(entries)
+    return streams
+
+
 def list_or_args(command, keys, args):
     oldapi = bool(args)
     try:
@@ -112,6 +422,168 @@ def list_or_args(command, keys, args):
 _NUM_FIRST_CHARS = frozenset(string.digits + "+-.")
 
 
+class LatencyHistogram(object):
+    """
+    Log-bucketed (HDR-style) histogram of latencies in seconds, recorded
+    in microseconds: values under 2**precision are counted exactly, and
+    every power of two above is split in 2**precision buckets, so any
+    value is within 1/2**precision of the bucket it is counted in.
+    """
+    def __init__(self, precision=3):
+        self.precision = precision
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def bucket(self, us):
+        sub = 1 << self.precision
+        if us < sub:
+            return us
+        shift = us.bit_length() - self.precision - 1
+        return (shift + 1) * sub + (us >> shift) - sub
+
+    def upper(self, bucket):
+        """
+        Upper bound of a bucket, in seconds
+        """
+        sub = 1 << self.precision
+        if bucket < sub:
+            return (bucket + 1) / 1e6
+        shift = bucket // sub - 1
+        return ((sub + bucket % sub + 1) << shift) / 1e6
+
+    def record(self, seconds):
+        b = self.bucket(int(seconds * 1e6))
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket of the q-th percentile (0 to 100), in
+        seconds
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(self.upper(b), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        """
+        [(bound, count of values up to bound), ...] for bounds in seconds
+        """
+        counts = [0] * len(bounds)
+        for b, count in six.iteritems(self.buckets):
+            upper = self.upper(b)
+            for i, bound in enumerate(bounds):
+                if upper <= bound:
+                    counts[i] += count
+        return list(zip(bounds, counts))
+
+
+class CommandMetrics(object):
+    """
+    Client side metrics of the commands sent by the connections of the
+    factories it is given to (metrics=True, or metrics=CommandMetrics()
+    to share one between connections): a LatencyHistogram per command,
+    from encoding the command to its reply, bytes sent and received, and
+    errors by command and exception type.
+    """
+    # Bounds of the histogram buckets exported to Prometheus, in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, precision=3):
+        self.precision = precision
+        self.histograms = {}
+        self.errors = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def record(self, command, seconds, error=None):
+        histogram = self.histograms.get(command)
+        if histogram is None:
+            histogram = self.histograms[command] = \
+                LatencyHistogram(self.precision)
+        histogram.record(seconds)
+        if error is not None:
+            key = (command, error)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def stats(self):
+        commands = {}
+        for command, histogram in six.iteritems(self.histograms):
+            commands[command] = {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "p50": histogram.percentile(50),
+                "p99": histogram.percentile(99),
+                "p999": histogram.percentile(99.9),
+                "max": histogram.max,
+            }
+        errors = {}
+        for (command, error), count in six.iteritems(self.errors):
+            errors.setdefault(command, {})[error] = count
+        return {"commands": commands, "errors": errors,
+                "bytes_in": self.bytesIn, "bytes_out": self.bytesOut}
+
+    @staticmethod
+    def _labels(labels):
+        return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                                     .replace('"', '\\"')
+                                     .replace("\n", "\\n"))
+                        for name, value in labels)
+
+    def prometheus(self, prefix="redis_client", labels=None):
+        """
+        The metrics in the Prometheus text exposition format. `labels` is
+        a dict of labels added to every sample.
+        """
+        common = sorted((labels or {}).items())
+        lines = []
+
+        name = prefix + "_command_duration_seconds"
+        lines.append("# HELP %s Time from sending a command to its reply." %
+                     name)
+        lines.append("# TYPE %s histogram" % name)
+        for command in sorted(self.histograms):
+            histogram = self.histograms[command]
+            base = common + [("command", command)]
+            for bound, count in histogram.cumulative(self.BUCKETS):
+                lines.append("%s_bucket{%s} %d" % (
+                    name, self._labels(base + [("le", repr(bound))]), count))
+            lines.append("%s_bucket{%s} %d" % (
+                name, self._labels(base + [("le", "+Inf")]), histogram.count))
+            lines.append("%s_sum{%s} %r" % (name, self._labels(base),
+                                            histogram.sum))
+            lines.append("%s_count{%s} %d" % (name, self._labels(base),
+                                              histogram.count))
+
+        name = prefix + "_command_errors_total"
+        lines.append("# HELP %s Commands failed, by exception type." % name)
+        lines.append("# TYPE %s counter" % name)
+        for (command, error), count in sorted(self.errors.items()):
+            lines.append("%s{%s} %d" % (name, self._labels(
+                common + [("command", command), ("error", error)]), count))
+
+        for direction, value in (("received", self.bytesIn),
+                                 ("sent", self.bytesOut)):
+            name = "%s_bytes_%s_total" % (prefix, direction)
+            lines.append("# HELP %s Bytes %s." % (name, direction))
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s%s %d" % (
+                name, "{%s}" % self._labels(common) if common else "", value))
+        return "\n".join(lines) + "\n"
+
+
 class MultiBulkStorage(object):
     def __init__(self, parent=None):
         self.items = None
@@ -228,28 +700,34 @@ class ReplyQueue(defer.DeferredQueue):
         self.waiting[i] = defer.Deferred()
 
 
-def _blocking_command(release_on_callback):
+def _blocking_command(release_on_callback, when=None):
     """
     Decorator used for marking protocol methods as `blocking` (methods that
     block connection from being used for sending another requests)
 
     release_on_callback means whether connection should be automatically
     released when deferred returned by method is fired
+
+    when, if given, is called with the arguments of a call and tells
+    whether that call blocks
     """
     def decorator(method):
-        method._blocking = True
+        method._blocking = when or True
         method._release_on_callback = release_on_callback
         return method
     return decorator
 
 
-class BaseRedisProtocol(LineReceiver):
+class BaseRedisProtocol(LineReceiver, _ScanIterators):
     """
     Redis client protocol.
     """
+    # CommandMetrics recording the commands sent, set by the factory
+    metrics = None
 
     def __init__(self, charset="utf-8", errors="strict", replyTimeout=None,
-                 password=None, dbid=None, convertNumbers=True):
+                 password=None, dbid=None, convertNumbers=True,
+                 maxInFlight=None, clientName=None):
         self.charset = charset
         self.errors = errors
 
@@ -278,10 +756,18 @@ class BaseRedisProtocol(LineReceiver):
         self.password = password
         self.dbid = dbid
         self.convertNumbers = convertNumbers
+        self.maxInFlight = maxInFlight
+        self.clientName = clientName
 
         self._waiting_for_connect = []
         self._waiting_for_disconnect = []
 
+        self.healthy = True
+        self.rtt = None
+        self.lastHealthCheck = None
+        self.healthCheckPending = False
+
+        self.trackingRedirect = None
 
     def whenConnected(self):
         d = defer.Deferred()
@@ -294,40 +780,74 @@ class BaseRedisProtocol(LineReceiver):
         self._waiting_for_disconnect.append(d)
         return d
 
+    def _handshake_commands(self):
+        """
+        Commands that prepare the connection for use, as a list of
+        (command args, error description) pairs.
+        """
+        commands = []
+        if self.password is not None:
+            commands.append((("AUTH", self.password), "could not auth"))
+        if self.clientName is not None:
+            commands.append((("CLIENT", "SETNAME", self.clientName),
+                             "could not set client name"))
+        if self.dbid is not None:
+            commands.append((("SELECT", self.dbid),
+                             "could not set dbid=%s" % self.dbid))
+        if self.trackingRedirect is not None:
+            commands.append((("CLIENT", "TRACKING", "ON", "REDIRECT",
+                              self.trackingRedirect),
+                             "could not enable client tracking"))
+        for script in getattr(self.factory, "scripts", {}).values():
+            commands.append((("SCRIPT", "LOAD", script.script),
+                             "could not load script %s" % script.sha))
+        return commands
+
+    def _handshake_check(self, replies):
+        """
+        Called with the replies to the handshake commands. Returning False
+        means the connection has been dropped and must not be used.
+        """
+        return True
 
     @defer.inlineCallbacks
     def connectionMade(self):
-        if self.password is not None:
+        cache = getattr(self.factory, "clientCache", None)
+        if cache is not None:
+            # Invalidations go to the cache's own connection
+            self.trackingRedirect = yield cache.whenTracking(self.factory)
+
+        # All the handshake commands are written at once, so the
+        # connection is ready after a single round trip.
+        commands = self._handshake_commands()
+        replies = []
+        if commands:
+            self.pipelining = True
             try:
-                response = yield self.auth(self.password)
-                if isinstance(response, ResponseError):
-                    raise response
-            except Exception as e:
-                self.factory.continueTrying = False
-                self.transport.loseConnection()
+                pending = [self.execute_command(*args) for args, _ in commands]
+            finally:
+                self.pipelining = False
+            self.transport.write(six.b("").join(self.pipelined_commands))
+            self.pipelined_commands = []
+            self.pipelined_replies = []
 
-                msg = "Redis error: could not auth: %s" % (str(e))
-                self.factory.connectionError(msg)
-                if self.factory.isLazy:
-                    log.msg(msg)
-                return None
+            results = yield defer.DeferredList(pending, consumeErrors=True)
+            for (success, value), (_, error) in zip(results, commands):
+                if not success:
+                    self.factory.continueTrying = False
+                    self.transport.loseConnection()
 
-        if self.dbid is not None:
-            try:
-                response = yield self.select(self.dbid)
-                if isinstance(response, ResponseError):
-                    raise response
-            except Exception as e:
-                self.factory.continueTrying = False
-                self.transport.loseConnection()
+                    msg = "Redis error: %s: %s" % (error, str(value.value))
+                    self.factory.connectionError(msg)
+                    if self.factory.isLazy:
+                        log.msg(msg)
+                    return None
+                replies.append(value)
 
-                msg = "Redis error: could not set dbid=%s: %s" % \
-                      (self.dbid, str(e))
-                self.factory.connectionError(msg)
-                if self.factory.isLazy:
-                    log.msg(msg)
-                return None
+        if not self._handshake_check(replies):
+            return None
 
+        self.script_hashes.update(getattr(self.factory, "scripts", ()))
         self.connected = 1
         self._waiting_for_connect, dfrs = [], self._waiting_for_connect
         for d in dfrs:
@@ -345,6 +865,12 @@ class BaseRedisProtocol(LineReceiver):
         while self.replyQueue.waiting:
             self.replyReceived(ConnectionError("Lost connection"))
 
+    def dataReceived(self, data, unpause=False):
+        # unpause: data already received, fed again by setLineMode()
+        if self.metrics is not None and not unpause:
+            self.metrics.bytesIn += len(data)
+        return LineReceiver.dataReceived(self, data, unpause)
+
     def lineReceived(self, line):
         """
         Reply types:
@@ -579,6 +1105,9 @@ class BaseRedisProtocol(LineReceiver):
         if self.connected == 0:
             raise ConnectionError("Not connected")
         else:
+            metrics = self.metrics
+            if metrics is not None:
+                started = reactor.seconds()
             command = self._build_command(*args, **kwargs)
             # When pipelining, buffer this command into our list of
             # pipelined commands. Otherwise, write the command immediately.
@@ -600,6 +1129,8 @@ class BaseRedisProtocol(LineReceiver):
 
             response = self.replyQueue.get().addCallback(self.handle_reply)
             response.addBoth(fire_result)
+            if self.maxInFlight:
+                response.addBoth(self._reply_slot_freed)
 
             apply_timeout = kwargs.get('apply_timeout', True)
             if self.replyTimeout and apply_timeout:
@@ -620,6 +1151,10 @@ class BaseRedisProtocol(LineReceiver):
                 delayed_call = self.callLater(self.replyTimeout, fire_timeout)
                 result.addBoth(cancel_timeout)
 
+            if metrics is not None:
+                metrics.bytesOut += len(command)
+                result.addBoth(self._record_metrics, metrics, args[0], started)
+
             # When pipelining, we need to keep track of the deferred replies
             # so that we can wait for them in a DeferredList when
             # execute_pipeline is called.
@@ -635,6 +1170,23 @@ class BaseRedisProtocol(LineReceiver):
                         result.addCallback(f)
             return result
 
+    @staticmethod
+    def _record_metrics(reply, metrics, command, started):
+        if isinstance(command, six.binary_type):
+            command = command.decode("utf-8", "replace")
+        error = None
+        if isinstance(reply, Failure):
+            error = reply.type.__name__
+        metrics.record(command.upper(), reactor.seconds() - started, error)
+        return reply
+
+    def hasFreeSlot(self):
+        return len(self.replyQueue.waiting) < self.maxInFlight
+
+    def _reply_slot_freed(self, value):
+        self.factory.connectionQueue.wakeup(self)
+        return value
+
     ##
     # REDIS COMMANDS
     ##
@@ -659,6 +1211,74 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("PING")
 
+    def client_setname(self, name):
+        """
+        Set the name of the current connection
+        """
+        return self.execute_command("CLIENT", "SETNAME", name)
+
+    def client_getname(self):
+        """
+        Get the name of the current connection
+        """
+        return self.execute_command("CLIENT", "GETNAME")
+
+    def client_id(self):
+        """
+        Get the ID of the current connection
+        """
+        return self.execute_command("CLIENT", "ID")
+
+    def client_unblock(self, client_id, error=False):
+        """
+        Unblock a client blocked by a blocking command, which replies
+        as if it timed out (or fails, with `error`)
+        """
+        if error:
+            return self.execute_command("CLIENT", "UNBLOCK", client_id,
+                                        "ERROR")
+        return self.execute_command("CLIENT", "UNBLOCK", client_id)
+
+    def client_tracking(self, on=True, redirect=None):
+        """
+        Enable or disable server assisted client side caching,
+        optionally sending invalidations to the client `redirect`
+        """
+        args = ["CLIENT", "TRACKING", "ON" if on else "OFF"]
+        if redirect is not None:
+            args.extend(["REDIRECT", redirect])
+        return self.execute_command(*args)
+
+    def checkHealth(self, timeout):
+        """
+        PING the server, recording the round trip time. The returned
+        deferred fails with TimeoutError if no reply arrives in `timeout`
+        seconds.
+        """
+        started = reactor.seconds()
+        self.healthCheckPending = True
+        d = self.execute_command("PING", apply_timeout=False)
+
+        def on_timeout():
+            d.errback(TimeoutError("No PING reply in %s seconds" % timeout))
+
+        timeout_call = self.callLater(timeout, on_timeout)
+
+        def on_reply(reply):
+            if timeout_call.active():
+                timeout_call.cancel()
+            self.healthCheckPending = False
+            now = reactor.seconds()
+            self.lastHealthCheck = now
+            if isinstance(reply, Failure):
+                self.healthy = False
+                return reply
+            self.healthy = True
+            self.rtt = now - started
+            return self.rtt
+
+        return d.addBoth(on_reply)
+
     # Commands operating on all value types
     def exists(self, key):
         """
@@ -673,6 +1293,13 @@ class BaseRedisProtocol(LineReceiver):
         keys = list_or_args("delete", keys, args)
         return self.execute_command("DEL", *keys)
 
+    def unlink(self, keys, *args):
+        """
+        Delete one or more keys, reclaiming their memory in the background
+        """
+        keys = list_or_args("unlink", keys, args)
+        return self.execute_command("UNLINK", *keys)
+
     def type(self, key):
         """
         Return the type of the value stored at key
@@ -686,7 +1313,7 @@ class BaseRedisProtocol(LineReceiver):
         return self.execute_command("KEYS", pattern)
 
     @staticmethod
-    def _build_scan_args(cursor, pattern, count):
+    def _build_scan_args(cursor, pattern, count, keytype=None):
         """
         Construct arguments list for SCAN, SSCAN, HSCAN, ZSCAN commands
         """
@@ -695,14 +1322,17 @@ class BaseRedisProtocol(LineReceiver):
             args.extend(("MATCH", pattern))
         if count is not None:
             args.extend(("COUNT", count))
+        if keytype is not None:
+            args.extend(("TYPE", keytype))
 
         return args
 
-    def scan(self, cursor=0, pattern=None, count=None):
+    def scan(self, cursor=0, pattern=None, count=None, keytype=None):
         """
-        Incrementally iterate the keys in database
+        Incrementally iterate the keys in database, optionally only the
+        ones of type `keytype` (Redis >= 6.0)
         """
-        args = self._build_scan_args(cursor, pattern, count)
+        args = self._build_scan_args(cursor, pattern, count, keytype)
         return self.execute_command("SCAN", *args)
 
     def randomkey(self):
@@ -824,6 +1454,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("GETSET", key, value)
 
+    def getdel(self, key):
+        """
+        Get the value of a key and delete it
+        """
+        return self.execute_command("GETDEL", key)
+
     def mget(self, keys, *args):
         """
         Multi-get, return the strings values of the keys
@@ -851,6 +1487,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("SETEX", key, time, value)
 
+    def psetex(self, key, milliseconds, value):
+        """
+        Set+Expire combo command, expiring in milliseconds
+        """
+        return self.execute_command("PSETEX", key, milliseconds, value)
+
     def mset(self, mapping):
         """
         Set the respective keys to the respective values.
@@ -918,6 +1560,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.incr(key, amount)
 
+    def incrbyfloat(self, key, amount):
+        """
+        Increment the float value of key by amount
+        """
+        return self.execute_command("INCRBYFLOAT", key, amount)
+
     def decr(self, key, amount=1):
         """
         Decrement the integer value of key
@@ -936,6 +1584,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("APPEND", key, value)
 
+    def setrange(self, key, offset, value):
+        """
+        Overwrite part of the string stored at key, starting at offset
+        """
+        return self.execute_command("SETRANGE", key, offset, value)
+
     def substr(self, key, start, end=-1):
         """
         Return a substring of a larger string
@@ -1448,6 +2102,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("HINCRBY", key, field, integer)
 
+    def hincrbyfloat(self, key, field, amount):
+        """
+        Increment the float value of the hash at key on field by amount.
+        """
+        return self.execute_command("HINCRBYFLOAT", key, field, amount)
+
     def hexists(self, key, field):
         """
         Test for existence of a specified field in a hash
@@ -1493,6 +2153,133 @@ class BaseRedisProtocol(LineReceiver):
         args = self._build_scan_args(cursor, pattern, count)
         return self.execute_command("HSCAN", key, *args)
 
+    # Commands operating on streams
+    def xadd(self, key, fields, id="*", maxlen=None, approximate=True):
+        """
+        Append an entry with the given fields (a dict) to a stream,
+        returns its id. With `maxlen` the stream is trimmed to about
+        (or exactly, without `approximate`) that many entries.
+        """
+        args = [key]
+        if maxlen is not None:
+            args.append("MAXLEN")
+            if approximate:
+                args.append("~")
+            args.append(maxlen)
+        args.append(id)
+        for field, value in six.iteritems(fields):
+            args.extend([field, value])
+        return self.execute_command("XADD", *args)
+
+    def xlen(self, key):
+        return self.execute_command("XLEN", key)
+
+    def xdel(self, key, *ids):
+        return self.execute_command("XDEL", key, *ids)
+
+    def xtrim(self, key, maxlen, approximate=True):
+        args = [key, "MAXLEN"]
+        if approximate:
+            args.append("~")
+        args.append(maxlen)
+        return self.execute_command("XTRIM", *args)
+
+    def xrange(self, key, start="-", end="+", count=None):
+        """
+        Returns the entries of a stream between two ids, as a list of
+        (id, fields) pairs
+        """
+        args = [key, start, end]
+        if count is not None:
+            args.extend(["COUNT", count])
+        return self.execute_command("XRANGE", *args,
+                                    post_proc=_stream_entries)
+
+    def xrevrange(self, key, end="+", start="-", count=None):
+        args = [key, end, start]
+        if count is not None:
+            args.extend(["COUNT", count])
+        return self.execute_command("XREVRANGE", *args,
+                                    post_proc=_stream_entries)
+
+    @staticmethod
+    def _build_xread_args(streams, count, block):
+        args = []
+        if count is not None:
+            args.extend(["COUNT", count])
+        if block is not None:
+            args.extend(["BLOCK", block])
+        args.append("STREAMS")
+        args.extend(streams.keys())
+        args.extend(streams.values())
+        return args
+
+    @_blocking_command(release_on_callback=True,
+                       when=lambda streams, count=None, block=None:
+                       block is not None)
+    def xread(self, streams, count=None, block=None):
+        """
+        Read entries after the given ids from one or more streams
+        (a dict of stream -> id), waiting up to `block` milliseconds
+        for them. Returns an OrderedDict of stream -> list of
+        (id, fields) pairs, empty if there are none.
+        """
+        args = self._build_xread_args(streams, count, block)
+        return self.execute_command("XREAD", *args,
+                                    apply_timeout=block is None,
+                                    post_proc=_stream_reply)
+
+    @_blocking_command(release_on_callback=True,
+                       when=lambda group, consumer, streams, count=None,
+                       block=None, noack=False: block is not None)
+    def xreadgroup(self, group, consumer, streams, count=None, block=None,
+                   noack=False):
+        """
+        Like xread, as `consumer` of the consumer `group`. The id ">" reads
+        entries never delivered to the group.
+        """
+        args = ["GROUP", group, consumer]
+        if noack:
+            args.append("NOACK")
+        args.extend(self._build_xread_args(streams, count, block))
+        return self.execute_command("XREADGROUP", *args,
+                                    apply_timeout=block is None,
+                                    post_proc=_stream_reply)
+
+    def xack(self, key, group, *ids):
+        return self.execute_command("XACK", key, group, *ids)
+
+    def xgroup_create(self, key, group, id="$", mkstream=False):
+        args = ["CREATE", key, group, id]
+        if mkstream:
+            args.append("MKSTREAM")
+        return self.execute_command("XGROUP", *args)
+
+    def xgroup_destroy(self, key, group):
+        return self.execute_command("XGROUP", "DESTROY", key, group)
+
+    def xpending(self, key, group):
+        """
+        Summary of the entries delivered to the group and not acknowledged
+        """
+        return self.execute_command("XPENDING", key, group)
+
+    def xautoclaim(self, key, group, consumer, min_idle_time, start="0-0",
+                   count=None):
+        """
+        Transfer to `consumer` the pending entries of the group idle for
+        at least `min_idle_time` milliseconds (Redis >= 6.2). Returns the
+        id to continue from ("0-0" when done) and a list of (id, fields)
+        pairs.
+        """
+        args = [key, group, consumer, min_idle_time, start]
+        if count is not None:
+            args.extend(["COUNT", count])
+
+        def post_proc(reply):
+            return reply[0], _stream_entries(reply[1])
+        return self.execute_command("XAUTOCLAIM", *args, post_proc=post_proc)
+
     # Sorting
     def sort(self, key, start=None, end=None, by=None, get=None,
              desc=None, alpha=False, store=None):
@@ -1645,6 +2432,12 @@ class BaseRedisProtocol(LineReceiver):
         """
         return self.execute_command("PUBLISH", channel, message)
 
+    def spublish(self, channel, message):
+        """
+        Publish message to a shard channel (Redis >= 7.0)
+        """
+        return self.execute_command("SPUBLISH", channel, message)
+
     # Persistence control commands
     def save(self):
         """
@@ -1724,10 +2517,23 @@ class BaseRedisProtocol(LineReceiver):
         if isinstance(script, six.text_type):
             script = script.encode()
         h = hashlib.sha1(script).hexdigest()
-        if h in self.script_hashes:
-            return self.evalsha(h, keys, args).addErrback(
-                self._evalsha_failed, script, h, keys, args)
-        return self._eval(script, h, keys, args)
+        return self._run_script(script, h, keys, args)
+
+    def run_script(self, script, keys=[], args=[]):
+        """
+        Run a Script, using EVALSHA if it is known to be loaded
+        """
+        return self._run_script(script.script, script.sha, keys, args)
+
+    def _run_script(self, script, script_hash, keys, args):
+        if script_hash not in self.script_hashes:
+            return self._eval(script, script_hash, keys, args)
+        if self.pipelining or self.inTransaction:
+            # Falling back to EVAL after a NOSCRIPT error would run the
+            # script out of the pipeline or transaction
+            return self.evalsha(script_hash, keys, args)
+        return self.evalsha(script_hash, keys, args).addErrback(
+            self._evalsha_failed, script, script_hash, keys, args)
 
     def _evalsha_errback(self, err, script_hash):
         if err.check(ResponseError):
@@ -1762,6 +2568,9 @@ class BaseRedisProtocol(LineReceiver):
                                     *hashes)
 
     def _script_flush_success(self, r):
+        # Scripts are flushed for every connection to the server
+        for conn in getattr(self.factory, "pool", [self]):
+            conn.script_hashes.clear()
         self.script_hashes.clear()
         return r
 
@@ -1783,6 +2592,58 @@ class BaseRedisProtocol(LineReceiver):
     def script_load(self, script):
         return self.execute_command("SCRIPT",  "LOAD", script)
 
+    # Redis 7.0 functions
+    def function_load(self, code, replace=False):
+        """
+        Load a library of functions, returns the name of the library
+        """
+        if replace:
+            return self.execute_command("FUNCTION", "LOAD", "REPLACE", code)
+        return self.execute_command("FUNCTION", "LOAD", code)
+
+    def function_delete(self, library):
+        return self.execute_command("FUNCTION", "DELETE", library)
+
+    def function_flush(self):
+        return self.execute_command("FUNCTION", "FLUSH")
+
+    def function_list(self, library=None, withcode=False):
+        args = ["FUNCTION", "LIST"]
+        if library is not None:
+            args.extend(["LIBRARYNAME", library])
+        if withcode:
+            args.append("WITHCODE")
+        return self.execute_command(*args)
+
+    def _fcall(self, command, function, keys, args):
+        keys_and_args = tuple(keys) + tuple(args)
+        r = self.execute_command(command, function, len(keys), *keys_and_args)
+        libraries = getattr(self.factory, "libraries", None)
+        if libraries and not (self.pipelining or self.inTransaction):
+            r.addErrback(self._fcall_failed, command, function, keys, args)
+        return r
+
+    def _fcall_failed(self, err, command, function, keys, args):
+        # The server lost the registered libraries (restarted, flushed...)
+        if err.check(ResponseError) and \
+                "Function not found" in str(err.value):
+            d = self.factory.loadLibraries(self)
+            return d.addCallback(lambda _: self.execute_command(
+                command, function, len(keys), *(tuple(keys) + tuple(args))))
+        return err
+
+    def fcall(self, function, keys=[], args=[]):
+        """
+        Invoke a function
+        """
+        return self._fcall("FCALL", function, keys, args)
+
+    def fcall_ro(self, function, keys=[], args=[]):
+        """
+        Invoke a read-only function, which can run on replicas
+        """
+        return self._fcall("FCALL_RO", function, keys, args)
+
     # Redis 2.8.9 HyperLogLog commands
     def pfadd(self, key, elements, *args):
         elements = list_or_args("pfadd", elements, args)
@@ -1845,6 +2706,8 @@ class HiredisProtocol(BaseRedisProtocol):
 
     def dataReceived(self, data, unpause=False):
         if data:
+            if self.metrics is not None:
+                self.metrics.bytesIn += len(data)
             self._reader.feed(data)
         res = self._reader.gets()
         while res is not False:
@@ -1872,8 +2735,8 @@ class HiredisProtocol(BaseRedisProtocol):
         r = BaseRedisProtocol.commit(self)
         return r.addCallback(self._convert_bin_values)
 
-    def scan(self, cursor=0, pattern=None, count=None):
-        r = BaseRedisProtocol.scan(self, cursor, pattern, count)
+    def scan(self, cursor=0, pattern=None, count=None, keytype=None):
+        r = BaseRedisProtocol.scan(self, cursor, pattern, count, keytype)
         return r.addCallback(self._convert_bin_values)
 
     def sscan(self, key, cursor=0, pattern=None, count=None):
@@ -1886,19 +2749,109 @@ else:
     RedisProtocol = BaseRedisProtocol
 
 
+class MonitorEvent(object):
+    """
+    A command seen by MONITOR, parsed from a line like:
+
+        1339518083.107412 [0 127.0.0.1:60866] "set" "key" "value"
+
+    `command` is upper case, `client` is "ip:port", "unix:path" or "lua",
+    and `args` are the arguments as text.
+    """
+    _line = re.compile(r'^(\d+(?:\.\d+)?) \[(\d+) ([^\]]*)\] ?(.*)$', re.S)
+    _arg = re.compile(r'"((?:[^"\\]|\\.)*)"', re.S)
+    _escapes = {"n": "\n", "r": "\r", "t": "\t", "a": "\a", "b": "\b"}
+
+    def __init__(self, timestamp, db, client, command, args):
+        self.timestamp = timestamp
+        self.db = db
+        self.client = client
+        self.command = command
+        self.args = args
+
+    @classmethod
+    def parse(cls, line):
+        """
+        Returns a MonitorEvent, or None if line is not a MONITOR line
+        """
+        if isinstance(line, six.binary_type):
+            line = line.decode("utf-8", "replace")
+        elif not isinstance(line, six.string_types):
+            return None
+        m = cls._line.match(line)
+        if m is None:
+            return None
+        timestamp, db, client, rest = m.groups()
+        args = [cls._unescape(arg) for arg in cls._arg.findall(rest)]
+        if not args:
+            return None
+        return cls(float(timestamp), int(db), client, args[0].upper(),
+                   args[1:])
+
+    @classmethod
+    def _unescape(cls, arg):
+        if "\\" not in arg:
+            return arg
+        # \xHH escapes are bytes of non printable (or UTF-8) characters
+        res = bytearray()
+        i = 0
+        while i < len(arg):
+            c = arg[i]
+            if c == "\\" and i + 1 < len(arg):
+                n = arg[i + 1]
+                if n == "x" and i + 3 < len(arg):
+                    res.append(int(arg[i + 2:i + 4], 16))
+                    i += 4
+                    continue
+                res.extend(cls._escapes.get(n, n).encode("utf-8"))
+                i += 2
+            else:
+                res.extend(c.encode("utf-8"))
+                i += 1
+        return res.decode("utf-8", "replace")
+
+    def __eq__(self, other):
+        return isinstance(other, MonitorEvent) and \
+            self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "<MonitorEvent %.6f [%d %s] %s %r>" % (
+            self.timestamp, self.db, self.client, self.command, self.args)
+
+
 class MonitorProtocol(RedisProtocol):
     """
     monitor has the same behavior as subscribe: hold the connection until
     something happens.
 
     take care with the performance impact: http://redis.io/commands/monitor
+
+    Lines go to messageReceived(), which parses them and passes a
+    MonitorEvent to eventReceived(), and to the `aggregator` of the
+    factory if any. With a `sampleRate` (0 to 1), only that fraction of
+    the lines, chosen at random, is passed on.
     """
+    sampleRate = None
+    aggregator = None
 
     def messageReceived(self, message):
-        pass
+        event = MonitorEvent.parse(message)
+        if event is not None:
+            self.eventReceived(event)
+
+    def eventReceived(self, event):
+        if self.aggregator is not None:
+            self.aggregator.add(event)
 
     def replyReceived(self, reply):
-        self.messageReceived(reply)
+        if self.replyQueue.waiting:
+            # Replies of the handshake and of MONITOR itself
+            self.replyQueue.put(reply)
+        elif self.sampleRate is None or random.random() < self.sampleRate:
+            self.messageReceived(reply)
 
     def monitor(self):
         return self.execute_command("MONITOR", apply_timeout=False)
@@ -1908,26 +2861,90 @@ class MonitorProtocol(RedisProtocol):
 
 
 class SubscriberProtocol(RedisProtocol):
-    _sub_unsub_reponses = set([u"subscribe", u"unsubscribe", u"psubscribe", u"punsubscribe",
-                               b"subscribe", b"unsubscribe", b"psubscribe", b"punsubscribe"])
+    _sub_unsub_reponses = set([u"subscribe", u"unsubscribe",
+                               u"psubscribe", u"punsubscribe",
+                               u"ssubscribe", u"sunsubscribe",
+                               b"subscribe", b"unsubscribe",
+                               b"psubscribe", b"punsubscribe",
+                               b"ssubscribe", b"sunsubscribe"])
+
+    # With a ChannelDispatcher, the messages of every chunk of data
+    # received are passed to it at once, and messageReceived only gets
+    # the ones it has no callbacks for. Messages received before the
+    # reply of a command are dispatched before its Deferred fires.
+    dispatcher = None
+
+    def __init__(self, *args, **kwargs):
+        RedisProtocol.__init__(self, *args, **kwargs)
+        self._messages = []
+        self._readingPausedBy = set()
+        self._pausedBefore = False
 
     def messageReceived(self, pattern, channel, message):
         pass
 
+    def pauseReading(self, owner):
+        """
+        Stop reading the socket until every owner that paused it has
+        called resumeReading()
+        """
+        if not self._readingPausedBy:
+            # Paused by setLineMode(), which will resume by itself
+            self._pausedBefore = self.paused
+            if not self.paused:
+                self.pauseProducing()
+        self._readingPausedBy.add(owner)
+
+    def resumeReading(self, owner):
+        if owner not in self._readingPausedBy:
+            return
+        self._readingPausedBy.discard(owner)
+        if not self._readingPausedBy and not self._pausedBefore:
+            RedisProtocol.resumeProducing(self)
+
+    def resumeProducing(self):
+        if self._readingPausedBy:
+            self._pausedBefore = False
+        else:
+            RedisProtocol.resumeProducing(self)
+
     def replyReceived(self, reply):
-        if isinstance(reply, list):
-            reply_len = len(reply)
-            if reply_len >= 3 and reply[-3] in (u"message", b"message"):
-                self.messageReceived(None, *reply[-2:])
-            elif reply_len >= 4 and reply[-4] in (u"pmessage", b"pmessage"):
-                self.messageReceived(*reply[-3:])
-            elif reply_len >= 3 and reply[-3] in self._sub_unsub_reponses and len(self.replyQueue.waiting) == 0:
+        if isinstance(reply, list) and reply:
+            kind = reply[0]
+            if len(reply) == 3 and kind in (u"message", b"message",
+                                            u"smessage", b"smessage"):
+                self._messageReceived(None, reply[1], reply[2])
+            elif len(reply) == 4 and kind in (u"pmessage", b"pmessage"):
+                self._messageReceived(reply[1], reply[2], reply[3])
+            elif kind in self._sub_unsub_reponses and \
+                    not self.replyQueue.waiting:
                 pass
             else:
-                self.replyQueue.put(reply[-3:])
+                self._dispatchMessages()
+                self.replyQueue.put(reply)
         else:
+            self._dispatchMessages()
             self.replyQueue.put(reply)
 
+    def _messageReceived(self, pattern, channel, message):
+        if self.dispatcher is None:
+            self.messageReceived(pattern, channel, message)
+        else:
+            self._messages.append((pattern, channel, message))
+
+    def dataReceived(self, data, unpause=False):
+        RedisProtocol.dataReceived(self, data, unpause)
+        # After a bulk reply, setLineMode() pauses and feeds the rest of
+        # the chunk back on the next reactor iteration: wait for it
+        if not self.paused:
+            self._dispatchMessages()
+
+    def _dispatchMessages(self):
+        if self._messages:
+            messages, self._messages = self._messages, []
+            for message in self.dispatcher.dispatch(messages):
+                self.messageReceived(*message)
+
     def subscribe(self, channels):
         if isinstance(channels, six.string_types):
             channels = [channels]
@@ -1948,8 +2965,22 @@ class SubscriberProtocol(RedisProtocol):
             patterns = [patterns]
         return self.execute_command("PUNSUBSCRIBE", *patterns)
 
+    def ssubscribe(self, channels):
+        """
+        Subscribe to shard channels (Redis >= 7.0)
+        """
+        if isinstance(channels, six.string_types):
+            channels = [channels]
+        return self.execute_command("SSUBSCRIBE", *channels,
+                                    apply_timeout=False)
+
+    def sunsubscribe(self, channels):
+        if isinstance(channels, six.string_types):
+            channels = [channels]
+        return self.execute_command("SUNSUBSCRIBE", *channels)
 
-class ConnectionHandler(object):
+
+class ConnectionHandler(_ScanIterators):
     def __init__(self, factory):
         self._factory = factory
         self._connected = factory.deferred
@@ -1957,32 +2988,62 @@ class ConnectionHandler(object):
     def disconnect(self):
         self._factory.continueTrying = 0
         self._factory.disconnectCalled = True
+        self._factory.stopHealthChecks()
         for conn in self._factory.pool:
             try:
                 conn.transport.loseConnection()
             except:
                 pass
 
-        return self._factory.waitForEmptyPool()
+        d = self._factory.waitForEmptyPool()
+        if self._factory.blockingFactory is not None:
+            blocking = self._factory.blockingFactory.disconnect()
+            d = defer.gatherResults([d, blocking], consumeErrors=True)
+            d.addCallback(lambda _: None)
+        if self._factory.clientCache is not None:
+            tracking = self._factory.clientCache.detach(self._factory)
+            d = defer.gatherResults([d, tracking], consumeErrors=True)
+            d.addCallback(lambda _: None)
+        return d
 
-    def __getattr__(self, method):
-        def wrapper(*args, **kwargs):
-            protocol_method = getattr(self._factory.protocol, method)
-            blocking = getattr(protocol_method, '_blocking', False)
+    def healthState(self):
+        return self._factory.healthState()
+
+    def metrics(self):
+        """
+        The CommandMetrics of the connections, None without metrics=True
+        """
+        return self._factory.metrics
+
+    def register_script(self, script):
+        return self._factory.registerScript(script)
+
+    def register_library(self, code):
+        return self._factory.registerLibrary(code)
+
+    def __getattr__(self, method):
+        def wrapper(*args, **kwargs):
+            protocol_method = getattr(self._factory.protocol, method)
+            blocking = getattr(protocol_method, '_blocking', False)
+            if callable(blocking):
+                blocking = blocking(*args, **kwargs)
             release_on_callback = getattr(protocol_method, '_release_on_callback', True)
 
-            d = self._factory.getConnection(peek=not blocking)
+            factory = self._factory
+            if blocking and release_on_callback:
+                factory = factory.getBlockingFactory()
+            d = factory.getConnection(peek=not blocking)
 
             def callback(connection):
                 try:
                     d = protocol_method(connection, *args, **kwargs)
                 except:
                     if blocking:
-                        self._factory.connectionQueue.put(connection)
+                        factory.connectionQueue.put(connection)
                     raise
 
                 def put_back(reply):
-                    self._factory.connectionQueue.put(connection)
+                    factory.connectionQueue.put(connection)
                     return reply
 
                 if blocking and release_on_callback:
@@ -1991,6 +3052,10 @@ class ConnectionHandler(object):
                 return d
             d.addCallback(callback)
             return d
+
+        cache = self._factory.clientCache
+        if cache is not None:
+            return cache.wrap(self._factory, method, wrapper)
         return wrapper
 
     def __repr__(self):
@@ -2113,6 +3178,8 @@ class HashRing(object):
     def get_node_pos(self, key):
         if len(self.ring) == 0:
             return [None, None]
+        if isinstance(key, six.text_type):
+            key = key.encode("utf-8")
         crc = zlib.crc32(key)
         idx = bisect.bisect(self.sorted_keys, crc)
         # prevents out of range index
@@ -2152,6 +3219,12 @@ class ShardedConnectionHandler(object):
             yield conn.disconnect()
         return True
 
+    def _node(self, key):
+        m = _findhash.match(key)
+        if m is not None and len(m.groups()) >= 1:
+            return self._ring(m.groups()[0])
+        return self._ring(key)
+
     def _wrap(self, method, *args, **kwargs):
         try:
             key = args[0]
@@ -2160,17 +3233,56 @@ class ShardedConnectionHandler(object):
             raise ValueError(
                 "Method '%s' requires a key as the first argument" % method)
 
-        m = _findhash.match(key)
-        if m is not None and len(m.groups()) >= 1:
-            node = self._ring(m.groups()[0])
-        else:
-            node = self._ring(key)
-
-        return getattr(node, method)(*args, **kwargs)
+        return getattr(self._node(key), method)(*args, **kwargs)
 
     def pipeline(self):
         raise NotImplementedError("Pipelining is not supported across shards")
 
+    def register_library(self, code):
+        """
+        Register a library of functions in every shard
+        """
+        d = defer.gatherResults([node.register_library(code)
+                                 for node in self._ring.nodes],
+                                consumeErrors=True)
+        return d.addCallback(lambda names: names[0])
+
+    def _fcall(self, method, function, keys, args):
+        if not keys:
+            raise ValueError(
+                "Method '%s' requires at least one key to be sharded" % method)
+        return getattr(self._node(keys[0]), method)(function, keys, args)
+
+    def fcall(self, function, keys=[], args=[]):
+        return self._fcall("fcall", function, keys, args)
+
+    def fcall_ro(self, function, keys=[], args=[]):
+        return self._fcall("fcall_ro", function, keys, args)
+
+    def scan_iter(self, pattern=None, count=None, keytype=None,
+                  dedup=True, prefetch=True, max_nodes=None,
+                  checkpoint=None):
+        """
+        Scan the keyspace of every shard concurrently, at most
+        `max_nodes` of them at a time and with one SCAN in flight per
+        shard. Returns a MergedScanIterator; pass its checkpoint() as
+        `checkpoint` to resume a scan.
+        """
+        if not self._ring:
+            raise ConnectionError("Not connected")
+
+        iterators = collections.OrderedDict()
+        finished = []
+        for node in self._ring.nodes:
+            name = node._factory.uuid
+            cursor = (checkpoint or {}).get(name, 0)
+            if cursor is None:
+                finished.append(name)
+            else:
+                iterators[name] = node.scan_iter(pattern, count, keytype,
+                                                 dedup, prefetch, cursor)
+        return MergedScanIterator(iterators, max_nodes, finished)
+
     def __getattr__(self, method):
         if method in ShardedMethods:
             return functools.partial(self._wrap, method)
@@ -2184,23 +3296,22 @@ class ShardedConnectionHandler(object):
         """
 
         keys = list_or_args("mget", keys, args)
-        group = collections.defaultdict(lambda: [])
+        group = collections.OrderedDict()
         for k in keys:
-            node = self._ring(k)
-            group[node].append(k)
+            group.setdefault(self._node(k), []).append(k)
 
-        deferreds = []
-        for node, keys in six.iteritems(group.items):
-            nd = node.mget(keys)
-            deferreds.append(nd)
-
-        result = []
-        response = yield defer.DeferredList(deferreds)
-        for (success, values) in response:
-            if success:
-                result += values
+        deferreds = [node.mget(node_keys)
+                     for node, node_keys in six.iteritems(group)]
+        try:
+            response = yield defer.gatherResults(deferreds, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
 
-        return result
+        # values in the order of the keys asked for
+        values = {}
+        for node_keys, node_values in zip(group.values(), response):
+            values.update(zip(node_keys, node_values))
+        return [values[k] for k in keys]
 
     def __repr__(self):
         nodes = []
@@ -2239,24 +3350,52 @@ class PeekableQueue(defer.DeferredQueue):
 
         self.peekers = []
 
-    def peek(self):
-        if self.pending:
-            return defer.succeed(random.choice(self.pending))
+    def peek(self, available=None):
+        """
+        Returns a random item without removing it from the queue. If
+        `available` is given, only items for which it returns True are
+        considered.
+        """
+        if available is None:
+            candidates = self.pending
         else:
+            candidates = [x for x in self.pending if available(x)]
+        if candidates:
+            return defer.succeed(random.choice(candidates))
+        else:
+            self._checkBacklog()
             d = defer.Deferred()
             self.peekers.append(d)
             return d
 
+    def get(self):
+        if not self.pending:
+            self._checkBacklog()
+        return defer.DeferredQueue.get(self)
+
+    def _checkBacklog(self):
+        if self.backlog is not None and \
+                len(self.waiting) + len(self.peekers) >= self.backlog:
+            raise defer.QueueUnderflow()
+
     def remove(self, item):
         self.pending.remove(item)
 
     def put(self, obj):
-        for d in self.peekers:
+        peekers, self.peekers = self.peekers, []
+        for d in peekers:
             d.callback(obj)
-        self.peekers = []
 
         defer.DeferredQueue.put(self, obj)
 
+    def wakeup(self, obj):
+        """
+        Hand a queued item to the oldest peeker, if any, e.g. when the
+        item has become available again.
+        """
+        if self.peekers and obj in self.pending:
+            self.peekers.pop(0).callback(obj)
+
 
 class RedisFactory(protocol.ReconnectingClientFactory):
     maxDelay = 10
@@ -2266,7 +3405,10 @@ class RedisFactory(protocol.ReconnectingClientFactory):
 
     def __init__(self, uuid, dbid, poolsize, isLazy=False,
                  handler=ConnectionHandler, charset="utf-8", password=None,
-                 replyTimeout=None, convertNumbers=True):
+                 replyTimeout=None, convertNumbers=True,
+                 healthCheckInterval=None, maxInFlight=None, maxWaiters=None,
+                 clientName=None, clientCache=None, blockingPoolsize=None,
+                 metrics=None, healthCheckTimeout=None):
         if not isinstance(poolsize, int):
             raise ValueError("Redis poolsize must be an integer, not %s" %
                              repr(poolsize))
@@ -2283,21 +3425,64 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         self.password = password
         self.replyTimeout = replyTimeout
         self.convertNumbers = convertNumbers
+        self.healthCheckInterval = healthCheckInterval
+        # A PING may wait behind a slow command of another caller (with
+        # maxInFlight), so give it longer than the interval by default
+        if healthCheckTimeout is None and healthCheckInterval:
+            healthCheckTimeout = healthCheckInterval * 3
+        self.healthCheckTimeout = healthCheckTimeout
+        self.maxInFlight = maxInFlight
+        self.maxWaiters = maxWaiters
+        self.clientName = clientName
+        self.clientCache = clientCache
+        # Scripts loaded on every connection, by SHA1
+        self.scripts = collections.OrderedDict()
+        # Function libraries loaded on the server, by name
+        self.libraries = collections.OrderedDict()
+        self._librariesLoading = None
+        # Elastic pool for blocking commands, see getBlockingFactory()
+        self.blockingPoolsize = blockingPoolsize
+        self.blockingFactory = None
+        # Callable that opens one more connection of a given factory to
+        # the same server, set by makeConnection()
+        self.openConnection = None
+        if metrics is True:
+            metrics = CommandMetrics()
+        self.metrics = metrics
 
         self.idx = 0
         self.size = 0
         self.pool = []
         self.deferred = defer.Deferred()
         self.handler = handler(self)
-        self.connectionQueue = PeekableQueue()
+        self.connectionQueue = PeekableQueue(backlog=maxWaiters)
         self._waitingForEmptyPool = set()
         self.disconnectCalled = False
+        self._healthCheckCall = None
+
+    def getBlockingFactory(self):
+        """
+        Returns the factory whose connections run blocking commands (BLPOP,
+        BRPOP and BRPOPLPUSH): with `blockingPoolsize`, a separate pool
+        created on first use, so that the connections of this one are
+        never held by them. Otherwise this factory.
+        """
+        if not self.blockingPoolsize or self.openConnection is None:
+            return self
+        if self.blockingFactory is None:
+            self.blockingFactory = BlockingConnectionFactory(
+                self, self.blockingPoolsize)
+        return self.blockingFactory
 
     def buildProtocol(self, addr):
         p = self.protocol(self.charset, replyTimeout=self.replyTimeout,
                           password=self.password, dbid=self.dbid,
-                          convertNumbers=self.convertNumbers)
+                          convertNumbers=self.convertNumbers,
+                          maxInFlight=self.maxInFlight,
+                          clientName=self.clientName)
         p.factory = self
+        if self.metrics is not None:
+            p.metrics = self.metrics
         p.whenConnected().addCallback(self.addConnection)
         return p
 
@@ -2310,6 +3495,9 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         self.connectionQueue.put(conn)
         self.pool.append(conn)
         self.size = len(self.pool)
+        if self.healthCheckInterval and self._healthCheckCall is None:
+            self._healthCheckCall = task.LoopingCall(self.checkHealth)
+            self._healthCheckCall.start(self.healthCheckInterval, now=False)
         if self.deferred:
             if self.size == self.poolsize:
                 self.deferred.callback(self.handler)
@@ -2342,6 +3530,125 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         self._waitingForEmptyPool.add(d)
         return d
 
+    def checkHealth(self):
+        """
+        PING every idle connection of the pool and evict the ones that
+        do not answer within healthCheckTimeout seconds.
+
+        Connections taken out of the pool by blocking commands,
+        transactions or pipelines are skipped, and so are the ones still
+        waiting for replies to other commands, which may be slow.
+        """
+        for conn in list(self.connectionQueue.pending):
+            if conn.connected and not conn.healthCheckPending and \
+                    not conn.replyQueue.waiting:
+                conn.checkHealth(self.healthCheckTimeout).addErrback(
+                    self._healthCheckFailed, conn)
+
+    def _healthCheckFailed(self, failure, conn):
+        if conn.connected:
+            log.msg("txredisapi: Evicting unhealthy connection: %s" %
+                    failure.getErrorMessage())
+            self.evictConnection(conn)
+
+    def evictConnection(self, conn):
+        """
+        Take the connection out of the pool right away and drop it.
+        It will be replaced by a fresh one if reconnecting is enabled.
+        """
+        conn.connected = 0
+        if conn in self.connectionQueue.pending:
+            self.connectionQueue.remove(conn)
+        conn.transport.abortConnection()
+
+    def stopHealthChecks(self):
+        if self._healthCheckCall is not None:
+            if self._healthCheckCall.running:
+                self._healthCheckCall.stop()
+            self._healthCheckCall = None
+
+    def healthState(self):
+        """
+        Returns a list with health information of every pooled connection.
+        """
+        state = []
+        for conn in self.pool:
+            try:
+                peer = conn.transport.getPeer()
+            except Exception:
+                peer = None
+            state.append({
+                "peer": peer,
+                "connected": bool(conn.connected),
+                "healthy": conn.healthy,
+                "rtt": conn.rtt,
+                "last_check": conn.lastHealthCheck,
+            })
+        return state
+
+    def registerScript(self, script):
+        """
+        Load `script` (a Script or its source) on every connection, now and
+        as part of the handshake of the ones made later. Returns a Deferred
+        which fires with the Script once it is loaded, or fails without
+        registering it if the server rejects it.
+        """
+        if not isinstance(script, Script):
+            script = Script(script)
+
+        # Connections in use by transactions or blocking commands will
+        # just run it with EVAL the first time
+        conns = [conn for conn in self.connectionQueue.pending
+                 if conn.connected]
+
+        def loaded(_):
+            self.scripts[script.sha] = script
+            for conn in conns:
+                conn.script_hashes.add(script.sha)
+            return script
+
+        d = defer.gatherResults([conn.script_load(script.script)
+                                 for conn in conns], consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d.addCallback(loaded)
+
+    @defer.inlineCallbacks
+    def registerLibrary(self, code):
+        """
+        Load a library of functions in the server (Redis >= 7), replacing
+        any previous version, and load it again whenever a function call
+        fails because the server doesn't know the function anymore.
+        Returns a Deferred which fires with the name of the library.
+        """
+        conn = yield self.getConnection(peek=True)
+        name = yield conn.function_load(code, replace=True)
+        self.libraries[name] = code
+        return name
+
+    def loadLibraries(self, conn):
+        """
+        Load the registered libraries using `conn`. Concurrent calls share
+        the same load.
+        """
+        d = defer.Deferred()
+        if self._librariesLoading is not None:
+            self._librariesLoading.append(d)
+            return d
+        self._librariesLoading = [d]
+
+        def done(result):
+            waiters, self._librariesLoading = self._librariesLoading, None
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+
+        loads = [conn.function_load(code, replace=True)
+                 for code in self.libraries.values()]
+        defer.gatherResults(loads, consumeErrors=True).addBoth(done)
+        return d
+
     def connectionError(self, why):
         if self.deferred:
             self.deferred.errback(ValueError(why))
@@ -2352,258 +3659,2879 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         if not self.continueTrying and not self.size:
             raise ConnectionError("Not connected")
 
+        # With maxInFlight only connections with free reply slots are
+        # handed out, the rest of callers wait in the queue (at most
+        # maxWaiters of them).
+        available = None
+        if peek and self.maxInFlight:
+            available = operator.methodcaller("hasFreeSlot")
         while True:
-            if peek:
-                conn = yield self.connectionQueue.peek()
-            else:
-                conn = yield self.connectionQueue.get()
+            try:
+                if peek:
+                    conn = yield self.connectionQueue.peek(available)
+                else:
+                    conn = yield self.connectionQueue.get()
+            except defer.QueueUnderflow:
+                raise PoolExhausted("Too many callers waiting for "
+                                    "a Redis connection")
             if conn.connected == 0:
                 log.msg('Discarding dead connection.')
                 if peek:
                     self.connectionQueue.remove(conn)
-            else:
+            elif available is None or available(conn):
                 return conn
 
 
+class _IdleQueue(PeekableQueue):
+    """
+    A connection queue that closes the connections left in it for more
+    than `idleTimeout` seconds.
+    """
+    def __init__(self, idleTimeout, backlog=None):
+        PeekableQueue.__init__(self, backlog=backlog)
+        self.idleTimeout = idleTimeout
+        self._idleCalls = {}
+
+    def put(self, conn):
+        if not conn.connected:
+            # Lost while in use: its factory has dropped it already
+            return
+        PeekableQueue.put(self, conn)
+        if conn in self.pending and conn not in self._idleCalls:
+            self._idleCalls[conn] = reactor.callLater(
+                self.idleTimeout, self._expire, conn)
+
+    def get(self):
+        return PeekableQueue.get(self).addCallback(self.busy)
+
+    def remove(self, conn):
+        PeekableQueue.remove(self, conn)
+        self.busy(conn)
+
+    def busy(self, conn):
+        call = self._idleCalls.pop(conn, None)
+        if call is not None and call.active():
+            call.cancel()
+        return conn
+
+    def _expire(self, conn):
+        del self._idleCalls[conn]
+        self.pending.remove(conn)
+        conn.transport.loseConnection()
+
+
+class BlockingConnectionFactory(RedisFactory):
+    """
+    Elastic pool for the blocking commands of `parent`: connections to
+    the same server are opened when needed, up to `maxsize` at a time,
+    and closed after `idleTimeout` seconds unused. They are not
+    reconnected when lost.
+    """
+    idleTimeout = 60
+
+    def __init__(self, parent, maxsize):
+        RedisFactory.__init__(self, parent.uuid, parent.dbid, 0, True,
+                              ConnectionHandler, parent.charset,
+                              parent.password, parent.replyTimeout,
+                              parent.convertNumbers,
+                              clientName=parent.clientName)
+        self.protocol = parent.protocol
+        self.parent = parent
+        self.metrics = parent.metrics
+        self.maxsize = maxsize
+        self.connecting = 0
+        self.deferred = None
+        self.connectionQueue = _IdleQueue(self.idleTimeout,
+                                          backlog=parent.maxWaiters)
+
+    def getConnection(self, peek=False):
+        if self.disconnectCalled:
+            return defer.fail(ConnectionError("Not connected"))
+        if not any(conn.connected for conn in self.connectionQueue.pending):
+            self._open()
+        return RedisFactory.getConnection(self, peek)
+
+    def _open(self):
+        if self.size + self.connecting < self.maxsize:
+            self.connecting += 1
+            self.parent.openConnection(self)
+
+    def addConnection(self, conn):
+        self.connecting -= 1
+        RedisFactory.addConnection(self, conn)
+
+    def delConnection(self, conn):
+        if conn in self.connectionQueue.pending:
+            self.connectionQueue.remove(conn)
+        else:
+            self.connectionQueue.busy(conn)
+        RedisFactory.delConnection(self, conn)
+        # Replace it for the callers waiting
+        if self.connectionQueue.waiting and not self.disconnectCalled:
+            self._open()
+
+    def clientConnectionLost(self, connector, reason):
+        pass
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connecting -= 1
+        if self.size or self.connecting:
+            return
+        # Nothing else will come for the callers waiting
+        waiting, self.connectionQueue.waiting = \
+            self.connectionQueue.waiting, []
+        for d in waiting:
+            d.errback(ConnectionError(reason.getErrorMessage()))
+
+    def disconnect(self):
+        self.disconnectCalled = True
+        self.continueTrying = 0
+        for conn in self.pool:
+            conn.transport.loseConnection()
+        return self.waitForEmptyPool()
+
+
 class SubscriberFactory(RedisFactory):
     protocol = SubscriberProtocol
 
-    def __init__(self, isLazy=False, handler=ConnectionHandler):
+    def __init__(self, isLazy=False, handler=ConnectionHandler,
+                 dispatcher=None):
         RedisFactory.__init__(self, None, None, 1, isLazy=isLazy,
                               handler=handler)
+        self.dispatcher = dispatcher
+
+    def getDispatcher(self):
+        """
+        The ChannelDispatcher of the connections, created on first use
+        """
+        if self.dispatcher is None:
+            self.dispatcher = ChannelDispatcher()
+            for conn in self.pool:
+                conn.dispatcher = self.dispatcher
+        return self.dispatcher
+
+    def buildProtocol(self, addr):
+        p = RedisFactory.buildProtocol(self, addr)
+        if self.dispatcher is not None:
+            p.dispatcher = self.dispatcher
+        return p
 
 
 class MonitorFactory(RedisFactory):
     protocol = MonitorProtocol
 
-    def __init__(self, isLazy=False, handler=ConnectionHandler):
+    def __init__(self, isLazy=False, handler=ConnectionHandler,
+                 sampleRate=None, aggregator=None):
         RedisFactory.__init__(self, None, None, 1, isLazy=isLazy,
                               handler=handler)
+        self.sampleRate = sampleRate
+        self.aggregator = aggregator
 
+    def buildProtocol(self, addr):
+        p = RedisFactory.buildProtocol(self, addr)
+        if self.sampleRate is not None:
+            p.sampleRate = self.sampleRate
+        if self.aggregator is not None:
+            p.aggregator = self.aggregator
+        return p
 
-def makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
-                   charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                   convertNumbers):
-    uuid = "%s:%d" % (host, port)
-    factory = RedisFactory(uuid, dbid, poolsize, isLazy, ConnectionHandler,
-                           charset, password, replyTimeout, convertNumbers)
-    factory.continueTrying = reconnect
-    for x in range(poolsize):
-        if ssl_context_factory is True:
-            ssl_context_factory = ssl.ClientContextFactory()
-        if ssl_context_factory:
-            reactor.connectSSL(host, port, factory, ssl_context_factory, connectTimeout)
-        else:
-            reactor.connectTCP(host, port, factory, connectTimeout)
-
-    if isLazy:
-        return factory.handler
-    else:
-        return factory.deferred
 
+class ClientTrackingProtocol(SubscriberProtocol):
+    """
+    Receives the invalidation messages of the connections that redirect
+    their CLIENT TRACKING notifications to it.
+    """
+    @defer.inlineCallbacks
+    def connectionMade(self):
+        yield SubscriberProtocol.connectionMade(self)
+        if not self.connected:
+            if not self.factory.continueTrying:
+                # The handshake failed, and won't be tried again
+                self.factory.trackingFailed("handshake failed")
+            return
+        try:
+            client_id = yield self.client_id()
+            yield self.subscribe("__redis__:invalidate")
+        except ResponseError as e:
+            # Rejected by the server (Redis < 6, proxy, ACL...)
+            self.factory.trackingFailed(e)
+            self.transport.loseConnection()
+            return
+        except Exception as e:
+            log.msg("txredisapi: could not set up client tracking: %s" % e)
+            self.transport.loseConnection()
+            return
+        self.factory.trackingReady(self, client_id)
 
-def makeShardedConnection(hosts, dbid, poolsize, reconnect, isLazy,
-                          charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                          convertNumbers):
-    err = "Please use a list or tuple of host:port for sharded connections"
-    if not isinstance(hosts, (list, tuple)):
-        raise ValueError(err)
+    def connectionLost(self, why):
+        self.factory.trackingLost(self)
+        SubscriberProtocol.connectionLost(self, why)
 
-    connections = []
-    for item in hosts:
-        try:
-            host, port = item.split(":")
-            port = int(port)
-        except:
-            raise ValueError(err)
+    def messageReceived(self, pattern, channel, message):
+        # A nil message means that the whole keyspace was flushed
+        if message is None:
+            self.factory.cache.invalidate()
+        else:
+            for key in message:
+                self.factory.cache.invalidate(key)
 
-        c = makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
-                           charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                           convertNumbers)
-        connections.append(c)
 
-    if isLazy:
-        return ShardedConnectionHandler(connections)
-    else:
-        deferred = defer.DeferredList(connections)
-        ShardedConnectionHandler(deferred)
-        return deferred
+class ClientTrackingFactory(SubscriberFactory):
+    protocol = ClientTrackingProtocol
+    maxDelay = 5
 
+    def __init__(self, cache, target):
+        SubscriberFactory.__init__(self, isLazy=True)
+        self.cache = cache
+        self.target = target
+        self.charset = target.charset
+        self.password = target.password
+        self.continueTrying = target.continueTrying
 
-def Connection(host="localhost", port=6379, dbid=None, reconnect=True,
-               charset="utf-8", password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-               connectTimeout=None, replyTimeout=None, convertNumbers=True):
-    return makeConnection(host, port, dbid, 1, reconnect, False,
-                          charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                          convertNumbers)
+        self.clientId = None
+        self.failed = False
+        self._waitingForTracking = []
+        # Handshake errors are reported by trackingFailed()
+        self.deferred.addErrback(lambda _: None)
 
+    def whenTracking(self):
+        """
+        Returns a Deferred which fires with the client ID to redirect
+        invalidations to, or None if tracking can't be set up.
+        """
+        if self.clientId is not None:
+            return defer.succeed(self.clientId)
+        if self.failed:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waitingForTracking.append(d)
+        return d
 
-def lazyConnection(host="localhost", port=6379, dbid=None, reconnect=True,
-                   charset="utf-8", password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-                   connectTimeout=None, replyTimeout=None, convertNumbers=True):
-    return makeConnection(host, port, dbid, 1, reconnect, True,
-                          charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                          convertNumbers)
+    def trackingReady(self, conn, client_id):
+        self.resetDelay()
 
+        # Connections made before the redirect connection was lost
+        # point to an ID that does not exist anymore.
+        def redirect(data_conn):
+            data_conn.trackingRedirect = client_id
+            return data_conn.client_tracking(True, client_id).addErrback(
+                lambda _: data_conn.transport.loseConnection())
 
-def ConnectionPool(host="localhost", port=6379, dbid=None,
-                   poolsize=10, reconnect=True, charset="utf-8", password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-                   connectTimeout=None, replyTimeout=None,
-                   convertNumbers=True):
-    return makeConnection(host, port, dbid, poolsize, reconnect, False,
-                          charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                          convertNumbers)
+        pending = [redirect(data_conn) for data_conn in self.target.pool
+                   if data_conn.trackingRedirect not in (None, client_id)]
 
+        def ready(_):
+            if not conn.connected:
+                return
+            self.clientId = client_id
+            self._waitingForTracking, dfrs = [], self._waitingForTracking
+            for d in dfrs:
+                d.callback(client_id)
+        defer.DeferredList(pending).addCallback(ready)
+
+    def trackingFailed(self, reason):
+        log.msg("txredisapi: could not set up client tracking, reading "
+                "without the cache: %s" % reason)
+        self.failed = True
+        self.continueTrying = False
+        self._waitingForTracking, dfrs = [], self._waitingForTracking
+        for d in dfrs:
+            d.callback(None)
 
-def lazyConnectionPool(host="localhost", port=6379, dbid=None,
-                       poolsize=10, reconnect=True, charset="utf-8",
-                       password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False, connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
-    return makeConnection(host, port, dbid, poolsize, reconnect, True,
-                          charset, password, ssl_context_factory, connectTimeout, replyTimeout,
-                          convertNumbers)
+    def clientConnectionFailed(self, connector, reason):
+        SubscriberFactory.clientConnectionFailed(self, connector, reason)
+        if not self.continueTrying:
+            self.trackingFailed(reason.getErrorMessage())
 
+    def trackingLost(self, conn):
+        if self.clientId is not None:
+            self.clientId = None
+            # Invalidations may have been missed
+            self.cache.invalidate()
 
-def ShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
-                      password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False, connectTimeout=None, replyTimeout=None,
-                      convertNumbers=True):
-    return makeShardedConnection(hosts, dbid, 1, reconnect, False,
-                                 charset, password, ssl_context_factory, connectTimeout,
-                                 replyTimeout, convertNumbers)
 
+def _glob_to_regex(pattern):
+    """
+    Translates a Redis glob-style pattern (as used by KEYS, SCAN and
+    PSUBSCRIBE) to a regular expression.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            res.append(".*")
+        elif c == "?":
+            res.append(".")
+        elif c == "\\" and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        elif c == "[":
+            j = pattern.find("]", i + 1 if pattern[i:i + 1] == "^" else i)
+            if j == -1:
+                res.append("\\[")
+                continue
+            chars = pattern[i:j]
+            i = j + 1
+            negate = chars.startswith("^")
+            if negate:
+                chars = chars[1:]
+            chars = chars.replace("\\", "\\\\")
+            res.append("[%s%s]" % ("^" if negate else "", chars))
+        else:
+            res.append(re.escape(c))
+    return "(?s)^%s$" % "".join(res)
 
-def lazyShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
-                          password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-                          connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
-    return makeShardedConnection(hosts, dbid, 1, reconnect, True,
-                                 charset, password, ssl_context_factory, connectTimeout,
-                                 replyTimeout, convertNumbers)
 
+class ChannelDispatcher(object):
+    """
+    Routes the messages received by a SubscriberProtocol to callbacks
+    registered by channel, or by glob-style pattern. Every callback gets
+    the messages of a chunk of data received as a list:
 
-def ShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
-                          charset="utf-8", password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-                          connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
-    return makeShardedConnection(hosts, dbid, poolsize, reconnect, False,
-                                 charset, password, ssl_context_factory, connectTimeout,
-                                 replyTimeout, convertNumbers)
+        def on_news(channel, messages):
+            ...
 
+        dispatcher = ChannelDispatcher()
+        dispatcher.add("news", on_news)
+        dispatcher.add_pattern("news.*", on_news)
 
-def lazyShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
-                              charset="utf-8", password=None, ssl_context_factory: Union[ssl.ClientContextFactory, bool]=False,
-                              connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
-    return makeShardedConnection(hosts, dbid, poolsize, reconnect, True,
-                                 charset, password, ssl_context_factory, connectTimeout,
-                                 replyTimeout, convertNumbers)
+    Messages of channel subscriptions go to the callbacks of the channel,
+    messages of pattern subscriptions to the callbacks of that pattern
+    (Redis sends a message of each matching pattern subscription besides
+    the one of the channel subscription).
+    """
+    def __init__(self):
+        self._channels = {}
+        self._patterns = collections.OrderedDict()
 
+    def add(self, channel, callback):
+        self._channels.setdefault(channel, []).append(callback)
 
-def makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
-                       charset, password, connectTimeout, replyTimeout,
-                       convertNumbers):
-    factory = RedisFactory(path, dbid, poolsize, isLazy, UnixConnectionHandler,
-                           charset, password, replyTimeout, convertNumbers)
-    factory.continueTrying = reconnect
-    for x in range(poolsize):
-        reactor.connectUNIX(path, factory, connectTimeout)
+    def remove(self, channel, callback=None):
+        """
+        Remove a callback of a channel, or all of them
+        """
+        self._remove(self._channels, channel, callback)
 
-    if isLazy:
-        return factory.handler
-    else:
-        return factory.deferred
+    def add_pattern(self, pattern, callback):
+        self._patterns.setdefault(pattern, []).append(callback)
 
+    def remove_pattern(self, pattern, callback=None):
+        self._remove(self._patterns, pattern, callback)
 
-def makeShardedUnixConnection(paths, dbid, poolsize, reconnect, isLazy,
-                              charset, password, connectTimeout, replyTimeout,
-                              convertNumbers):
-    err = "Please use a list or tuple of paths for sharded unix connections"
-    if not isinstance(paths, (list, tuple)):
-        raise ValueError(err)
+    @staticmethod
+    def _remove(index, name, callback):
+        if name not in index:
+            return
+        registered = index[name]
+        if callback is not None:
+            registered.remove(callback)
+        if callback is None or not registered:
+            del index[name]
+
+    def dispatch(self, messages):
+        """
+        Deliver (pattern, channel, message) tuples, pattern being None for
+        channel subscriptions. Returns the ones without callbacks.
+        """
+        batches = collections.OrderedDict()
+        unhandled = []
+        for pattern, channel, message in messages:
+            if pattern is None:
+                callbacks = self._channels.get(channel)
+            else:
+                callbacks = self._patterns.get(pattern)
+            if not callbacks:
+                unhandled.append((pattern, channel, message))
+            for callback in callbacks or []:
+                batches.setdefault((callback, channel), []).append(message)
 
-    connections = []
-    for path in paths:
-        c = makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
-                               charset, password, connectTimeout, replyTimeout,
-                               convertNumbers)
-        connections.append(c)
+        for (callback, channel), batch in six.iteritems(batches):
+            try:
+                callback(channel, batch)
+            except Exception:
+                log.err()
+        return unhandled
 
-    if isLazy:
-        return ShardedUnixConnectionHandler(connections)
-    else:
-        deferred = defer.DeferredList(connections)
-        ShardedUnixConnectionHandler(deferred)
-        return deferred
 
+class _PartitionProtocol(SubscriberProtocol):
+    """
+    A connection of a PartitionedSubscriber. Redis confirms every channel
+    of a SUBSCRIBE (or UNSUBSCRIBE...) separately, so the Deferred of a
+    command fires once all of them are received.
+    """
+    def __init__(self, *args, **kwargs):
+        SubscriberProtocol.__init__(self, *args, **kwargs)
+        self._confirmations = collections.deque()
 
-def UnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
-                   charset="utf-8", password=None,
-                   connectTimeout=None, replyTimeout=None, convertNumbers=True):
-    return makeUnixConnection(path, dbid, 1, reconnect, False,
-                              charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+    def subscription(self, command, names):
+        if self.connected == 0:
+            raise ConnectionError("Not connected")
+        d = defer.Deferred()
+        self._confirmations.append([len(names), d])
+        self.transport.write(self._build_command(command, *names))
+        return d
 
+    def replyReceived(self, reply):
+        if isinstance(reply, list) and reply and self._confirmations and \
+                reply[0] in self._sub_unsub_reponses:
+            pending = self._confirmations[0]
+            pending[0] -= 1
+            if not pending[0]:
+                self._confirmations.popleft()
+                pending[1].callback(None)
+        else:
+            SubscriberProtocol.replyReceived(self, reply)
 
-def lazyUnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
-                       charset="utf-8", password=None,
-                       connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
-    return makeUnixConnection(path, dbid, 1, reconnect, True,
-                              charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+    def _messageReceived(self, pattern, channel, message):
+        self.factory.messages += 1
+        SubscriberProtocol._messageReceived(self, pattern, channel, message)
 
+    def messageReceived(self, pattern, channel, message):
+        self.factory.subscriber.messageReceived(pattern, channel, message)
 
-def UnixConnectionPool(path="/tmp/redis.sock", dbid=None, poolsize=10,
-                       reconnect=True, charset="utf-8", password=None,
-                       connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
-    return makeUnixConnection(path, dbid, poolsize, reconnect, False,
-                              charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+    def connectionLost(self, why):
+        self._confirmations, pending = collections.deque(), self._confirmations
+        for _, d in pending:
+            d.errback(ConnectionError("Lost connection"))
+        SubscriberProtocol.connectionLost(self, why)
+
+
+class _PartitionFactory(SubscriberFactory):
+    protocol = _PartitionProtocol
+
+    def __init__(self, subscriber, index, host, port):
+        SubscriberFactory.__init__(self, dispatcher=subscriber.dispatcher)
+        self.subscriber = subscriber
+        self.index = index
+        self.host = host
+        self.port = port
+        self.uuid = "%s:%d" % (host, port)
+        self.password = subscriber.password
+        self.channels = set()
+        self.patterns = set()
+        self.messages = 0
+        self.opened = False
+        # Fired once the connection is made and subscribed
+        self._waitingForSubscribed = []
+
+    @property
+    def connection(self):
+        return self.pool[0] if self.pool else None
+
+    def addConnection(self, conn):
+        SubscriberFactory.addConnection(self, conn)
+        if self.connection is conn:
+            self.resubscribe(conn)
+
+    @defer.inlineCallbacks
+    def resubscribe(self, conn):
+        """
+        Subscribe a new connection to the channels and patterns of the
+        partition, chunkSize names per command, one command at a time.
+        """
+        size = self.subscriber.chunkSize
+        for command, names in ((self.subscriber.subscribeCommand,
+                                self.channels),
+                               ("PSUBSCRIBE", self.patterns)):
+            names = list(names)
+            for i in range(0, len(names), size):
+                try:
+                    yield conn.subscription(command, names[i:i + size])
+                except ConnectionError:
+                    return
+
+        self._waitingForSubscribed, waiting = [], self._waitingForSubscribed
+        for d in waiting:
+            d.callback(None)
+
+    def clientConnectionFailed(self, connector, reason):
+        SubscriberFactory.clientConnectionFailed(self, connector, reason)
+        self._failWaiting(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        SubscriberFactory.clientConnectionLost(self, connector, reason)
+        if not self.continueTrying:
+            self._failWaiting(reason)
+
+    def _failWaiting(self, reason):
+        self._waitingForSubscribed, waiting = [], self._waitingForSubscribed
+        for d in waiting:
+            d.errback(ConnectionError(reason.getErrorMessage()))
+
+    def whenSubscribed(self):
+        """
+        Returns a Deferred which fires once the connection is made and
+        subscribed to the channels and patterns of the partition, or
+        fails if connecting does
+        """
+        d = defer.Deferred()
+        self._waitingForSubscribed.append(d)
+        return d
+
+    def send(self, command, names):
+        conn = self.connection
+        if conn is None or not names:
+            return defer.succeed(None)
+        try:
+            return conn.subscription(command, names)
+        except ConnectionError:
+            # Sent again by resubscribe() once reconnected
+            return defer.succeed(None)
+
+
+class PartitionedSubscriber(object):
+    """
+    Subscriptions hashed over `partitions` connections, so that the
+    messages of many channels are parsed off several sockets, and a
+    reconnection only resubscribes one partition, `chunkSize` channels
+    per command.
+
+    Channels and patterns are kept by partition, and subscribed again
+    whenever its connection is made; while disconnected, subscribe() only
+    records them. Messages go to messageReceived(), or to the callbacks
+    of `dispatcher` (a ChannelDispatcher shared by all the partitions).
+
+        subscriber = PartitionedSubscriber("localhost", 6379, partitions=8)
+        yield subscriber.connect()
+        yield subscriber.subscribe(channels)
+    """
+    subscribeCommand = "SUBSCRIBE"
+    unsubscribeCommand = "UNSUBSCRIBE"
+
+    def __init__(self, host="localhost", port=6379, partitions=4,
+                 dispatcher=None, chunkSize=1000, password=None,
+                 reconnect=True, connectTimeout=None):
+        if not isinstance(partitions, int) or partitions < 1:
+            raise ValueError("partitions must be a positive integer, not %s" %
+                             repr(partitions))
+        self.host = host
+        self.port = port
+        self.dispatcher = dispatcher
+        self.chunkSize = chunkSize
+        self.password = password
+        self.reconnect = reconnect
+        self.connectTimeout = connectTimeout
+        self.factories = [_PartitionFactory(self, i, host, port)
+                          for i in range(partitions)]
+        self._lastStats = time.time()
+        self._lastMessages = [0] * partitions
+
+    def connect(self):
+        """
+        Connect all the partitions. Returns a Deferred which fires with
+        this subscriber once they are connected.
+        """
+        deferreds = []
+        for factory in self.factories:
+            deferreds.append(factory.deferred)
+            self._open(factory)
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda _: self)
+        return d
+
+    def _open(self, factory):
+        factory.opened = True
+        factory.continueTrying = self.reconnect
+        reactor.connectTCP(factory.host, factory.port, factory,
+                           self.connectTimeout)
+
+    def partition(self, name):
+        if isinstance(name, six.text_type):
+            name = name.encode("utf-8")
+        return zlib.crc32(name) % len(self.factories)
+
+    def _group(self, names):
+        if isinstance(names, (six.string_types, six.binary_type)):
+            names = [names]
+        groups = collections.OrderedDict()
+        for name in names:
+            groups.setdefault(self.partition(name), []).append(name)
+        return groups
+
+    def _update(self, command, names, kind, subscribe):
+        deferreds = []
+        for index, group in six.iteritems(self._group(names)):
+            factory = self.factories[index]
+            registered = getattr(factory, kind)
+            if subscribe:
+                group = [name for name in group if name not in registered]
+                registered.update(group)
+            else:
+                group = [name for name in group if name in registered]
+                registered.difference_update(group)
+            for i in range(0, len(group), self.chunkSize):
+                deferreds.append(self._send(factory, command,
+                                            group[i:i + self.chunkSize]))
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallbacks(lambda _: None, lambda f: f.value.subFailure)
+        return d
+
+    def _send(self, factory, command, names):
+        return factory.send(command, names)
+
+    def subscribe(self, channels):
+        return self._update(self.subscribeCommand, channels, "channels", True)
+
+    def unsubscribe(self, channels):
+        return self._update(self.unsubscribeCommand, channels, "channels",
+                            False)
+
+    def psubscribe(self, patterns):
+        return self._update("PSUBSCRIBE", patterns, "patterns", True)
+
+    def punsubscribe(self, patterns):
+        return self._update("PUNSUBSCRIBE", patterns, "patterns", False)
+
+    def messageReceived(self, pattern, channel, message):
+        pass
+
+    def getDispatcher(self):
+        """
+        The ChannelDispatcher of all the partitions, created on first use
+        """
+        if self.dispatcher is None:
+            self.dispatcher = ChannelDispatcher()
+            for factory in self.factories:
+                factory.dispatcher = self.dispatcher
+                for conn in factory.pool:
+                    conn.dispatcher = self.dispatcher
+        return self.dispatcher
+
+    def stats(self):
+        """
+        Per partition: number of channels and patterns, messages received,
+        messages per second since the previous call and whether it is
+        connected.
+        """
+        now = time.time()
+        elapsed = max(now - self._lastStats, 1e-6)
+        stats = []
+        for i, factory in enumerate(self.factories):
+            stats.append({
+                "channels": len(factory.channels),
+                "patterns": len(factory.patterns),
+                "messages": factory.messages,
+                "rate": (factory.messages - self._lastMessages[i]) / elapsed,
+                "connected": factory.connection is not None,
+            })
+            self._lastMessages[i] = factory.messages
+        self._lastStats = now
+        return stats
+
+    def disconnect(self):
+        d = defer.gatherResults([factory.handler.disconnect()
+                                 for factory in self.factories],
+                                consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def __repr__(self):
+        return "<Redis Partitioned Subscriber: %s:%s - %d partition(s)>" % \
+               (self.host, self.port, len(self.factories))
+
+
+class ShardedSubscriber(PartitionedSubscriber):
+    """
+    Subscriptions to the channels of a sharded deployment: every channel
+    is subscribed on the node a ShardedConnection to the same `hosts`
+    publishes it to (hash tags included), and a node is only connected
+    to while it owns subscribed channels.
+
+    With ssubscribe=True (Redis >= 7.0), channels are shard channels,
+    subscribed with SSUBSCRIBE and published with SPUBLISH; otherwise
+    with SUBSCRIBE and PUBLISH. Patterns can't be sharded.
+
+    add_node() and remove_node() change the nodes, and move the channels
+    whose owner changed to their new node.
+    """
+    _hostsError = "Please use a list or tuple of host:port for sharded " \
+                  "subscribers"
+
+    def __init__(self, hosts, ssubscribe=False, dispatcher=None,
+                 chunkSize=1000, password=None, reconnect=True,
+                 connectTimeout=None):
+        if not isinstance(hosts, (list, tuple)):
+            raise ValueError(self._hostsError)
+        if ssubscribe:
+            self.subscribeCommand = "SSUBSCRIBE"
+            self.unsubscribeCommand = "SUNSUBSCRIBE"
+        self.dispatcher = dispatcher
+        self.chunkSize = chunkSize
+        self.password = password
+        self.reconnect = reconnect
+        self.connectTimeout = connectTimeout
+        self.factories = []
+        self._lastStats = time.time()
+        self._lastMessages = []
+        for host in hosts:
+            self._addFactory(*self._parse(host))
+        self._ring = HashRing([f.handler for f in self.factories])
+
+    def _parse(self, item):
+        try:
+            host, port = item.split(":")
+            return host, int(port)
+        except (AttributeError, ValueError):
+            raise ValueError(self._hostsError)
+
+    def _addFactory(self, host, port, index=None):
+        if index is None:
+            index = len(self.factories)
+            self.factories.append(None)
+            self._lastMessages.append(0)
+        factory = _PartitionFactory(self, index, host, port)
+        self.factories[index] = factory
+        self._lastMessages[index] = 0
+        return factory
+
+    def connect(self):
+        """
+        Nodes are connected to when channels are subscribed on them
+        """
+        return defer.succeed(self)
+
+    def partition(self, name):
+        m = _findhash.match(name)
+        if m is not None and len(m.groups()) >= 1:
+            name = m.groups()[0]
+        return self._ring(name)._factory.index
+
+    def _send(self, factory, command, names):
+        if factory.connection is not None:
+            return factory.send(command, names)
+        if command != self.subscribeCommand:
+            return defer.succeed(None)
+        d = factory.whenSubscribed()
+        if not factory.opened:
+            self._open(factory)
+        return d
+
+    def psubscribe(self, patterns):
+        raise NotImplementedError("Patterns can't be sharded")
+
+    def punsubscribe(self, patterns):
+        raise NotImplementedError("Patterns can't be sharded")
+
+    def add_node(self, host):
+        """
+        Add a node, and move to it the channels it now owns
+        """
+        host, port = self._parse(host)
+        self._addFactory(host, port)
+        return self._rebalance()
+
+    def remove_node(self, host):
+        """
+        Remove a node, and move its channels to their new owners
+        """
+        host, port = self._parse(host)
+        uuid = "%s:%d" % (host, port)
+        for factory in self.factories:
+            if factory.uuid == uuid:
+                break
+        else:
+            raise ValueError("Unknown node: %s" % uuid)
+
+        self.factories.remove(factory)
+        del self._lastMessages[factory.index]
+        for index, other in enumerate(self.factories):
+            other.index = index
+        channels, factory.channels = list(factory.channels), set()
+        self._ring = HashRing([f.handler for f in self.factories])
+        d = defer.gatherResults([factory.handler.disconnect(),
+                                 self.subscribe(channels)],
+                                consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def _rebalance(self):
+        self._ring = HashRing([f.handler for f in self.factories])
+        deferreds = []
+        moved = []
+        for factory in list(self.factories):
+            channels = [channel for channel in factory.channels
+                        if self.partition(channel) != factory.index]
+            if not channels:
+                continue
+            moved.extend(channels)
+            factory.channels.difference_update(channels)
+            if not factory.channels:
+                # Owns nothing anymore: close its connection
+                deferreds.append(factory.handler.disconnect())
+                self._addFactory(factory.host, factory.port, factory.index)
+                continue
+            for i in range(0, len(channels), self.chunkSize):
+                deferreds.append(self._send(
+                    factory, self.unsubscribeCommand,
+                    channels[i:i + self.chunkSize]))
+
+        self._ring = HashRing([f.handler for f in self.factories])
+        deferreds.append(self.subscribe(moved))
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def __repr__(self):
+        return "<Redis Sharded Subscriber: %s>" % \
+               ", ".join(f.uuid for f in self.factories)
+
+
+class Subscription(object):
+    """
+    Messages of some channels and patterns, queued for a consumer that
+    takes them at its own pace, with get() or as an async iterator of
+    (pattern, channel, message) tuples, pattern being None for channel
+    subscriptions:
+
+        sub = Subscription(rc, maxsize=1000, overflow="pause")
+        yield sub.subscribe(["prices", "trades"])
+        async for pattern, channel, message in sub:
+            ...
+
+    `handler` is the connection of a SubscriberFactory, or a
+    PartitionedSubscriber; messages are routed to subscriptions by its
+    ChannelDispatcher. At most `maxsize` messages are queued, and then,
+    depending on `overflow`:
+
+    - "drop-oldest": the oldest queued message is dropped
+    - "drop-newest": the message received is dropped
+    - "pause": the connections stop reading the socket until the queue
+      is down to half of `maxsize` (messages already read are queued)
+    """
+    OVERFLOW = ("drop-oldest", "drop-newest", "pause")
+
+    def __init__(self, handler, maxsize=1000, overflow="drop-oldest"):
+        if overflow not in self.OVERFLOW:
+            raise ValueError("overflow must be one of %s, not %s" %
+                             (", ".join(self.OVERFLOW), repr(overflow)))
+        if isinstance(handler, PartitionedSubscriber):
+            self._factories = handler.factories
+            self.dispatcher = handler.getDispatcher()
+        else:
+            self._factories = [handler._factory]
+            self.dispatcher = handler._factory.getDispatcher()
+        self.handler = handler
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.received = 0
+        self.dropped = 0
+        self.pauses = 0
+        self.paused = False
+        self.closed = False
+        self._queue = collections.deque()
+        self._waiting = []
+        self._channels = {}
+        self._patterns = {}
+
+    def subscribe(self, channels):
+        if isinstance(channels, six.string_types):
+            channels = [channels]
+        for channel in channels:
+            if channel not in self._channels:
+                callback = functools.partial(self._received, None)
+                self._channels[channel] = callback
+                self.dispatcher.add(channel, callback)
+        return self.handler.subscribe(channels)
+
+    def psubscribe(self, patterns):
+        if isinstance(patterns, six.string_types):
+            patterns = [patterns]
+        for pattern in patterns:
+            if pattern not in self._patterns:
+                callback = functools.partial(self._received, pattern)
+                self._patterns[pattern] = callback
+                self.dispatcher.add_pattern(pattern, callback)
+        return self.handler.psubscribe(patterns)
+
+    def unsubscribe(self, channels):
+        """
+        Stop receiving messages of some channels. The connection only
+        unsubscribes from the ones no other callback is registered for.
+        """
+        if isinstance(channels, six.string_types):
+            channels = [channels]
+        unused = []
+        for channel in channels:
+            if channel in self._channels:
+                self.dispatcher.remove(channel, self._channels.pop(channel))
+                if channel not in self.dispatcher._channels:
+                    unused.append(channel)
+        if not unused:
+            return defer.succeed(None)
+        return self.handler.unsubscribe(unused)
+
+    def punsubscribe(self, patterns):
+        if isinstance(patterns, six.string_types):
+            patterns = [patterns]
+        unused = []
+        for pattern in patterns:
+            if pattern in self._patterns:
+                self.dispatcher.remove_pattern(pattern,
+                                               self._patterns.pop(pattern))
+                if pattern not in self.dispatcher._patterns:
+                    unused.append(pattern)
+        if not unused:
+            return defer.succeed(None)
+        return self.handler.punsubscribe(unused)
+
+    def _received(self, pattern, channel, messages):
+        for message in messages:
+            self.received += 1
+            if self._waiting:
+                self._waiting.pop(0).callback((pattern, channel, message))
+                continue
+            if len(self._queue) >= self.maxsize:
+                if self.overflow == "drop-oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self.overflow == "drop-newest":
+                    self.dropped += 1
+                    continue
+                else:
+                    self._pause()
+            self._queue.append((pattern, channel, message))
+
+    def _pause(self):
+        # Also called for every message read while paused, to pause
+        # connections made in the meantime
+        if not self.paused:
+            self.paused = True
+            self.pauses += 1
+        for factory in self._factories:
+            for conn in factory.pool:
+                conn.pauseReading(self)
+
+    def _resume(self):
+        self.paused = False
+        for factory in self._factories:
+            for conn in factory.pool:
+                conn.resumeReading(self)
+
+    def get(self):
+        """
+        Returns a Deferred which fires with the next message, or None
+        once the subscription is closed
+        """
+        if self._queue:
+            item = self._queue.popleft()
+            if self.paused and len(self._queue) <= self.maxsize // 2:
+                self._resume()
+            return defer.succeed(item)
+        if self.closed:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        def item(message):
+            if message is None:
+                raise StopAsyncIteration()
+            return message
+        return self.get().addCallback(item)
+
+    def stats(self):
+        return {"queued": len(self._queue), "received": self.received,
+                "dropped": self.dropped, "pauses": self.pauses,
+                "paused": self.paused}
+
+    def close(self):
+        """
+        Unsubscribe and end the iteration. Messages already queued are
+        discarded.
+        """
+        self.closed = True
+        self._queue.clear()
+        if self.paused:
+            self._resume()
+        self._waiting, waiting = [], self._waiting
+        for d in waiting:
+            d.callback(None)
+        d = defer.gatherResults([self.unsubscribe(list(self._channels)),
+                                 self.punsubscribe(list(self._patterns))],
+                                consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def __repr__(self):
+        return "<Redis Subscription: %d channel(s), %d pattern(s)>" % \
+               (len(self._channels), len(self._patterns))
+
+
+class HotKeyAggregator(object):
+    """
+    Rolling top `k` commands and keys of the MonitorEvents added to it,
+    for MonitorFactory(aggregator=...). Commands are counted exactly;
+    keys in a count-min sketch of `depth` rows of `width` counters, so
+    memory does not grow with the number of distinct keys (estimates
+    may be over, never under, the actual count).
+
+    Counts are halved every `halfLife` seconds, so the top lists follow
+    what is hot lately. Counts are of the events added: with a sampled
+    MONITOR, divide them by the sample rate.
+    """
+    # Commands whose arguments are not keys
+    KEYLESS = frozenset([
+        "AUTH", "BGREWRITEAOF", "BGSAVE", "CLIENT", "CLUSTER", "COMMAND",
+        "CONFIG", "DBSIZE", "DEBUG", "DISCARD", "ECHO", "EXEC", "FLUSHALL",
+        "FLUSHDB", "FUNCTION", "HELLO", "INFO", "LASTSAVE", "LATENCY",
+        "MEMORY", "MONITOR", "MULTI", "PING", "PSUBSCRIBE", "PUBLISH",
+        "PUNSUBSCRIBE", "QUIT", "RANDOMKEY", "READONLY", "READWRITE",
+        "ROLE", "SAVE", "SCAN", "SCRIPT", "SELECT", "SHUTDOWN", "SLAVEOF",
+        "REPLICAOF", "SLOWLOG", "SPUBLISH", "SSUBSCRIBE", "SUBSCRIBE",
+        "SUNSUBSCRIBE", "SWAPDB", "TIME", "UNSUBSCRIBE", "UNWATCH", "WAIT"])
+    # Commands whose arguments are all keys
+    ALLKEYS = frozenset(["DEL", "EXISTS", "MGET", "TOUCH", "UNLINK",
+                         "WATCH", "SDIFF", "SINTER", "SUNION", "PFCOUNT"])
+
+    def __init__(self, k=10, width=2048, depth=4, halfLife=60):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.halfLife = halfLife
+        self.events = 0
+        self._sketch = [[0.0] * width for _ in range(depth)]
+        self._keys = {}
+        self._floor = 0.0
+        self._commands = {}
+        self._decayed = time.time()
+
+    def keys(self, event):
+        """
+        The keys of the command of an event
+        """
+        command, args = event.command, event.args
+        if command in self.KEYLESS or not args:
+            return []
+        if command in self.ALLKEYS:
+            return args
+        if command in ("MSET", "MSETNX"):
+            return args[::2]
+        if command in ("EVAL", "EVALSHA", "FCALL", "FCALL_RO"):
+            try:
+                return args[2:2 + int(args[1])]
+            except (IndexError, ValueError):
+                return []
+        return args[:1]
+
+    def _hashes(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def estimate(self, key):
+        """
+        Estimated count of a key
+        """
+        return min(row[i] for row, i in zip(self._sketch, self._hashes(key)))
+
+    def add(self, event):
+        elapsed = time.time() - self._decayed
+        if elapsed >= self.halfLife:
+            self.decay(0.5 ** int(elapsed // self.halfLife))
+
+        self.events += 1
+        self._commands[event.command] = \
+            self._commands.get(event.command, 0) + 1
+        for key in self.keys(event):
+            estimate = None
+            for row, i in zip(self._sketch, self._hashes(key)):
+                row[i] += 1
+                if estimate is None or row[i] < estimate:
+                    estimate = row[i]
+            self._addTop(key, estimate)
+
+    def _addTop(self, key, estimate):
+        if key in self._keys or len(self._keys) < self.k:
+            self._keys[key] = estimate
+        elif estimate > self._floor:
+            coldest = min(self._keys, key=self._keys.get)
+            if estimate > self._keys[coldest]:
+                del self._keys[coldest]
+                self._keys[key] = estimate
+            self._floor = min(self._keys.values())
+
+    def decay(self, factor=0.5):
+        """
+        Multiply all the counts by factor
+        """
+        for row in self._sketch:
+            row[:] = [count * factor for count in row]
+        for index in (self._keys, self._commands):
+            for name in index:
+                index[name] *= factor
+        self._floor *= factor
+        self._decayed = time.time()
+
+    @staticmethod
+    def _top(counts, k):
+        return sorted(six.iteritems(counts), key=lambda item: -item[1])[:k]
+
+    def top_keys(self, k=None):
+        """
+        [(key, count), ...] of the hottest keys, hottest first
+        """
+        return self._top(self._keys, k or self.k)
+
+    def top_commands(self, k=None):
+        return self._top(self._commands, k or self.k)
+
+    def __repr__(self):
+        return "<Redis Hot Key Aggregator: %d event(s)>" % self.events
+
+
+class ReplyCache(object):
+    """
+    Process local cache of GET, HGET, HGETALL and MGET replies. It is
+    bounded by `maxEntries` replies and, optionally, `maxBytes` (an
+    estimation of the size of the keys and values), evicting the least
+    recently used (`policy="lru"`) or least frequently used
+    (`policy="lfu"`) replies first. Replies may be stored with a TTL;
+    None replies for `negativeTtl` seconds at most, if set.
+
+    See ClientCache and NearCacheHandler.
+    """
+    commands = frozenset(["get", "hget", "hgetall", "mget"])
+
+    def __init__(self, maxEntries=10000, maxBytes=None, policy="lru",
+                 negativeTtl=None):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Cache policy must be 'lru' or 'lfu', not %s" %
+                             repr(policy))
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.negativeTtl = negativeTtl
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # (key, subkey) -> (value, expiration time)
+        self._entries = collections.OrderedDict()
+        self._keys = {}
+        # LFU bookkeeping: entry -> number of uses, and entries by uses
+        self._uses = {}
+        self._byUses = {}
+        self._minUses = 1
+        # Reads in flight by key, as [count, version]. Invalidations bump
+        # the version so that replies older than them are not stored.
+        self._inflight = {}
+        self._flushes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, (six.text_type, six.binary_type)):
+            return len(value)
+        if isinstance(value, dict):
+            return sum(ReplyCache._sizeof(k) + ReplyCache._sizeof(v)
+                       for k, v in six.iteritems(value))
+        if isinstance(value, (list, tuple)):
+            return sum(ReplyCache._sizeof(v) for v in value)
+        return 8
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, six.binary_type):
+            try:
+                return key.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        return key
+
+    def _touch(self, entry):
+        if self.policy == "lru":
+            self._entries[entry] = self._entries.pop(entry)
+            return
+        uses = self._uses[entry]
+        bucket = self._byUses[uses]
+        del bucket[entry]
+        if not bucket:
+            del self._byUses[uses]
+            if self._minUses == uses:
+                self._minUses = uses + 1
+        self._uses[entry] = uses + 1
+        self._byUses.setdefault(uses + 1,
+                                collections.OrderedDict())[entry] = None
+
+    def _victim(self):
+        if self.policy == "lru":
+            return next(iter(self._entries))
+        while self._minUses not in self._byUses:
+            self._minUses += 1
+        return next(iter(self._byUses[self._minUses]))
+
+    def lookup(self, key, subkey):
+        """
+        Returns (True, value) if the reply is cached, (False, None) otherwise.
+        """
+        entry = (self._key(key), subkey)
+        try:
+            value, expires = self._entries[entry]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        if expires is not None and expires <= reactor.seconds():
+            self._discard(entry)
+            self.misses += 1
+            return False, None
+        self._touch(entry)
+        self.hits += 1
+        if isinstance(value, dict):
+            value = dict(value)
+        return True, value
+
+    def store(self, key, subkey, value, ttl=None):
+        key = self._key(key)
+        entry = (key, subkey)
+        self._discard(entry)
+        expires = None if ttl is None else reactor.seconds() + ttl
+        self._entries[entry] = (value, expires)
+        self._keys.setdefault(key, set()).add(subkey)
+        if self.policy == "lfu":
+            self._uses[entry] = 1
+            self._byUses.setdefault(1, collections.OrderedDict())[entry] = None
+            self._minUses = 1
+        self.size += self._sizeof(key) + self._sizeof(value)
+        while self._entries and (
+                len(self._entries) > self.maxEntries or
+                (self.maxBytes is not None and self.size > self.maxBytes)):
+            self._discard(self._victim())
+            self.evictions += 1
+
+    def _discard(self, entry):
+        try:
+            value, _ = self._entries.pop(entry)
+        except KeyError:
+            return
+        key, subkey = entry
+        self.size -= self._sizeof(key) + self._sizeof(value)
+        subkeys = self._keys[key]
+        subkeys.discard(subkey)
+        if not subkeys:
+            del self._keys[key]
+        if self.policy == "lfu":
+            uses = self._uses.pop(entry)
+            bucket = self._byUses[uses]
+            del bucket[entry]
+            if not bucket:
+                del self._byUses[uses]
+
+    def invalidate(self, key=None):
+        """
+        Drop the cached replies of `key`, or all of them.
+        """
+        self.invalidations += 1
+        if key is None:
+            self._flushes += 1
+            self._entries.clear()
+            self._keys.clear()
+            self._uses.clear()
+            self._byUses.clear()
+            self.size = 0
+            return
+        key = self._key(key)
+        if key in self._inflight:
+            self._inflight[key][1] += 1
+        for subkey in list(self._keys.get(key, ())):
+            self._discard((key, subkey))
+
+    def _begin(self, key):
+        reading = self._inflight.setdefault(self._key(key), [0, 0])
+        reading[0] += 1
+        return reading[1], self._flushes
+
+    def _end(self, key, token):
+        key = self._key(key)
+        reading = self._inflight[key]
+        reading[0] -= 1
+        if not reading[0]:
+            del self._inflight[key]
+        return token == (reading[1], self._flushes)
+
+    def _fetch(self, fetch, keys, subkeys, args, kwargs, post, ttl=None):
+        tokens = [self._begin(key) for key in keys]
+
+        def on_reply(reply):
+            values = post(reply)
+            for key, subkey, value, token in zip(keys, subkeys, values, tokens):
+                if not self._end(key, token):
+                    continue
+                seconds = None if ttl is None else ttl(key)
+                if value is None and self.negativeTtl is not None:
+                    seconds = self.negativeTtl if seconds is None else \
+                        min(seconds, self.negativeTtl)
+                if seconds is None or seconds > 0:
+                    self.store(key, subkey, value, seconds)
+            return reply
+
+        def on_error(failure):
+            for key, token in zip(keys, tokens):
+                self._end(key, token)
+            return failure
+
+        return fetch(*args, **kwargs).addCallbacks(on_reply, on_error)
+
+    def cached(self, method, fetch, ttl=None):
+        """
+        Wraps the connection handler method `fetch`, one of `commands`,
+        with the cache.
+
+        `ttl`, if given, is called with a key and returns for how long to
+        keep its replies. Keys with no TTL are not cached.
+        """
+        def cacheable(key):
+            return ttl is None or ttl(key)
+
+        def get(key):
+            if cacheable(key):
+                hit, value = self.lookup(key, "get")
+                if hit:
+                    return defer.succeed(value)
+                return self._fetch(fetch, [key], ["get"], (key,), {},
+                                   lambda reply: [reply], ttl)
+            return fetch(key)
+
+        def hget(key, field):
+            if cacheable(key):
+                subkey = ("hget", self._key(field))
+                hit, value = self.lookup(key, subkey)
+                if hit:
+                    return defer.succeed(value)
+                return self._fetch(fetch, [key], [subkey], (key, field), {},
+                                   lambda reply: [reply], ttl)
+            return fetch(key, field)
+
+        def hgetall(key):
+            if cacheable(key):
+                hit, value = self.lookup(key, "hgetall")
+                if hit:
+                    return defer.succeed(value)
+                return self._fetch(fetch, [key], ["hgetall"], (key,), {},
+                                   lambda reply: [dict(reply)], ttl)
+            return fetch(key)
+
+        def mget(keys, *args):
+            keys = list_or_args("mget", keys, args)
+            values = {}
+            missing = []
+            for key in keys:
+                if key in values or key in missing:
+                    continue
+                hit = False
+                if cacheable(key):
+                    hit, value = self.lookup(key, "get")
+                if hit:
+                    values[key] = value
+                else:
+                    missing.append(key)
+            if not missing:
+                return defer.succeed([values[key] for key in keys])
+
+            def merge(reply):
+                values.update(zip(missing, reply))
+                return [values[key] for key in keys]
+
+            stored = [key for key in missing if cacheable(key)]
+            if len(stored) < len(missing):
+                def post(reply):
+                    return [value for key, value in zip(missing, reply)
+                            if cacheable(key)]
+            else:
+                def post(reply):
+                    return reply
+            return self._fetch(fetch, stored, ["get"] * len(stored),
+                               (missing,), {}, post, ttl).addCallback(merge)
+
+        return {"get": get, "hget": hget, "hgetall": hgetall,
+                "mget": mget}[method]
+
+    def invalidating(self, method, fetch):
+        """
+        Wraps the connection handler method `fetch`, the write command
+        `method`, so that it invalidates the cached replies of the keys
+        it writes.
+        """
+        def write(*args, **kwargs):
+            # Our own writes would not be reflected in the cache otherwise
+            keys = _written_keys(method, args, kwargs)
+
+            def invalidate(result):
+                if keys is None:
+                    self.invalidate()
+                for key in keys or ():
+                    self.invalidate(key)
+                return result
+            invalidate(None)
+            return fetch(*args, **kwargs).addBoth(invalidate)
+        return write
+
+    @staticmethod
+    def isWrite(method):
+        """
+        Whether `method` is a command writing keys (see WriteMethods)
+        """
+        return method in WriteMethods
+
+
+class ClientCache(ReplyCache):
+    """
+    Cache of GET, HGET, HGETALL and MGET replies kept coherent by the
+    server with CLIENT TRACKING (Redis >= 6).
+
+    Every connection redirects its invalidation messages to a connection
+    subscribed to __redis__:invalidate. The cache is flushed, and not
+    used, while the invalidation connection is lost, or for good if the
+    server rejects its commands.
+
+    Pass it as `clientCache` to Connection, ConnectionPool and friends.
+    """
+    def __init__(self, maxEntries=10000, maxBytes=None, policy="lru",
+                 negativeTtl=None):
+        ReplyCache.__init__(self, maxEntries, maxBytes, policy, negativeTtl)
+        self._trackers = {}
+
+    def attach(self, factory, connect):
+        """
+        Start tracking the keys read by the connections of `factory`.
+        `connect` is called with the factory of the invalidation connection.
+        """
+        tracker = ClientTrackingFactory(self, factory)
+        self._trackers[factory] = tracker
+        connect(tracker)
+
+    def detach(self, factory):
+        tracker = self._trackers.pop(factory, None)
+        if tracker is None:
+            return defer.succeed(None)
+        self.invalidate()
+        return tracker.handler.disconnect()
+
+    def whenTracking(self, factory):
+        return self._trackers[factory].whenTracking()
+
+    def _isTracking(self, factory):
+        tracker = self._trackers.get(factory)
+        return tracker is not None and tracker.clientId is not None
+
+    def wrap(self, factory, method, fetch):
+        """
+        Wraps the ConnectionHandler method `fetch` with the cache.
+        """
+        if method in self.commands:
+            cached = self.cached(method, fetch)
+        elif self.isWrite(method):
+            cached = self.invalidating(method, fetch)
+        else:
+            return fetch
+
+        def wrapper(*args, **kwargs):
+            if not self._isTracking(factory):
+                return fetch(*args, **kwargs)
+            return cached(*args, **kwargs)
+        return wrapper
+
+
+class _InvalidatingConnection(object):
+    """
+    The connection of a transaction or pipeline started through a
+    NearCacheHandler. The keys written through it are invalidated when
+    the commands are queued, and again when they run: on commit() and
+    execute_pipeline().
+    """
+    def __init__(self, cache, conn):
+        self._cache = cache
+        self._conn = conn
+        self._keys = set()
+        self._all = False
+
+    def _written(self, method, args, kwargs):
+        keys = _written_keys(method, args, kwargs)
+        if keys is None:
+            self._all = True
+            self._cache.invalidate()
+        else:
+            self._keys.update(keys)
+            for key in keys:
+                self._cache.invalidate(key)
+
+    def _invalidate(self, result):
+        keys, self._keys = self._keys, set()
+        if self._all:
+            self._all = False
+            self._cache.invalidate()
+        for key in keys:
+            self._cache.invalidate(key)
+        return result
+
+    def commit(self):
+        return self._conn.commit().addBoth(self._invalidate)
+
+    def execute_pipeline(self):
+        return self._conn.execute_pipeline().addBoth(self._invalidate)
+
+    def discard(self):
+        self._keys = set()
+        self._all = False
+        return self._conn.discard()
+
+    def multi(self, *args, **kwargs):
+        return self._conn.multi(*args, **kwargs).addCallback(
+            lambda _: self)
+
+    def __getattr__(self, method):
+        attr = getattr(self._conn, method)
+        if not self._cache.isWrite(method):
+            return attr
+
+        def write(*args, **kwargs):
+            self._written(method, args, kwargs)
+            return attr(*args, **kwargs)
+        return write
+
+    def __repr__(self):
+        return "<Redis Near Cache Connection: %r>" % self._conn
+
+
+class NearCacheHandler(object):
+    """
+    Read-through cache in front of a connection handler, for servers that
+    don't support CLIENT TRACKING. Replies of GET, HGET, HGETALL and MGET
+    are kept for the TTL of the first pattern in `ttls` (a list of
+    (pattern, seconds) pairs or a dict, using Redis glob-style patterns)
+    matching the key. Keys matching no pattern are not cached.
+
+    Replies may be stale for up to their TTL when other clients write the
+    keys; writes made through this handler, including the transactions
+    and pipelines it starts, invalidate them right away. None replies
+    are cached for `negativeTtl` seconds at most (0 disables negative
+    caching).
+    """
+    def __init__(self, handler, ttls, maxEntries=10000, maxBytes=None,
+                 policy="lru", negativeTtl=None):
+        self.handler = handler
+        self.cache = ReplyCache(maxEntries, maxBytes, policy, negativeTtl)
+
+        if isinstance(ttls, dict):
+            ttls = list(ttls.items())
+        self._ttls = [(re.compile(_glob_to_regex(pattern)), seconds)
+                      for pattern, seconds in ttls]
+        self._ttlByKey = {}
+
+    def ttl(self, key):
+        """
+        For how long the replies of `key` may be cached, or None.
+        """
+        try:
+            return self._ttlByKey[key]
+        except KeyError:
+            pass
+        seconds = None
+        for regex, pattern_ttl in self._ttls:
+            if regex.match(self.cache._key(key)):
+                seconds = pattern_ttl
+                break
+        # Memoized for as many keys as the cache may hold
+        if len(self._ttlByKey) < self.cache.maxEntries:
+            self._ttlByKey[key] = seconds
+        return seconds
+
+    def stats(self):
+        return self.cache.stats()
+
+    def invalidate(self, key=None):
+        self.cache.invalidate(key)
+
+    def disconnect(self):
+        self.cache.invalidate()
+        return self.handler.disconnect()
+
+    def __getattr__(self, method):
+        fetch = getattr(self.handler, method)
+        if method in self.cache.commands:
+            return self.cache.cached(method, fetch, self.ttl)
+        elif self.cache.isWrite(method):
+            return self.cache.invalidating(method, fetch)
+        elif method in ("multi", "pipeline", "watch"):
+            def start(*args, **kwargs):
+                return fetch(*args, **kwargs).addCallback(
+                    lambda conn: _InvalidatingConnection(self.cache, conn))
+            return start
+        return fetch
+
+    def __repr__(self):
+        return "<Redis Near Cache: %r>" % self.handler
+
+
+class CoalescingHandler(object):
+    """
+    Wraps a connection handler so that identical read commands (same
+    method and arguments) issued while one of them is waiting for its
+    reply share that reply instead of going to the server again.
+
+    Only the methods in `commands` are coalesced, by default the read-only
+    ones (see ReadOnlyMethods).
+    """
+    def __init__(self, handler, commands=None):
+        self.handler = handler
+        self.commands = set(ReadOnlyMethods if commands is None else commands)
+
+        self.requests = collections.Counter()
+        self.coalesced = collections.Counter()
+        self._inflight = {}
+
+    @staticmethod
+    def _hashable(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(CoalescingHandler._hashable(v) for v in value)
+        if isinstance(value, dict):
+            return tuple(sorted((k, CoalescingHandler._hashable(v))
+                                for k, v in six.iteritems(value)))
+        return value
+
+    @staticmethod
+    def _copy(reply):
+        # Each caller gets its own mutable reply
+        if isinstance(reply, dict):
+            return dict(reply)
+        if isinstance(reply, list):
+            return list(reply)
+        return reply
+
+    def stats(self):
+        return {
+            "requests": sum(self.requests.values()),
+            "coalesced": sum(self.coalesced.values()),
+            "commands": dict((method, {"requests": self.requests[method],
+                                       "coalesced": self.coalesced[method]})
+                             for method in self.requests),
+        }
+
+    def _call(self, method, fetch, args, kwargs):
+        self.requests[method] += 1
+        try:
+            key = (method, self._hashable(args),
+                   self._hashable(kwargs) if kwargs else ())
+            waiters = self._inflight.get(key)
+        except TypeError:
+            # unhashable arguments
+            return fetch(*args, **kwargs)
+
+        d = defer.Deferred()
+        if waiters is not None:
+            self.coalesced[method] += 1
+            waiters.append(d)
+            return d
+
+        waiters = self._inflight[key] = [d]
+
+        def fan_out(result):
+            del self._inflight[key]
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(self._copy(result))
+
+        try:
+            reply = fetch(*args, **kwargs)
+        except Exception:
+            del self._inflight[key]
+            raise
+        reply.addBoth(fan_out)
+        return d
+
+    def disconnect(self):
+        return self.handler.disconnect()
+
+    def __getattr__(self, method):
+        fetch = getattr(self.handler, method)
+        if method not in self.commands:
+            return fetch
+
+        def wrapper(*args, **kwargs):
+            return self._call(method, fetch, args, kwargs)
+        return wrapper
+
+    def __repr__(self):
+        return "<Redis Coalescing Connection: %r>" % self.handler
+
+
+class BatchingHandler(object):
+    """
+    Wraps a connection handler, sharded or not, so that the `get` and
+    `hget` calls made during one reactor iteration are sent as a single
+    MGET (one per shard) and one HMGET per hash. Batches hold at most
+    `maxBatch` keys or fields.
+
+    Unlike GET, MGET replies None for keys that are not strings, so a
+    batched `get` of a key holding e.g. a hash fires with None instead of
+    failing with WRONGTYPE. Keys requested alone are sent as a GET.
+    """
+    def __init__(self, handler, maxBatch=None):
+        self.handler = handler
+        self.maxBatch = maxBatch
+
+        self.requests = 0
+        self.batches = 0
+
+        self._gets = collections.OrderedDict()
+        self._hgets = collections.OrderedDict()
+        self._flushCall = None
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches}
+
+    def _schedule(self):
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self.flush)
+
+    def get(self, key):
+        d = defer.Deferred()
+        self._gets.setdefault(key, []).append(d)
+        self.requests += 1
+        self._schedule()
+        return d
+
+    def hget(self, key, field):
+        d = defer.Deferred()
+        fields = self._hgets.setdefault(key, collections.OrderedDict())
+        fields.setdefault(field, []).append(d)
+        self.requests += 1
+        self._schedule()
+        return d
+
+    def _chunks(self, items):
+        size = self.maxBatch or len(items) or 1
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def _send(self, fetch, single, waiters):
+        """
+        Request the values of the names of `waiters` with fetch(names),
+        or single(name) for one name. If a batch fails, its names are
+        requested again one by one, so that only the callers of the
+        names that fail get the error.
+        """
+        self.batches += 1
+        names = list(waiters)
+        if len(names) == 1:
+            d = defer.maybeDeferred(single, names[0])
+            d.addCallback(lambda value: [value])
+        else:
+            d = defer.maybeDeferred(fetch, names)
+
+        def deliver(values):
+            for name, value in zip(names, values):
+                for waiter in waiters[name]:
+                    waiter.callback(value)
+
+        def fail(failure):
+            if len(names) > 1:
+                for name in names:
+                    self._send(fetch, single, {name: waiters[name]})
+                return
+            for waiter in waiters[names[0]]:
+                waiter.errback(failure)
+
+        d.addCallbacks(deliver, fail)
+
+    def flush(self):
+        """
+        Send the calls collected so far, without waiting for the end of
+        the reactor iteration.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        gets, self._gets = self._gets, collections.OrderedDict()
+        hgets, self._hgets = self._hgets, collections.OrderedDict()
+
+        for keys in self._chunks(list(gets)):
+            waiters = collections.OrderedDict((k, gets[k]) for k in keys)
+            self._send(self.handler.mget, self.handler.get, waiters)
+        for key, fields in six.iteritems(hgets):
+            for names in self._chunks(list(fields)):
+                waiters = collections.OrderedDict((f, fields[f]) for f in names)
+                self._send(functools.partial(self.handler.hmget, key),
+                           functools.partial(self.handler.hget, key), waiters)
+
+    def disconnect(self):
+        self.flush()
+        return self.handler.disconnect()
+
+    def __getattr__(self, method):
+        return getattr(self.handler, method)
+
+    def __repr__(self):
+        return "<Redis Batching Connection: %r>" % self.handler
+
+
+class BlockingMultiplexer(object):
+    """
+    Wraps a (non sharded) connection handler so that all the `blpop`
+    calls waiting at the same time share a single BLPOP, on one
+    connection of its own, listening on the keys of all of them. When
+    a key gets a value it goes to the oldest caller waiting on that key,
+    and the BLPOP is sent again for the keys still waited on. When a
+    caller waits on a key that is not part of the BLPOP in flight, that
+    one is interrupted with CLIENT UNBLOCK (Redis >= 5.0) from another
+    connection.
+
+    Timeouts are handled on the client side. A value popped for a key
+    whose callers gave up in the meantime is pushed back to the head of
+    its list. If the BLPOP fails (e.g. with WRONGTYPE) every caller
+    waiting gets the error.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+        self.requests = 0
+        self.blpops = 0
+
+        # Callers waiting on each key, oldest first
+        self._waiters = collections.OrderedDict()
+        self._conn = None
+        self._clientId = None
+        self._connecting = None
+        self._inflight = None
+        self._inflightKeys = frozenset()
+        self._unblocking = False
+
+    def stats(self):
+        return {"requests": self.requests, "blpops": self.blpops,
+                "waiting": len(set(w for waiters in self._waiters.values()
+                                   for w in waiters)),
+                "keys": len(self._waiters)}
+
+    def blpop(self, keys, timeout=0):
+        if isinstance(keys, six.string_types):
+            keys = [keys]
+        waiter = _PopWaiter(list(keys), self._cancel)
+        if timeout:
+            waiter.timeoutCall = reactor.callLater(timeout, self._timedOut,
+                                                   waiter)
+        for key in waiter.keys:
+            self._waiters.setdefault(key, collections.deque()).append(waiter)
+        self.requests += 1
+        self._update()
+        return waiter.deferred
+
+    def _forget(self, waiter):
+        for key in waiter.keys:
+            waiters = self._waiters.get(key)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[key]
+        if waiter.timeoutCall is not None and waiter.timeoutCall.active():
+            waiter.timeoutCall.cancel()
+
+    def _timedOut(self, waiter):
+        self._forget(waiter)
+        waiter.deferred.callback(None)
+
+    def _cancel(self, waiter):
+        self._forget(waiter)
+
+    def _update(self):
+        if self._inflight is None:
+            self._issue()
+        elif not set(self._waiters).issubset(self._inflightKeys):
+            self._unblock()
+
+    @defer.inlineCallbacks
+    def _connect(self):
+        factory = self.handler._factory.getBlockingFactory()
+        conn = yield factory.getConnection()
+        try:
+            self._clientId = yield conn.client_id()
+        except Exception:
+            factory.connectionQueue.put(conn)
+            raise
+        self._conn = conn
+
+    def _issue(self):
+        if self._inflight is not None or not self._waiters:
+            return
+        if self._conn is None or not self._conn.connected:
+            self._conn = None
+            if self._connecting is None:
+                self._connecting = self._connect()
+                self._connecting.addBoth(self._connected)
+            return
+
+        self._inflightKeys = frozenset(self._waiters)
+        self._inflight = BaseRedisProtocol.blpop(self._conn,
+                                                 list(self._waiters), 0)
+        self._inflight.addCallbacks(self._popped, self._failed)
+        self.blpops += 1
+
+    def _connected(self, result):
+        self._connecting = None
+        if isinstance(result, Failure):
+            self._failAll(result)
+        else:
+            self._issue()
+
+    def _unblock(self):
+        if self._unblocking:
+            return
+        self._unblocking = True
+        inflight = self._inflight
+
+        def unblocked(count):
+            self._unblocking = False
+            # Sent before the BLPOP got to the server, try again
+            if not count and self._inflight is inflight and \
+                    inflight is not None:
+                reactor.callLater(0.01, self._update)
+
+        def failed(failure):
+            self._unblocking = False
+            log.msg("txredisapi: CLIENT UNBLOCK failed: %s" %
+                    failure.getErrorMessage())
+
+        d = self.handler.client_unblock(self._clientId)
+        d.addCallbacks(unblocked, failed)
+
+    def _popped(self, reply):
+        self._inflight = None
+        if reply is not None:
+            key, value = reply
+            waiters = self._waiters.get(key)
+            if waiters:
+                waiter = waiters[0]
+                self._forget(waiter)
+                waiter.deferred.callback(reply)
+            else:
+                # Nobody waits for it anymore
+                self.handler.lpush(key, value).addErrback(log.err)
+        self._issue()
+
+    def _failed(self, failure):
+        self._inflight = None
+        self._failAll(failure)
+
+    def _failAll(self, failure):
+        waiters = set(w for ws in self._waiters.values() for w in ws)
+        for waiter in waiters:
+            self._forget(waiter)
+            waiter.deferred.errback(failure)
+
+    def disconnect(self):
+        if self._conn is not None:
+            self._conn.factory.connectionQueue.put(self._conn)
+        return self.handler.disconnect()
+
+    def __getattr__(self, method):
+        return getattr(self.handler, method)
+
+    def __repr__(self):
+        return "<Redis Multiplexed BLPOP Connection: %r>" % self.handler
+
+
+class _PopWaiter(object):
+    def __init__(self, keys, cancel):
+        self.keys = keys
+        self.timeoutCall = None
+        self.deferred = defer.Deferred(lambda _: cancel(self))
+
+
+class ReliableQueue(object):
+    """
+    A work queue where claimed jobs are not lost when a worker dies: they
+    stay "in progress" until acknowledged, and jobs not acknowledged
+    within `visibilityTimeout` seconds are put back in the queue by
+    requeue() (see start()).
+
+    Jobs are claimed in batches of up to `batchSize` with a single script
+    call, and the acks made during one reactor iteration are sent
+    together. Every job gets an id when pushed; claim() returns
+    (id, job) pairs and ack() takes ids.
+
+    The queue uses the keys `name` (ids waiting, a list), `name:jobs`
+    (the jobs by id), `name:processing` (ids claimed, by deadline) and
+    `name:seq`. Deadlines use the clock of the server.
+    """
+    PUSH = Script("""
+local id = redis.call('INCRBY', KEYS[3], #ARGV) - #ARGV
+for i = 1, #ARGV do
+    redis.call('HSET', KEYS[2], id + i, ARGV[i])
+    redis.call('RPUSH', KEYS[1], id + i)
+end
+return id + #ARGV
+""")
+    CLAIM = Script("""
+redis.replicate_commands()
+local now = redis.call('TIME')
+local deadline = now[1] + now[2] / 1000000 + ARGV[2]
+local jobs = {}
+for i = 1, tonumber(ARGV[1]) do
+    local id = redis.call('LPOP', KEYS[1])
+    if not id then break end
+    redis.call('ZADD', KEYS[2], deadline, id)
+    jobs[#jobs + 1] = id
+    jobs[#jobs + 1] = redis.call('HGET', KEYS[3], id)
+end
+return jobs
+""")
+    ACK = Script("""
+local acked = 0
+for i = 1, #ARGV do
+    if redis.call('ZREM', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        acked = acked + 1
+    end
+end
+return acked
+""")
+    TOUCH = Script("""
+redis.replicate_commands()
+local now = redis.call('TIME')
+local deadline = now[1] + now[2] / 1000000 + ARGV[1]
+local touched = 0
+for i = 2, #ARGV do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], deadline, ARGV[i])
+        touched = touched + 1
+    end
+end
+return touched
+""")
+    REQUEUE = Script("""
+redis.replicate_commands()
+local now = redis.call('TIME')
+local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf',
+                       now[1] + now[2] / 1000000,
+                       'LIMIT', 0, ARGV[1])
+for i = #ids, 1, -1 do
+    redis.call('ZREM', KEYS[2], ids[i])
+    redis.call('LPUSH', KEYS[1], ids[i])
+end
+return #ids
+""")
+
+    def __init__(self, handler, name, visibilityTimeout=30, batchSize=100):
+        self.handler = handler
+        self.name = name
+        self.visibilityTimeout = visibilityTimeout
+        self.batchSize = batchSize
+        self.keys = [name, "%s:processing" % name, "%s:jobs" % name,
+                     "%s:seq" % name]
+
+        self._acks = []
+        self._ackWaiters = []
+        self._flushCall = None
+        self._requeueCall = None
+
+    def push(self, jobs):
+        """
+        Add jobs to the end of the queue. Returns a Deferred which fires
+        with the id of the last one.
+        """
+        if isinstance(jobs, (six.string_types, six.binary_type)):
+            jobs = [jobs]
+        keys = [self.keys[0], self.keys[2], self.keys[3]]
+        return self.PUSH(self.handler, keys, list(jobs))
+
+    def claim(self, count=None):
+        """
+        Take up to `count` (by default `batchSize`) jobs from the head of
+        the queue. Returns a Deferred which fires with a list of
+        (id, job) pairs, empty if the queue is empty.
+        """
+        d = self.CLAIM(self.handler, self.keys[:3],
+                       [count or self.batchSize, self.visibilityTimeout])
+        return d.addCallback(lambda r: list(zip(r[::2], r[1::2])))
+
+    def ack(self, ids):
+        """
+        Acknowledge claimed jobs, which are then deleted. The acks of one
+        reactor iteration are sent together; the returned Deferred fires
+        once they are done.
+        """
+        if isinstance(ids, (list, tuple, set)):
+            self._acks.extend(ids)
+        else:
+            self._acks.append(ids)
+        d = defer.Deferred()
+        self._ackWaiters.append(d)
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Send the acks collected so far.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        ids, self._acks = self._acks, []
+        waiters, self._ackWaiters = self._ackWaiters, []
+        if not waiters:
+            return
+
+        def done(result):
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+
+        self.ACK(self.handler, self.keys[1:3], ids).addBoth(done)
+
+    def touch(self, ids, timeout=None):
+        """
+        Give claimed jobs `timeout` (by default visibilityTimeout) more
+        seconds to be acknowledged.
+        """
+        if not isinstance(ids, (list, tuple, set)):
+            ids = [ids]
+        args = [timeout or self.visibilityTimeout] + list(ids)
+        return self.TOUCH(self.handler, [self.keys[1]], args)
+
+    def requeue(self, limit=1000):
+        """
+        Put up to `limit` jobs whose visibility timeout expired back at the
+        head of the queue. Returns a Deferred which fires with how many.
+        """
+        return self.REQUEUE(self.handler, self.keys[:2], [limit])
+
+    def start(self, interval=1):
+        """
+        Requeue expired jobs every `interval` seconds.
+        """
+        self._requeueCall = task.LoopingCall(self._requeueAll)
+        self._requeueCall.start(interval, now=False)
+
+    @defer.inlineCallbacks
+    def _requeueAll(self):
+        try:
+            while (yield self.requeue()):
+                pass
+        except Exception as e:
+            log.msg("txredisapi: Could not requeue jobs of %s: %s" %
+                    (self.name, e))
+
+    def stop(self):
+        if self._requeueCall is not None and self._requeueCall.running:
+            self._requeueCall.stop()
+        self._requeueCall = None
+        self.flush()
+
+    @defer.inlineCallbacks
+    def size(self):
+        """
+        Returns a Deferred which fires with the number of jobs waiting and
+        in progress.
+        """
+        waiting = yield self.handler.llen(self.keys[0])
+        processing = yield self.handler.zcard(self.keys[1])
+        return (waiting, processing)
+
+    def __repr__(self):
+        return "<Redis Reliable Queue %s: %r>" % (self.name, self.handler)
+
+
+class StreamConsumer(object):
+    """
+    A worker of the consumer `group` of `stream`. Entries are read with
+    XREADGROUP on a connection of its own (from the blocking pool, see
+    blockingPoolsize), waiting up to `block` milliseconds for new ones,
+    and passed to `process(entry_id, fields)`, which may return a
+    Deferred. At most `window` entries are processed at the same time,
+    and reads ask for no more than `count` of them.
+
+    Entries processed without errors are acknowledged, the acks of one
+    reactor iteration in a single XACK. Entries of the group pending for
+    more than `minIdleTime` milliseconds, e.g. because their consumer
+    died, are claimed with XAUTOCLAIM (Redis >= 6.2) every `claimInterval`
+    seconds and processed again.
+
+    Reads failing with one of `fatalErrors` (e.g. the group or the stream
+    was deleted) stop the consumer, see join(); other failures are
+    retried after a delay growing from `retryDelay` up to `maxRetryDelay`
+    seconds. When its connection is lost, the consumer takes another
+    one, and stops with the ConnectionError if there is none.
+    """
+    fatalErrors = ("NOGROUP", "WRONGTYPE", "NOPERM")
+    retryDelay = 0.1
+    maxRetryDelay = 30
+
+    def __init__(self, handler, stream, group, consumer, process,
+                 count=100, block=1000, window=100, claimInterval=30,
+                 minIdleTime=60000):
+        self.handler = handler
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.process = process
+        self.count = count
+        self.block = block
+        self.window = window
+        self.claimInterval = claimInterval
+        self.minIdleTime = minIdleTime
+
+        self.processed = 0
+        self.failed = 0
+        self.running = False
+        self.error = None
+
+        self._conn = None
+        self._clientId = None
+        self._inflight = set()
+        self._slotWaiters = []
+        self._delay = 0
+        self._sleeping = None
+        self._acks = []
+        self._ackCall = None
+        self._claimCall = None
+        self._loop = None
+
+    def stats(self):
+        return {"processed": self.processed, "failed": self.failed,
+                "inflight": len(self._inflight)}
+
+    @defer.inlineCallbacks
+    def start(self, createGroup=True):
+        """
+        Create the group (reading new entries only) and the stream if
+        needed, and start consuming. Returns a Deferred which fires once
+        the consumer is running.
+        """
+        if createGroup:
+            try:
+                yield self.handler.xgroup_create(self.stream, self.group, "$",
+                                                 mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+        yield self._connect()
+        self.running = True
+        if self.claimInterval:
+            self._claimCall = task.LoopingCall(self.claim)
+            self._claimCall.start(self.claimInterval, now=False)
+        self._loop = self._run()
+
+    @defer.inlineCallbacks
+    def _connect(self):
+        factory = self.handler._factory.getBlockingFactory()
+        conn = yield factory.getConnection()
+        try:
+            self._clientId = yield conn.client_id()
+        except Exception:
+            factory.connectionQueue.put(conn)
+            raise
+        self._conn = conn
+
+    def join(self):
+        """
+        Returns a Deferred which fires once the consumer stopped reading,
+        failing with the error which stopped it, if any.
+        """
+        d = defer.Deferred()
+
+        def finished(result):
+            if self.error is not None:
+                d.errback(self.error)
+            else:
+                d.callback(None)
+            return result
+        self._loop.addBoth(finished)
+        return d
+
+    def _waitForSlot(self):
+        d = defer.Deferred()
+        self._slotWaiters.append(d)
+        return d
+
+    def _freeSlots(self):
+        waiters, self._slotWaiters = self._slotWaiters, []
+        for d in waiters:
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def _run(self):
+        while self.running:
+            if len(self._inflight) >= self.window:
+                yield self._waitForSlot()
+                continue
+            count = min(self.count, self.window - len(self._inflight))
+            try:
+                reply = yield BaseRedisProtocol.xreadgroup(
+                    self._conn, self.group, self.consumer,
+                    {self.stream: ">"}, count=count, block=self.block)
+            except Exception as e:
+                if not self.running:
+                    break
+                if not self._conn.connected:
+                    log.msg("txredisapi: Stream consumer %s lost its "
+                            "connection" % self.consumer)
+                    try:
+                        yield self._connect()
+                    except Exception as e:
+                        log.msg("txredisapi: Stream consumer %s stopped: "
+                                "%s" % (self.consumer, e))
+                        if not isinstance(e, ConnectionError):
+                            e = ConnectionError(str(e))
+                        self.error = e
+                        self.running = False
+                        break
+                    continue
+                if isinstance(e, ResponseError) and \
+                        str(e).startswith(self.fatalErrors):
+                    log.msg("txredisapi: Stream consumer %s stopped: %s" %
+                            (self.consumer, e))
+                    self.error = e
+                    self.running = False
+                    break
+                self._delay = min(self._delay * 2 or self.retryDelay,
+                                  self.maxRetryDelay)
+                log.msg("txredisapi: XREADGROUP failed, retrying in %ss: %s"
+                        % (self._delay, e))
+                self._sleeping = task.deferLater(reactor, self._delay,
+                                                 lambda: None)
+                try:
+                    yield self._sleeping
+                except defer.CancelledError:
+                    pass
+                self._sleeping = None
+                continue
+            self._delay = 0
+            for entry_id, fields in reply.get(self.stream, []):
+                self._dispatch(entry_id, fields)
+
+    def _dispatch(self, entry_id, fields):
+        d = defer.maybeDeferred(self.process, entry_id, fields)
+        self._inflight.add(d)
+
+        def done(result):
+            self._inflight.discard(d)
+            if isinstance(result, Failure):
+                self.failed += 1
+                log.msg("txredisapi: Processing %s failed: %s" %
+                        (entry_id, result.getErrorMessage()))
+            else:
+                self.processed += 1
+                self.ack(entry_id)
+            self._freeSlots()
+        d.addBoth(done)
+
+    def ack(self, entry_id):
+        self._acks.append(entry_id)
+        if self._ackCall is None:
+            self._ackCall = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        Send the acks collected so far.
+        """
+        if self._ackCall is not None:
+            if self._ackCall.active():
+                self._ackCall.cancel()
+            self._ackCall = None
+        ids, self._acks = self._acks, []
+        if not ids:
+            return defer.succeed(0)
+        d = self.handler.xack(self.stream, self.group, *ids)
+        return d.addErrback(log.err)
+
+    @defer.inlineCallbacks
+    def claim(self):
+        """
+        Claim and process the entries of the group idle for more than
+        minIdleTime milliseconds, no more than `window` of them at a time.
+        """
+        start = "0-0"
+        try:
+            while self.running:
+                start, entries = yield self.handler.xautoclaim(
+                    self.stream, self.group, self.consumer,
+                    self.minIdleTime, start, self.count)
+                for entry_id, fields in entries:
+                    # Deleted from the stream while pending
+                    if fields is None:
+                        self.ack(entry_id)
+                        continue
+                    while self.running and \
+                            len(self._inflight) >= self.window:
+                        yield self._waitForSlot()
+                    if not self.running:
+                        break
+                    self._dispatch(entry_id, fields)
+                if start == "0-0":
+                    break
+        except Exception as e:
+            log.msg("txredisapi: XAUTOCLAIM failed: %s" % e)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Stop reading, wait for the entries being processed and send their
+        acks. The connection goes back to its pool.
+        """
+        self.running = False
+        if self._claimCall is not None and self._claimCall.running:
+            self._claimCall.stop()
+        self._freeSlots()
+        if self._sleeping is not None:
+            self._sleeping.cancel()
+        if self._loop is not None:
+            if self._conn.connected:
+                yield self.handler.client_unblock(self._clientId)
+            yield self._loop
+        yield defer.DeferredList(list(self._inflight))
+        yield self.flush()
+        if self._conn is not None and self._conn.connected:
+            self._conn.factory.connectionQueue.put(self._conn)
+        self._conn = None
+
+    def __repr__(self):
+        return "<Redis Stream Consumer %s/%s/%s: %r>" % (
+            self.stream, self.group, self.consumer, self.handler)
+
+
+class DelayedScheduler(object):
+    """
+    Jobs scheduled to be ready at a given time (a UNIX timestamp). They
+    wait in `shards` sorted sets, `name:0`, `name:1`..., scored by due
+    time, and once due are moved atomically, up to `batchSize` per
+    script call, to the list `ready` (or appended to it as entries with
+    a "job" field, with stream=True), where workers take them from.
+
+    Every shard is polled when its next job is due, at least every
+    `maxInterval` seconds, and again right away while full batches are
+    moved. Schedulers of several processes can poll different shards
+    (see start()), and polling the same shard is safe. Due times are
+    stored and compared with the clock of the server, so the clocks of
+    the processes may differ from it.
+    """
+    SCHEDULE = Script("""
+redis.replicate_commands()
+local t = redis.call('TIME')
+return redis.call('ZADD', KEYS[1], t[1] + t[2] / 1000000 + ARGV[1], ARGV[2])
+""")
+
+    MOVE = Script("""
+redis.replicate_commands()
+local t = redis.call('TIME')
+local now = t[1] + t[2] / 1000000
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now,
+                        'LIMIT', 0, ARGV[1])
+for i = 1, #jobs do
+    redis.call('ZREM', KEYS[1], jobs[i])
+    if ARGV[2] == 'stream' then
+        redis.call('XADD', KEYS[2], '*', 'job', jobs[i])
+    else
+        redis.call('RPUSH', KEYS[2], jobs[i])
+    end
+end
+local wait = -1
+local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if first[2] then
+    wait = math.max(first[2] - now, 0)
+end
+return {#jobs, tostring(wait)}
+""")
+
+    def __init__(self, handler, name, ready, shards=1, stream=False,
+                 batchSize=100, maxInterval=1.0):
+        self.handler = handler
+        self.name = name
+        self.ready = ready
+        self.shards = ["%s:%d" % (name, i) for i in range(shards)]
+        self.stream = stream
+        self.batchSize = batchSize
+        self.maxInterval = maxInterval
+
+        self.moved = 0
+        self._polling = None
+        self._calls = {}
+
+    def _shard(self, job):
+        if isinstance(job, six.text_type):
+            job = job.encode("utf-8")
+        elif not isinstance(job, six.binary_type):
+            job = str(job).encode("utf-8")
+        return zlib.crc32(job) % len(self.shards)
+
+    def schedule(self, job, due):
+        """
+        Schedule `job` (a string) to be ready at `due`, a timestamp of
+        the local clock. Scheduling it again changes its due time.
+        """
+        return self.scheduleIn(job, due - time.time())
+
+    def scheduleIn(self, job, delay):
+        """
+        Schedule `job` (a string) to be ready in `delay` seconds, counted
+        by the server from when it gets the command.
+        """
+        shard = self._shard(job)
+        d = self.SCHEDULE(self.handler, [self.shards[shard]], [delay, job])
+        # Poll earlier if it is due before the next poll of its shard
+        call = self._calls.get(shard)
+        if call is not None and call.active():
+            if delay < call.getTime() - reactor.seconds():
+                call.reset(max(delay, 0))
+        return d
+
+    def cancel(self, job):
+        return self.handler.zrem(self.shards[self._shard(job)], job)
+
+    def move(self, shard):
+        """
+        Move the due jobs of a shard, up to batchSize. Returns a Deferred
+        which fires with how many were moved and the seconds until the
+        next job of the shard is due (None if there are none).
+        """
+        d = self.MOVE(self.handler, [self.shards[shard], self.ready],
+                      [self.batchSize, "stream" if self.stream else "list"])
+
+        def moved(reply):
+            count, wait = int(reply[0]), float(reply[1])
+            self.moved += count
+            return count, (None if wait < 0 else wait)
+        return d.addCallback(moved)
+
+    def start(self, shards=None):
+        """
+        Start polling the given shards (indexes), all of them by default.
+        """
+        if shards is None:
+            shards = range(len(self.shards))
+        self._polling = set(shards)
+        for shard in self._polling:
+            self._calls[shard] = reactor.callLater(0, self._poll, shard)
+
+    def _poll(self, shard):
+        def next_poll(result):
+            if isinstance(result, Failure):
+                log.msg("txredisapi: Could not move jobs of %s: %s" %
+                        (self.shards[shard], result.getErrorMessage()))
+                delay = self.maxInterval
+            else:
+                count, wait = result
+                if count >= self.batchSize:
+                    delay = 0
+                elif wait is None:
+                    delay = self.maxInterval
+                else:
+                    delay = min(wait, self.maxInterval)
+            if self._polling and shard in self._polling:
+                self._calls[shard] = reactor.callLater(delay, self._poll,
+                                                       shard)
+        self.move(shard).addBoth(next_poll)
+
+    def stop(self):
+        self._polling = None
+        for call in self._calls.values():
+            if call.active():
+                call.cancel()
+        self._calls = {}
+
+    def __repr__(self):
+        return "<Redis Delayed Scheduler %s: %r>" % (self.name, self.handler)
+
+
+def makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
+                   charset, password, ssl_context_factory, connectTimeout,
+                   replyTimeout, convertNumbers, **kwargs):
+    uuid = "%s:%d" % (host, port)
+    factory = RedisFactory(uuid, dbid, poolsize, isLazy, ConnectionHandler,
+                           charset, password, replyTimeout, convertNumbers,
+                           **kwargs)
+    factory.continueTrying = reconnect
+    if ssl_context_factory is True:
+        ssl_context_factory = ssl.ClientContextFactory()
+
+    def connect(factory):
+        if ssl_context_factory:
+            reactor.connectSSL(host, port, factory, ssl_context_factory,
+                               connectTimeout)
+        else:
+            reactor.connectTCP(host, port, factory, connectTimeout)
+
+    factory.openConnection = connect
+    if factory.clientCache is not None:
+        factory.clientCache.attach(factory, connect)
+    for x in range(poolsize):
+        connect(factory)
+
+    if isLazy:
+        return factory.handler
+    else:
+        return factory.deferred
+
+
+def makeShardedConnection(hosts, dbid, poolsize, reconnect, isLazy,
+                          charset, password, ssl_context_factory,
+                          connectTimeout, replyTimeout, convertNumbers,
+                          **kwargs):
+    err = "Please use a list or tuple of host:port for sharded connections"
+    if not isinstance(hosts, (list, tuple)):
+        raise ValueError(err)
+
+    connections = []
+    for item in hosts:
+        try:
+            host, port = item.split(":")
+            port = int(port)
+        except:
+            raise ValueError(err)
+
+        c = makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
+                           charset, password, ssl_context_factory,
+                           connectTimeout, replyTimeout, convertNumbers,
+                           **kwargs)
+        connections.append(c)
+
+    if isLazy:
+        return ShardedConnectionHandler(connections)
+    else:
+        deferred = defer.DeferredList(connections)
+        ShardedConnectionHandler(deferred)
+        return deferred
+
+
+# The options of RedisFactory after convertNumbers (healthCheckInterval,
+# maxInFlight, maxWaiters, clientName, clientCache, blockingPoolsize,
+# metrics and healthCheckTimeout) are given to the functions below by keyword.
+
+def Connection(host="localhost", port=6379, dbid=None, reconnect=True,
+               charset="utf-8", password=None,
+               ssl_context_factory: Union[ssl.ClientContextFactory,
+                                          bool] = False,
+               connectTimeout=None, replyTimeout=None, convertNumbers=True,
+               **kwargs):
+    return makeConnection(host, port, dbid, 1, reconnect, False,
+                          charset, password, ssl_context_factory,
+                          connectTimeout, replyTimeout, convertNumbers,
+                          **kwargs)
+
+
+def lazyConnection(host="localhost", port=6379, dbid=None, reconnect=True,
+                   charset="utf-8", password=None,
+                   ssl_context_factory: Union[ssl.ClientContextFactory,
+                                              bool] = False,
+                   connectTimeout=None, replyTimeout=None,
+                   convertNumbers=True, **kwargs):
+    return makeConnection(host, port, dbid, 1, reconnect, True,
+                          charset, password, ssl_context_factory,
+                          connectTimeout, replyTimeout, convertNumbers,
+                          **kwargs)
+
+
+def ConnectionPool(host="localhost", port=6379, dbid=None,
+                   poolsize=10, reconnect=True, charset="utf-8",
+                   password=None,
+                   ssl_context_factory: Union[ssl.ClientContextFactory,
+                                              bool] = False,
+                   connectTimeout=None, replyTimeout=None,
+                   convertNumbers=True, **kwargs):
+    return makeConnection(host, port, dbid, poolsize, reconnect, False,
+                          charset, password, ssl_context_factory,
+                          connectTimeout, replyTimeout, convertNumbers,
+                          **kwargs)
+
+
+def lazyConnectionPool(host="localhost", port=6379, dbid=None,
+                       poolsize=10, reconnect=True, charset="utf-8",
+                       password=None,
+                       ssl_context_factory: Union[ssl.ClientContextFactory,
+                                                  bool] = False,
+                       connectTimeout=None, replyTimeout=None,
+                       convertNumbers=True, **kwargs):
+    return makeConnection(host, port, dbid, poolsize, reconnect, True,
+                          charset, password, ssl_context_factory,
+                          connectTimeout, replyTimeout, convertNumbers,
+                          **kwargs)
+
+
+def ShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
+                      password=None,
+                      ssl_context_factory: Union[ssl.ClientContextFactory,
+                                                 bool] = False,
+                      connectTimeout=None, replyTimeout=None,
+                      convertNumbers=True, **kwargs):
+    return makeShardedConnection(hosts, dbid, 1, reconnect, False,
+                                 charset, password, ssl_context_factory,
+                                 connectTimeout, replyTimeout,
+                                 convertNumbers, **kwargs)
+
+
+def lazyShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
+                          password=None,
+                          ssl_context_factory: Union[
+                              ssl.ClientContextFactory, bool] = False,
+                          connectTimeout=None, replyTimeout=None,
+                          convertNumbers=True, **kwargs):
+    return makeShardedConnection(hosts, dbid, 1, reconnect, True,
+                                 charset, password, ssl_context_factory,
+                                 connectTimeout, replyTimeout,
+                                 convertNumbers, **kwargs)
+
+
+def ShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
+                          charset="utf-8", password=None,
+                          ssl_context_factory: Union[
+                              ssl.ClientContextFactory, bool] = False,
+                          connectTimeout=None, replyTimeout=None,
+                          convertNumbers=True, **kwargs):
+    return makeShardedConnection(hosts, dbid, poolsize, reconnect, False,
+                                 charset, password, ssl_context_factory,
+                                 connectTimeout, replyTimeout,
+                                 convertNumbers, **kwargs)
+
+
+def lazyShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
+                              charset="utf-8", password=None,
+                              ssl_context_factory: Union[
+                                  ssl.ClientContextFactory, bool] = False,
+                              connectTimeout=None, replyTimeout=None,
+                              convertNumbers=True, **kwargs):
+    return makeShardedConnection(hosts, dbid, poolsize, reconnect, True,
+                                 charset, password, ssl_context_factory,
+                                 connectTimeout, replyTimeout,
+                                 convertNumbers, **kwargs)
+
+
+def makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
+                       charset, password, connectTimeout, replyTimeout,
+                       convertNumbers, **kwargs):
+    factory = RedisFactory(path, dbid, poolsize, isLazy, UnixConnectionHandler,
+                           charset, password, replyTimeout, convertNumbers,
+                           **kwargs)
+    factory.continueTrying = reconnect
+    factory.openConnection = lambda f: reactor.connectUNIX(
+        path, f, connectTimeout)
+    if factory.clientCache is not None:
+        factory.clientCache.attach(factory, factory.openConnection)
+    for x in range(poolsize):
+        reactor.connectUNIX(path, factory, connectTimeout)
+
+    if isLazy:
+        return factory.handler
+    else:
+        return factory.deferred
+
+
+def makeShardedUnixConnection(paths, dbid, poolsize, reconnect, isLazy,
+                              charset, password, connectTimeout, replyTimeout,
+                              convertNumbers, **kwargs):
+    err = "Please use a list or tuple of paths for sharded unix connections"
+    if not isinstance(paths, (list, tuple)):
+        raise ValueError(err)
+
+    connections = []
+    for path in paths:
+        c = makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
+                               charset, password, connectTimeout, replyTimeout,
+                               convertNumbers, **kwargs)
+        connections.append(c)
+
+    if isLazy:
+        return ShardedUnixConnectionHandler(connections)
+    else:
+        deferred = defer.DeferredList(connections)
+        ShardedUnixConnectionHandler(deferred)
+        return deferred
+
+
+def UnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
+                   charset="utf-8", password=None,
+                   connectTimeout=None, replyTimeout=None, convertNumbers=True,
+                   **kwargs):
+    return makeUnixConnection(path, dbid, 1, reconnect, False,
+                              charset, password, connectTimeout, replyTimeout,
+                              convertNumbers, **kwargs)
+
+
+def lazyUnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
+                       charset="utf-8", password=None,
+                       connectTimeout=None, replyTimeout=None,
+                       convertNumbers=True, **kwargs):
+    return makeUnixConnection(path, dbid, 1, reconnect, True,
+                              charset, password, connectTimeout, replyTimeout,
+                              convertNumbers, **kwargs)
+
+
+def UnixConnectionPool(path="/tmp/redis.sock", dbid=None, poolsize=10,
+                       reconnect=True, charset="utf-8", password=None,
+                       connectTimeout=None, replyTimeout=None,
+                       convertNumbers=True, **kwargs):
+    return makeUnixConnection(path, dbid, poolsize, reconnect, False,
+                              charset, password, connectTimeout, replyTimeout,
+                              convertNumbers, **kwargs)
 
 
 def lazyUnixConnectionPool(path="/tmp/redis.sock", dbid=None, poolsize=10,
                            reconnect=True, charset="utf-8", password=None,
                            connectTimeout=None, replyTimeout=None,
-                           convertNumbers=True):
+                           convertNumbers=True, **kwargs):
     return makeUnixConnection(path, dbid, poolsize, reconnect, True,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+                              convertNumbers, **kwargs)
 
 
 def ShardedUnixConnection(paths, dbid=None, reconnect=True, charset="utf-8",
-                          password=None, connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
+                          password=None, connectTimeout=None,
+                          replyTimeout=None, convertNumbers=True, **kwargs):
     return makeShardedUnixConnection(paths, dbid, 1, reconnect, False,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers, **kwargs)
 
 
 def lazyShardedUnixConnection(paths, dbid=None, reconnect=True,
                               charset="utf-8", password=None,
                               connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
+                              convertNumbers=True, **kwargs):
     return makeShardedUnixConnection(paths, dbid, 1, reconnect, True,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers, **kwargs)
 
 
 def ShardedUnixConnectionPool(paths, dbid=None, poolsize=10, reconnect=True,
                               charset="utf-8", password=None,
                               connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
+                              convertNumbers=True, **kwargs):
     return makeShardedUnixConnection(paths, dbid, poolsize, reconnect, False,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers, **kwargs)
 
 
 def lazyShardedUnixConnectionPool(paths, dbid=None, poolsize=10,
                                   reconnect=True, charset="utf-8",
                                   password=None, connectTimeout=None,
-                                  replyTimeout=None, convertNumbers=True):
+                                  replyTimeout=None, convertNumbers=True,
+                                  **kwargs):
     return makeShardedUnixConnection(paths, dbid, poolsize, reconnect, True,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers, **kwargs)
 
 
 class MasterNotFoundError(ConnectionError):
@@ -2614,19 +6542,53 @@ class SentinelRedisProtocol(RedisProtocol):
 
     def connectionMade(self):
         self.factory.resetDelay()
+        return RedisProtocol.connectionMade(self)
+
+    def _handshake_commands(self):
+        commands = RedisProtocol._handshake_commands(self)
+        commands.append((("ROLE",), "could not get role"))
+        return commands
+
+    def _handshake_check(self, replies):
+        role = replies[-1]
+        connector = self.transport.connector
+        if self.factory.is_master and not connector.standby and \
+                role[0] != "master":
+            self.factory.sentinel_manager.forget_master(
+                self.factory.service_name,
+                (self.transport.connector.host, self.transport.connector.port))
+            self.transport.loseConnection()
+            return False
+        self.factory.resetDelay()
+        return True
 
-        def check_role(role):
-            if self.factory.is_master and role[0] != "master":
-                self.transport.loseConnection()
-                return defer.succeed(None)
-            else:
-                self.factory.resetDelay()
-                return RedisProtocol.connectionMade(self)
 
-        if self.password is not None:
-            self.auth(self.password)
+class SentinelConnector(Connector):
+    """
+    Connector that ignores connect() calls unless it is disconnected, so
+    that a failover can reconnect it right away without clashing with an
+    already scheduled retry. Retired connectors never connect again.
+    """
+    standby = False
+    retired = False
 
-        return self.role().addCallback(check_role)
+    def connect(self):
+        if self.state == "disconnected" and not self.retired:
+            Connector.connect(self)
+
+    def retire(self):
+        self.retired = True
+        if self.state == "connecting":
+            self.stopConnecting()
+        elif self.state == "connected":
+            self.disconnect()
+
+
+class SentinelConnectionHandler(ConnectionHandler):
+    def disconnect(self):
+        standby = self._factory.stopStandby()
+        return defer.gatherResults([ConnectionHandler.disconnect(self),
+                                    standby], consumeErrors=True)
 
 
 class SentinelConnectionFactory(RedisFactory):
@@ -2635,6 +6597,7 @@ class SentinelConnectionFactory(RedisFactory):
     protocol = SentinelRedisProtocol
 
     def __init__(self, sentinel_manager, service_name, is_master, *args, **kwargs):
+        kwargs.setdefault("handler", SentinelConnectionHandler)
         RedisFactory.__init__(self, *args, **kwargs)
 
         self.sentinel_manager = sentinel_manager
@@ -2643,13 +6606,165 @@ class SentinelConnectionFactory(RedisFactory):
 
         self._current_master_addr = None
         self._slave_no = 0
+        self.connectors = []
+
+        # Warm standby connections to replicas, by address
+        self.standby = {}
+        self.standbyConnectors = {}
+        self.standbyPoolsize = 0
+        self.standbyReplicas = 1
+        self.promoted = []
+        self._standbyRefreshCall = None
 
     def clientConnectionFailed(self, connector, reason):
+        if connector.retired:
+            return
+        if connector.standby:
+            self.retry(connector)
+            return
+        if self.is_master:
+            self.sentinel_manager.forget_master(
+                self.service_name, (connector.host, connector.port))
         self.try_to_connect(connector)
 
     def clientConnectionLost(self, connector, unused_reason):
+        if connector.retired:
+            return
+        if connector.standby:
+            self.retry(connector)
+            return
         self.try_to_connect(connector, nodelay=True)
 
+    def addConnection(self, conn):
+        connector = conn.transport.connector
+        if connector.standby:
+            if self.disconnectCalled:
+                conn.transport.loseConnection()
+                return
+            addr = (connector.host, connector.port)
+            self.standby.setdefault(addr, []).append(conn)
+            conn.whenDisconnected().addCallback(self._forgetStandby)
+            return
+
+        if self.promoted and connector in self.connectors:
+            # A regular connection replaces a promoted standby one
+            self._retireConnection(self.promoted.pop(0))
+        RedisFactory.addConnection(self, conn)
+
+    def _dropConnections(self):
+        for conn in list(self.pool):
+            # Not handed out anymore while being closed
+            try:
+                self.connectionQueue.remove(conn)
+            except ValueError:
+                pass
+            conn.transport.loseConnection()
+
+    def _forgetStandby(self, conn):
+        for conns in self.standby.values():
+            if conn in conns:
+                conns.remove(conn)
+        if conn in self.promoted:
+            self.promoted.remove(conn)
+
+    def _retireConnection(self, conn):
+        # Closes the connection once the replies in flight are received
+        try:
+            self.connectionQueue.remove(conn)
+        except ValueError:
+            pass
+        pending = list(conn.replyQueue.waiting)
+        defer.DeferredList(pending).addCallback(
+            lambda _: conn.transport.loseConnection())
+
+    def startStandby(self, poolsize, replicas=1, refresh_interval=30):
+        """
+        Keep `poolsize` authenticated connections to each of the `replicas`
+        replicas Sentinel would promote first. When one of them becomes the
+        master its connections are moved to the pool right away, and are
+        replaced by regular connections as those get reestablished.
+        """
+        self.standbyPoolsize = poolsize
+        self.standbyReplicas = replicas
+        self._standbyRefreshCall = task.LoopingCall(self.refreshStandby)
+        self._standbyRefreshCall.start(refresh_interval)
+
+    @staticmethod
+    def _promotionOrder(replica):
+        # The order Sentinel picks the replica to promote in
+        return (int(replica.get("slave-priority", 100)),
+                -int(replica.get("slave-repl-offset", 0)),
+                replica.get("run-id", ""))
+
+    def refreshStandby(self):
+        def on_replicas(replicas):
+            if self.disconnectCalled:
+                return
+            replicas = [
+                r for r in replicas
+                if r.get("master-link-status", "ok") == "ok" and
+                int(r.get("slave-priority", 100)) != 0 and
+                (r["ip"], int(r["port"])) != self._current_master_addr
+            ]
+            replicas.sort(key=self._promotionOrder)
+            addrs = set((r["ip"], int(r["port"]))
+                        for r in replicas[:self.standbyReplicas])
+
+            for addr in set(self.standbyConnectors) - addrs:
+                for connector in self.standbyConnectors.pop(addr):
+                    connector.retire()
+            for addr in addrs - set(self.standbyConnectors):
+                connectors = []
+                for _ in range(self.standbyPoolsize):
+                    connector = SentinelConnector(addr[0], addr[1], self,
+                                                  self.maxDelay, None, reactor)
+                    connector.standby = True
+                    connector.connect()
+                    connectors.append(connector)
+                self.standbyConnectors[addr] = connectors
+
+        def on_error(failure):
+            log.msg("txredisapi: Can't refresh standby replicas of {0}: {1}"
+                    .format(self.service_name, failure.getErrorMessage()))
+
+        return self.sentinel_manager.discover_replicas(self.service_name) \
+            .addCallbacks(on_replicas, on_error)
+
+    def promoteStandby(self, addr):
+        """
+        Moves the standby connections to `addr`, the new master, to the pool.
+        """
+        connectors = self.standbyConnectors.pop(addr, [])
+        conns = self.standby.pop(addr, [])
+        for connector in connectors:
+            connector.standby = False
+            if connector.state != "connected":
+                connector.retire()
+            else:
+                # Not reconnected when lost, regular connectors take over
+                connector.retired = True
+        for conn in conns:
+            if conn.connected:
+                self.promoted.append(conn)
+                RedisFactory.addConnection(self, conn)
+        if self._standbyRefreshCall is not None:
+            self.refreshStandby()
+        return len(conns)
+
+    def stopStandby(self):
+        if self._standbyRefreshCall is not None:
+            if self._standbyRefreshCall.running:
+                self._standbyRefreshCall.stop()
+            self._standbyRefreshCall = None
+        waiting = []
+        for addr, connectors in self.standbyConnectors.items():
+            waiting.extend(conn.whenDisconnected()
+                           for conn in self.standby.get(addr, []))
+            for connector in connectors:
+                connector.retire()
+        self.standbyConnectors = {}
+        return defer.DeferredList(waiting)
+
     def try_to_connect(self, connector, force_master=False, nodelay=False):
         if not self.continueTrying:
             return
@@ -2661,14 +6776,16 @@ class SentinelConnectionFactory(RedisFactory):
             self.resetDelay()
 
         def on_master_addr(addr):
-            if self._current_master_addr is not None and \
-               self._current_master_addr != addr:
+            changed = self._current_master_addr is not None and \
+                self._current_master_addr != addr
+            if changed:
                 self.resetDelay()
                 # master has changed, dropping all alive connections
-                for conn in self.pool:
-                    conn.transport.loseConnection()
+                self._dropConnections()
 
             self._current_master_addr = addr
+            if changed:
+                self.promoteStandby(addr)
             connector.host, connector.port = addr
             if nodelay:
                 connector.connect()
@@ -2694,12 +6811,335 @@ class SentinelConnectionFactory(RedisFactory):
             self.sentinel_manager.discover_slaves(self.service_name) \
                 .addCallback(on_slave_addrs)
 
+    def master_switched(self, addr):
+        """
+        Called by Sentinel when a failover to `addr` has been announced.
+        """
+        if not self.continueTrying:
+            return
+
+        if not self.is_master:
+            # promoted replica is not a replica anymore
+            for conn in list(self.pool):
+                peer = conn.transport.getPeer()
+                if (peer.host, peer.port) == addr:
+                    conn.transport.loseConnection()
+            return
+
+        if self._current_master_addr == addr:
+            return
+        self._current_master_addr = addr
+        self.resetDelay()
+        self._dropConnections()
+        self.promoteStandby(addr)
+        for connector in self.connectors:
+            if connector.state == "connecting":
+                connector.stopConnecting()
+            if connector.state == "disconnected":
+                connector.host, connector.port = addr
+                connector.connect()
+
+
+ReadOnlyMethods = frozenset([
+    "bitcount",
+    "dbsize",
+    "exists",
+    "fcall_ro",
+    "get",
+    "getbit",
+    "hexists",
+    "hget",
+    "hgetall",
+    "hkeys",
+    "hlen",
+    "hmget",
+    "hscan",
+    "hvals",
+    "keys",
+    "lindex",
+    "llen",
+    "lrange",
+    "mget",
+    "pfcount",
+    "randomkey",
+    "scan",
+    "scard",
+    "sdiff",
+    "sinter",
+    "sismember",
+    "smembers",
+    "srandmember",
+    "sscan",
+    "sunion",
+    "ttl",
+    "type",
+    "zcard",
+    "zcount",
+    "zrange",
+    "zrangebyscore",
+    "zrank",
+    "zrevrange",
+    "zrevrangebyscore",
+    "zrevrank",
+    "zscan",
+    "zscore",
+])
+
+
+# Commands writing keys, with the arguments holding the keys they write,
+# as (position, name): a key, a list of keys or a mapping of keys to
+# values, or all the positional arguments from position on when name is
+# None. None for commands writing every key.
+_KEY = ((0, "key"),)
+_KEYS = ((0, "keys"), (1, None))
+_DSTKEY = ((0, "dstkey"),)
+_SCRIPT_KEYS = ((1, "keys"),)
+WriteMethods = {
+    "append": _KEY,
+    "bitop": ((1, "destkey"),),
+    "blpop": ((0, "keys"),),
+    "brpop": ((0, "keys"),),
+    "brpoplpush": ((0, "source"), (1, "destination")),
+    "decr": _KEY,
+    "decrby": _KEY,
+    "delete": _KEYS,
+    "eval": _SCRIPT_KEYS,
+    "evalsha": _SCRIPT_KEYS,
+    "expire": _KEY,
+    "fcall": _SCRIPT_KEYS,
+    "flush": None,
+    "flushall": None,
+    "flushdb": None,
+    "getdel": _KEY,
+    "getset": _KEY,
+    "hdecr": _KEY,
+    "hdel": _KEY,
+    "hincr": _KEY,
+    "hincrby": _KEY,
+    "hincrbyfloat": _KEY,
+    "hmset": _KEY,
+    "hset": _KEY,
+    "hsetnx": _KEY,
+    "incr": _KEY,
+    "incrby": _KEY,
+    "incrbyfloat": _KEY,
+    "lpop": _KEY,
+    "lpush": _KEY,
+    "lrem": _KEY,
+    "lset": _KEY,
+    "ltrim": _KEY,
+    "move": _KEY,
+    "mset": ((0, "mapping"),),
+    "msetnx": ((0, "mapping"),),
+    "persist": _KEY,
+    "pfadd": _KEY,
+    "pfmerge": ((0, "destKey"),),
+    "pop": _KEY,
+    "psetex": _KEY,
+    "push": _KEY,
+    "rename": ((0, "oldkey"), (1, "newkey")),
+    "renamenx": ((0, "oldkey"), (1, "newkey")),
+    "rpop": _KEY,
+    "rpoplpush": ((0, "srckey"), (1, "dstkey")),
+    "rpush": _KEY,
+    "run_script": _SCRIPT_KEYS,
+    "sadd": _KEY,
+    "sdiffstore": _DSTKEY,
+    "set": _KEY,
+    "setbit": _KEY,
+    "setex": _KEY,
+    "setnx": _KEY,
+    "setrange": _KEY,
+    "sinterstore": _DSTKEY,
+    "smove": ((0, "srckey"), (1, "dstkey")),
+    "sort": ((7, "store"),),
+    "spop": _KEY,
+    "srem": _KEY,
+    "sunionstore": _DSTKEY,
+    "unlink": _KEYS,
+    "xadd": _KEY,
+    "xdel": _KEY,
+    "xtrim": _KEY,
+    "zadd": _KEY,
+    "zdecr": _KEY,
+    "zincr": _KEY,
+    "zincrby": _KEY,
+    "zinterstore": _DSTKEY,
+    "zrem": _KEY,
+    "zremrangebyrank": _KEY,
+    "zremrangebyscore": _KEY,
+    "zunionstore": _DSTKEY,
+}
+
+
+def _written_keys(method, args, kwargs):
+    """
+    The keys written by a call of the command `method` (see
+    WriteMethods), or None if it may write any key.
+    """
+    spec = WriteMethods[method]
+    if spec is None:
+        return None
+    values = []
+    for position, name in spec:
+        if name is None:
+            values.extend(args[position:])
+        elif position < len(args):
+            values.append(args[position])
+        elif name in kwargs:
+            values.append(kwargs[name])
+
+    keys = []
+    for value in values:
+        if isinstance(value, dict):
+            keys.extend(value)
+        elif isinstance(value, (list, tuple)):
+            keys.extend(value)
+        elif value is not None:
+            keys.append(value)
+    return keys
+
+
+class ReplicaRoutingHandler(object):
+    """
+    Connection handler that sends read-only commands (see ReadOnlyMethods)
+    to the replica with the lowest measured round trip time, and everything
+    else to the master. Reads go to the master when no replica is healthy.
+
+    Use Sentinel.replica_routing_for() to create it.
+    """
+
+    def __init__(self, sentinel_manager, service_name, master,
+                 replica_factory, refresh_interval=30,
+                 check_replication=True, max_replication_lag=None):
+        self.sentinel_manager = sentinel_manager
+        self.service_name = service_name
+        self.master = master
+        self.replicas = {}
+
+        self._replica_factory = replica_factory
+        self.check_replication = check_replication
+        self.max_replication_lag = max_replication_lag
+
+        self._refresh_call = task.LoopingCall(self.refresh)
+        self._refresh_call.start(refresh_interval)
+
+    def _usable_replicas(self, replicas):
+        if self.check_replication:
+            replicas = [
+                r for r in replicas
+                if r.get("master-link-status", "ok") == "ok" and
+                not r["is_master_down"]
+            ]
+        if self.max_replication_lag is not None and replicas:
+            offsets = [int(r.get("slave-repl-offset", 0)) for r in replicas]
+            newest = max(offsets)
+            replicas = [
+                r for r, offset in zip(replicas, offsets)
+                if newest - offset <= self.max_replication_lag
+            ]
+        return set((r["ip"], int(r["port"])) for r in replicas)
+
+    def refresh(self):
+        """
+        Ask Sentinel for the current replicas, connecting to new ones and
+        dropping those that went away or fell behind.
+        """
+        def on_replicas(replicas):
+            addrs = self._usable_replicas(replicas)
+            for addr in set(self.replicas) - addrs:
+                self.replicas.pop(addr).disconnect()
+            for addr in addrs - set(self.replicas):
+                self.replicas[addr] = self._replica_factory(*addr)
+
+        def on_error(failure):
+            log.msg("txredisapi: Can't refresh replicas of {0}: {1}".format(
+                self.service_name, failure.getErrorMessage()))
+
+        return self.sentinel_manager.discover_replicas(self.service_name) \
+            .addCallbacks(on_replicas, on_error)
+
+    @staticmethod
+    def _replica_rtt(replica):
+        rtts = [conn.rtt for conn in replica._factory.pool
+                if conn.connected and conn.healthy]
+        if not rtts:
+            return None
+        # Connections not measured yet are assumed to be slow
+        return min(float("inf") if rtt is None else rtt for rtt in rtts)
+
+    def select_replica(self):
+        """
+        Returns the handler of the fastest healthy replica or None.
+        """
+        best, best_rtt = None, None
+        for replica in self.replicas.values():
+            rtt = self._replica_rtt(replica)
+            if rtt is not None and (best is None or rtt < best_rtt):
+                best, best_rtt = replica, rtt
+        return best
+
+    def master_switched(self, addr):
+        # The promoted replica will be dropped by the refresh
+        self.refresh()
+
+    def disconnect(self):
+        if self._refresh_call.running:
+            self._refresh_call.stop()
+        handlers = [self.master] + list(self.replicas.values())
+        self.replicas = {}
+        return defer.gatherResults([h.disconnect() for h in handlers],
+                                   consumeErrors=True)
+
+    def __getattr__(self, method):
+        handler = None
+        if method in ReadOnlyMethods:
+            handler = self.select_replica()
+        return getattr(handler or self.master, method)
+
+    def __repr__(self):
+        return "<Redis Replica Routing Connection: %s - %d replica(s)>" % \
+               (self.service_name, len(self.replicas))
+
+
+class SentinelEventProtocol(SubscriberProtocol):
+    """
+    Subscribes to Sentinel's failover related events and passes them
+    to the Sentinel object.
+    """
+    channels = ["+switch-master", "+sdown", "+odown"]
+
+    def connectionMade(self):
+        d = SubscriberProtocol.connectionMade(self)
+
+        def subscribe(_):
+            if self.connected:
+                return self.subscribe(self.channels)
+        d.addCallback(subscribe)
+        return d
+
+    def messageReceived(self, pattern, channel, message):
+        self.factory.sentinel_manager.handle_event(channel, message)
+
+
+class SentinelEventFactory(SubscriberFactory):
+    maxDelay = 5
+    initialDelay = 0.1
+    protocol = SentinelEventProtocol
+
+    def __init__(self, sentinel_manager, password=None):
+        SubscriberFactory.__init__(self, isLazy=True)
+        self.sentinel_manager = sentinel_manager
+        self.password = password
+        self.continueTrying = True
+
 
 class Sentinel(object):
 
     discovery_timeout = 10
 
-    def __init__(self, sentinel_addresses, min_other_sentinels=0, **connection_kwargs):
+    def __init__(self, sentinel_addresses, min_other_sentinels=0,
+                 watch_failover=False, **connection_kwargs):
         self.sentinels = [
             lazyConnection(host, port, **connection_kwargs)
             for host, port in sentinel_addresses
@@ -2707,9 +7147,61 @@ class Sentinel(object):
 
         self.min_other_sentinels = min_other_sentinels
 
+        # Factories and handlers to notify about failovers
+        self._listeners = []
+        # Master addresses by service name, kept up to date by events
+        self._masters = {}
+
+        self.watch_failover = watch_failover
+        self._event_handlers = []
+        if watch_failover:
+            for host, port in sentinel_addresses:
+                factory = SentinelEventFactory(
+                    self, password=connection_kwargs.get("password"))
+                reactor.connectTCP(host, port, factory)
+                self._event_handlers.append(factory.handler)
+
     def disconnect(self):
-        return defer.gatherResults([sentinel.disconnect() for sentinel in self.sentinels],
-                                   consumeErrors = True)
+        handlers = self.sentinels + self._event_handlers
+        return defer.gatherResults([handler.disconnect()
+                                    for handler in handlers],
+                                   consumeErrors=True)
+
+    def handle_event(self, channel, message):
+        """
+        Handles +switch-master, +sdown and +odown events published by
+        Sentinels. Several Sentinels announce the same event, so this must
+        be idempotent.
+        """
+        if isinstance(message, six.binary_type):
+            message = message.decode()
+        if isinstance(channel, six.binary_type):
+            channel = channel.decode()
+        parts = message.split()
+
+        if channel == "+switch-master" and len(parts) >= 5:
+            # <name> <old ip> <old port> <new ip> <new port>
+            service_name, addr = parts[0], (parts[3], int(parts[4]))
+            log.msg("txredisapi: Sentinel announced failover of {0} to "
+                    "{1}:{2}".format(service_name, *addr))
+            self._masters[service_name] = addr
+            for listener in list(self._listeners):
+                if listener.service_name == service_name:
+                    listener.master_switched(addr)
+
+        elif channel in ("+sdown", "+odown") and len(parts) >= 4 and \
+                parts[0] == "master":
+            # master <name> <ip> <port> [...]
+            self.forget_master(parts[1], (parts[2], int(parts[3])))
+
+    def forget_master(self, service_name, addr=None):
+        """
+        Drop the cached master address of the service, if it is `addr`
+        (or whatever it is, if `addr` is not given).
+        """
+        cached = self._masters.get(service_name)
+        if cached is not None and (addr is None or cached == addr):
+            del self._masters[service_name]
 
     def check_master_state(self, state):
         if not state["is_master"] or state["is_sdown"] or state["is_odown"]:
@@ -2721,6 +7213,9 @@ class Sentinel(object):
         return True
 
     def discover_master(self, service_name):
+        if self.watch_failover and service_name in self._masters:
+            return defer.succeed(self._masters[service_name])
+
         result = defer.Deferred()
 
         def on_response(response):
@@ -2729,7 +7224,10 @@ class Sentinel(object):
 
             state = response.get(service_name)
             if state and self.check_master_state(state):
-                result.callback((state["ip"], int(state["port"])))
+                addr = (state["ip"], int(state["port"]))
+                if self.watch_failover:
+                    self._masters[service_name] = addr
+                result.callback(addr)
                 timeout_call.cancel()
 
         def on_timeout():
@@ -2755,13 +7253,24 @@ class Sentinel(object):
         ]
 
     def discover_slaves(self, service_name):
+        return self.discover_replicas(service_name).addCallback(
+            self.filter_slaves)
+
+    def discover_replicas(self, service_name):
+        """
+        Like discover_slaves(), but fires with the full Sentinel state of
+        every replica that is not in ODOWN or SDOWN state.
+        """
         result = defer.Deferred()
 
         def on_response(response):
             if result.called:
                 return
 
-            slaves = self.filter_slaves(response)
+            slaves = [
+                slave for slave in response
+                if not slave["is_odown"] and not slave["is_sdown"]
+            ]
             if slaves:
                 result.callback(slaves)
                 timeout_call.cancel()
@@ -2777,20 +7286,33 @@ class Sentinel(object):
 
         return result
 
-    @staticmethod
-    def _connect_factory_and_return_handler(factory, poolsize):
+    def _connect_factory_and_return_handler(self, factory, poolsize):
+        self._listeners.append(factory)
         for _ in range(poolsize):
             # host and port will be rewritten by try_to_connect
-            connector = Connector("0.0.0.0", None, factory, factory.maxDelay, None, reactor)
+            connector = SentinelConnector("0.0.0.0", None, factory,
+                                          factory.maxDelay, None, reactor)
+            factory.connectors.append(connector)
             factory.try_to_connect(connector, nodelay=True)
         return factory.handler
 
     def master_for(self, service_name, factory_class=SentinelConnectionFactory,
-                   dbid=None, poolsize=1, **connection_kwargs):
+                   dbid=None, poolsize=1, standby_poolsize=0,
+                   standby_replicas=1, standby_refresh_interval=30,
+                   **connection_kwargs):
+        """
+        With `standby_poolsize`, that many connections are also kept open
+        to each of the `standby_replicas` replicas most likely to be
+        promoted, so that the pool can be used right after a failover.
+        """
         factory = factory_class(sentinel_manager=self, service_name=service_name,
                                 is_master=True, uuid=None, dbid=dbid,
                                 poolsize=poolsize, **connection_kwargs)
-        return self._connect_factory_and_return_handler(factory, poolsize)
+        handler = self._connect_factory_and_return_handler(factory, poolsize)
+        if standby_poolsize:
+            factory.startStandby(standby_poolsize, standby_replicas,
+                                 standby_refresh_interval)
+        return handler
 
     def slave_for(self, service_name, factory_class=SentinelConnectionFactory,
                   dbid=None, poolsize=1, **connection_kwargs):
@@ -2799,6 +7321,37 @@ class Sentinel(object):
                                 poolsize=poolsize, **connection_kwargs)
         return self._connect_factory_and_return_handler(factory, poolsize)
 
+    def replica_routing_for(self, service_name, dbid=None, poolsize=1,
+                            replica_poolsize=1, healthCheckInterval=1,
+                            refresh_interval=30, check_replication=True,
+                            max_replication_lag=None, **connection_kwargs):
+        """
+        Returns a ReplicaRoutingHandler: writes go to the master, reads go
+        to the replica with the lowest round trip time, as measured by
+        health checks every `healthCheckInterval` seconds.
+
+        With `check_replication`, replicas whose link to the master is down
+        are not used. `max_replication_lag` excludes replicas whose
+        replication offset is that many bytes behind the most up to date
+        replica.
+        """
+        master = self.master_for(service_name, dbid=dbid, poolsize=poolsize,
+                                 **connection_kwargs)
+
+        def replica_factory(host, port):
+            return lazyConnectionPool(host, port, dbid=dbid,
+                                      poolsize=replica_poolsize,
+                                      healthCheckInterval=healthCheckInterval,
+                                      **connection_kwargs)
+
+        handler = ReplicaRoutingHandler(self, service_name, master,
+                                        replica_factory,
+                                        refresh_interval=refresh_interval,
+                                        check_replication=check_replication,
+                                        max_replication_lag=max_replication_lag)
+        self._listeners.append(handler)
+        return handler
+
 
 __all__ = [
     "Connection", "lazyConnection",
@@ -2809,7 +7362,14 @@ __all__ = [
     "UnixConnectionPool", "lazyUnixConnectionPool",
     "ShardedUnixConnection", "lazyShardedUnixConnection",
     "ShardedUnixConnectionPool", "lazyShardedUnixConnectionPool",
-    "Sentinel", "MasterNotFoundError"
+    "Sentinel", "MasterNotFoundError", "PoolExhausted",
+    "ReplicaRoutingHandler", "ReplyCache", "ClientCache", "NearCacheHandler",
+    "CoalescingHandler", "BatchingHandler", "Script", "ScanIterator",
+    "MergedScanIterator", "BlockingMultiplexer",
+    "ReliableQueue", "StreamConsumer", "DelayedScheduler",
+    "ChannelDispatcher", "PartitionedSubscriber", "ShardedSubscriber",
+    "Subscription", "MonitorEvent", "HotKeyAggregator", "LatencyHistogram",
+    "CommandMetrics"
 ]
 
 __author__ = "Alexandre Fiori"